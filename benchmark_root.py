@@ -0,0 +1,184 @@
+# command:
+# python benchmark_root.py -d h36m -k cpn_ft_h36m_dbb -f 243 --bench-batch-sizes 1,8,32
+# python benchmark_root.py -f 243 --bench-synthetic
+
+import os
+import weakref
+import numpy as np
+import torch
+from time import perf_counter
+from torch.utils._pytree import tree_flatten
+from torch.utils._python_dispatch import TorchDispatchMode
+
+from common.arguments import parse_args
+from common.camera import project_to_2d
+from common.generators import PackedGenerator_Seq
+from common.prepared_dataset import prepare_data
+from common.utils import ROOT_SOLVERS, get_root_solver
+
+args = parse_args()
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+batch_sizes = [int(b) for b in args.bench_batch_sizes.split(',')]
+num_frames = args.number_of_frames
+solvers = {name: get_root_solver(name, args.root_refine) for name in ROOT_SOLVERS}
+
+
+class PeakMemory(TorchDispatchMode):
+    """
+    Peak size of the tensor storages allocated while the mode is active (CPU fallback for
+    torch.cuda.max_memory_allocated). Inputs created before entering are not counted.
+    """
+    def __init__(self):
+        super().__init__()
+        self.live = {}
+        self.current = 0
+        self.peak = 0
+
+    def _release(self, ptr):
+        entry = self.live[ptr]
+        entry[1] -= 1
+        if entry[1] == 0:
+            self.current -= entry[0]
+            del self.live[ptr]
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        out = func(*args, **(kwargs or {}))
+        inputs = {t.untyped_storage().data_ptr() for t in tree_flatten((args, kwargs))[0] if isinstance(t, torch.Tensor)}
+        for t in tree_flatten(out)[0]:
+            if not isinstance(t, torch.Tensor):
+                continue
+            ptr = t.untyped_storage().data_ptr()
+            if ptr in inputs and ptr not in self.live:
+                continue
+            if ptr not in self.live:
+                self.live[ptr] = [t.untyped_storage().nbytes(), 0]
+                self.current += self.live[ptr][0]
+                self.peak = max(self.peak, self.current)
+            self.live[ptr][1] += 1
+            weakref.finalize(t, self._release, ptr)
+        return out
+
+
+def peak_memory(fn):
+    """ Extra memory (bytes) needed by fn() at its peak """
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+        fn()
+        torch.cuda.synchronize()
+        return torch.cuda.max_memory_allocated() - base
+    tracker = PeakMemory()
+    with tracker:
+        fn()
+    return tracker.peak
+
+
+def synthetic_batch(batch_size, noise=0.005, outlier_ratio=0.1, outlier_scale=0.05):
+    """
+    Random root-relative poses placed 3-7 m in front of an H36M-like camera, projected with
+    project_to_2d, with Gaussian 2D noise and a fraction of grossly wrong joints.
+    """
+    p3d = 0.25 * torch.randn(batch_size, num_frames, 17, 3)
+    p3d[:, :, 0] = 0
+    root = torch.cat((torch.rand(batch_size, 1, 1, 2) - 0.5, 3 + 4 * torch.rand(batch_size, 1, 1, 1)), dim=-1)
+    root = root + 0.01 * torch.randn(batch_size, num_frames, 1, 3).cumsum(dim=1)
+    camera = torch.tensor([2.29, 2.29, 0.02, 0.01, 0, 0, 0, 0, 0]).repeat(batch_size, 1)
+    p2d = project_to_2d(p3d + root, camera)
+    p2d = p2d + noise * torch.randn_like(p2d)
+    outliers = torch.rand(batch_size, num_frames, 17, 1) < outlier_ratio
+    p2d = p2d + outliers * outlier_scale * torch.randn_like(p2d)
+    return p3d, p2d, camera, root
+
+
+def real_batches():
+    """ Yields (batch size, p3d, p2d, camera, root) windows of the test subjects, or nothing if the data is missing """
+    dataset_path = 'data/data_3d_' + args.dataset + '.npz'
+    keypoints_path = 'data/data_2d_' + args.dataset + '_' + args.keypoints + '.npz'
+    if args.prepared_data:
+        dataset_path = keypoints_path = args.prepared_data
+    if not os.path.exists(dataset_path) or not os.path.exists(keypoints_path):
+        print('INFO: {} not found, skipping real inputs'.format(dataset_path))
+        return
+    if args.dataset == 'h36m':
+        from common.h36m_dataset import Human36mDataset
+        dataset = Human36mDataset(dataset_path)
+    elif args.dataset.startswith('humaneva'):
+        from common.humaneva_dataset import HumanEvaDataset
+        dataset = HumanEvaDataset(dataset_path)
+    else:
+        raise KeyError('Invalid dataset')
+    if dataset.prepared():
+        keypoints = dataset.keypoints()
+    else:
+        keypoints, _ = prepare_data(dataset, keypoints_path)
+
+    cameras, poses_3d, poses_2d = [], [], []
+    for subject in args.subjects_test.split(','):
+        for action in keypoints[subject].keys():
+            for cam_idx, kps in enumerate(keypoints[subject][action]):
+                poses_2d.append(kps)
+                poses_3d.append(dataset[subject][action]['positions_3d'][cam_idx])
+                cameras.append(dataset.cameras()[subject][cam_idx]['intrinsic'])
+
+    for batch_size in batch_sizes:
+        generator = PackedGenerator_Seq(batch_size, cameras, poses_3d, poses_2d, num_frames)
+        cam, batch_3d, batch_2d, _, _, _, _ = next(generator.next_epoch())
+        batch_3d = torch.from_numpy(batch_3d)
+        root = batch_3d[:, :, :1].clone()
+        batch_3d[:, :, 0] = 0
+        yield batch_size, batch_3d, torch.from_numpy(batch_2d), torch.from_numpy(cam), root
+
+
+def benchmark(name, solver, p3d, p2d, camera, root):
+    p3d, p2d, camera, root = p3d.to(device), p2d.to(device), camera.to(device), root.to(device)
+
+    def call():
+        with torch.no_grad():
+            return solver(p3d, p2d, camera)[0]
+
+    def train_step():
+        solver(p3d.clone().requires_grad_(), p2d, camera)[0].sum().backward()
+
+    torch.manual_seed(0)
+    mrpe = torch.norm(call() - root, dim=-1).mean().item()
+    timings = []
+    for _ in range(args.bench_repeat):
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start = perf_counter()
+        call()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        timings.append(perf_counter() - start)
+    latency = np.median(timings)
+    peak = peak_memory(train_step)
+
+    batch_size = p3d.shape[0]
+    print('{:<14} {:>6} {:>10.2f} {:>12.0f} {:>10.1f} {:>9.1f}'.format(
+        name, batch_size, latency * 1000, batch_size * p3d.shape[1] / latency, peak / 2**20, mrpe * 1000))
+
+
+def print_header(title):
+    print('----' + title + '----')
+    print('{:<14} {:>6} {:>10} {:>12} {:>10} {:>9}'.format('solver', 'batch', 'ms/call', 'frames/s', 'peak MB', 'MRPE mm'))
+
+
+print('Benchmarking root solvers on {} with {}-frame windows'.format(device, num_frames))
+print('(latency: forward without grad, peak memory: forward + backward w.r.t. p3d, {} refinement steps)'.format(args.root_refine))
+
+print_header('synthetic')
+for batch_size in batch_sizes:
+    torch.manual_seed(batch_size)
+    inputs = synthetic_batch(batch_size)
+    for name, solver in solvers.items():
+        benchmark(name, solver, *inputs)
+
+if not args.bench_synthetic:
+    header = False
+    for batch_size, *inputs in real_batches():
+        if not header:
+            print_header(args.dataset + ' ' + args.subjects_test)
+            header = True
+        for name, solver in solvers.items():
+            benchmark(name, solver, *inputs)
@@ -26,6 +26,8 @@ def parse_args():
                         help='log file directory')
     parser.add_argument('-cf','--checkpoint-frequency', default=256, type=int, metavar='N',
                         help='create a checkpoint every N epochs')
+    parser.add_argument('--keep-checkpoints', default=0, type=int, metavar='N',
+                        help='keep only the N most recent periodic checkpoints (0: keep all)')
     parser.add_argument('-r', '--resume', default='', type=str, metavar='FILENAME',
                         help='checkpoint to resume (file name)')
     parser.add_argument('--nolog', action='store_true', help='forbiden log function')
@@ -35,12 +37,15 @@ def parse_args():
     parser.add_argument('--export-training-curves', action='store_true', help='save training curves as .png images')
     parser.add_argument('-m','--model', default='MixSTE2', type=str, metavar='NAME', help='model name')
     parser.add_argument('-n', '--wandb_id', default='', type=str, metavar='ID', help='wandb id')
+    parser.add_argument('--prepared-data', default='', type=str, metavar='PATH',
+                        help='memory-mapped dataset store written by prepare_data.py (skips per-run data preparation)')
 
 
     # Model arguments
     parser.add_argument('-s', '--stride', default=81, type=int, metavar='N', help='chunk size to use during training')
     parser.add_argument('-e', '--epochs', default=256, type=int, metavar='N', help='number of training epochs')
     parser.add_argument('-b', '--batch-size', default=2, type=int, metavar='N', help='batch size in terms of predicted frames')
+    parser.add_argument('-eb', '--eval-batch-size', default=16, type=int, metavar='N', help='number of windows per evaluation batch')
     parser.add_argument('-drop', '--dropout', default=0., type=float, metavar='P', help='dropout probability')
     parser.add_argument('-lr', '--learning-rate', default=0.00004, type=float, metavar='LR', help='initial learning rate')
     parser.add_argument('-lrd', '--lr-decay', default=0.99, type=float, metavar='LR', help='learning rate decay per epoch')
@@ -56,6 +61,10 @@ def parse_args():
     parser.add_argument('--ftpostrf', action='store_true', help='For fintune to post refine module')
     parser.add_argument('--loss2d', default=0, type=float, help='use 2d loss')
     parser.add_argument('--lossroot', default=0, type=float, help='use root loss')
+    parser.add_argument('--root-solver', default='trimmed', type=str, metavar='NAME',
+                        help='root solver: lstsq, trimmed, torrent, m_estimation, ransac, lms, irls or temporal')
+    parser.add_argument('--root-refine', default=0, type=int, metavar='N',
+                        help='Levenberg-Marquardt iterations refining the root under the full (distorted) camera model')
     # parser.add_argument('-no-tta', '--no-test-time-augmentation', dest='test_time_augmentation', action='store_false',
     #                     help='disable test-time flipping')
     # parser.add_argument('-arc', '--architecture', default='3,3,3', type=str, metavar='LAYERS', help='filter widths separated by comma')
@@ -66,10 +75,23 @@ def parse_args():
 
     # Experimental
     parser.add_argument('-gpu', default='0', type=str, help='assign the gpu(s) to use')
+    parser.add_argument('--threads', default=0, type=int, metavar='N',
+                        help='intra-op threads per rank without GPUs (default: physical cores of the rank)')
     parser.add_argument('--subset', default=1, type=float, metavar='FRACTION', help='reduce dataset size by fraction')
     parser.add_argument('--downsample', default=1, type=int, metavar='FACTOR', help='downsample frame rate by factor (semi-supervised)')
     parser.add_argument('--warmup', default=1, type=int, metavar='N', help='warm-up epochs for semi-supervision')
     parser.add_argument('--no-eval', action='store_true', help='disable epoch evaluation while training (small speed-up)')
+    parser.add_argument('--train-eval-windows', default=64, type=int, metavar='N',
+                        help='windows per action of the fixed training-set sample evaluated every epoch (0: full pass)')
+    parser.add_argument('--train-eval-interval', default=1, type=int, metavar='K',
+                        help='evaluate the training set every K epochs')
+    parser.add_argument('--async-eval', action='store_true',
+                        help='evaluate weight snapshots in a separate process instead of stopping training every epoch')
+    parser.add_argument('--async-eval-cores', default=-1, type=int, metavar='N',
+                        help='physical cores kept out of the training ranks for the --async-eval worker without GPUs '
+                             '(default: an equal share of the node)')
+    parser.add_argument('--bar-interval', default=20, type=int, metavar='N',
+                        help='refresh the training progress bar (and sync the running metrics) every N iterations')
     parser.add_argument('--dense', action='store_true', help='use dense convolutions instead of dilated convolutions')
     parser.add_argument('--disable-optimizations', action='store_true', help='disable optimized model for single-frame predictions')
     parser.add_argument('--linear-projection', action='store_true', help='use only linear coefficients for semi-supervised projection')
@@ -96,6 +118,11 @@ def parse_args():
     parser.add_argument('--compare', action='store_true', default=False, help='Whether to compare with other methods e.g. Poseformer')
     # parser.add_argument('-comchk', type=str, default='/mnt/data3/home/zjl/workspace/3dpose/PoseFormer/checkpoint/detected81f.bin', help='checkpoint of comparison methods')
 
+    # Root solver benchmark (benchmark_root.py)
+    parser.add_argument('--bench-batch-sizes', default='1,8,32', type=str, metavar='LIST', help='batch sizes separated by comma')
+    parser.add_argument('--bench-repeat', default=10, type=int, metavar='N', help='timed calls per solver and batch size')
+    parser.add_argument('--bench-synthetic', action='store_true', help='only benchmark on synthetic inputs')
+
     # ft2d.py
     parser.add_argument('-lcs', '--linear_channel_size', type=int, default=1024, metavar='N', help='channel size of the LinearModel')
     parser.add_argument('-depth', type=int, default=4, metavar='N', help='nums of blocks of the LinearModel')
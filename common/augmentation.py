@@ -0,0 +1,124 @@
+import numpy as np
+import torch
+import torch.nn as nn
+
+
+def flip_permutation(num_joints, left, right):
+    """
+    Index table that swaps the left and right joints, e.g. x[..., perm, :] mirrors a pose.
+    """
+    perm = np.arange(num_joints)
+    if left is not None and right is not None:
+        perm[list(left) + list(right)] = list(right) + list(left)
+    return perm
+
+
+class PoseFlip:
+    """
+    Horizontal flip augmentation for 2D keypoints, 3D joints and camera parameters.
+    The left/right permutation tables are derived once; a whole batch is then flipped with one
+    gather and one multiply, selected per sample with a boolean mask. Works on NumPy arrays and
+    torch tensors (tables are cached per device).
+
+    Arguments:
+    kps_left and kps_right -- list of left/right 2D keypoints
+    joints_left and joints_right -- list of left/right 3D joints
+    num_keypoints -- number of 2D keypoints
+    num_joints -- number of 3D joints (defaults to num_keypoints)
+    """
+    def __init__(self, kps_left, kps_right, joints_left, joints_right, num_keypoints, num_joints=None):
+        if num_joints is None:
+            num_joints = num_keypoints
+        self.perm_2d = flip_permutation(num_keypoints, kps_left, kps_right)
+        self.perm_3d = flip_permutation(num_joints, joints_left, joints_right)
+        self._tables = {}
+
+    @classmethod
+    def from_metadata(cls, keypoints_metadata, skeleton):
+        keypoints_symmetry = keypoints_metadata['keypoints_symmetry']
+        return cls(keypoints_symmetry[0], keypoints_symmetry[1], skeleton.joints_left(), skeleton.joints_right(),
+                   num_keypoints=keypoints_metadata['num_joints'], num_joints=skeleton.num_joints())
+
+    def _table(self, name, like):
+        table = getattr(self, name)
+        if not torch.is_tensor(like):
+            return table
+        key = (name, like.device)
+        if key not in self._tables:
+            self._tables[key] = torch.from_numpy(table).to(like.device)
+        return self._tables[key]
+
+    def _flip(self, x, perm, mask, channel):
+        """
+        Negate x[..., channel] and permute the joint axis (-2) of the samples selected by mask
+        (first axis). Without a mask every sample is flipped.
+        """
+        perm = self._table(perm, x)
+        sign = [1] * x.shape[-1]
+        sign[channel] = -1
+        if mask is None:
+            sign = torch.tensor(sign, dtype=x.dtype, device=x.device) if torch.is_tensor(x) else np.array(sign, dtype=x.dtype)
+            return x[..., perm, :] * sign
+
+        # per-sample joint order and sign, broadcast over all axes between batch and joints
+        view = (x.shape[0],) + (1,) * (x.ndim - 3)
+        if torch.is_tensor(x):
+            mask = torch.as_tensor(mask, device=x.device)
+            identity = torch.arange(len(perm), device=x.device)
+            index = torch.where(mask[:, None], perm, identity).view(view + (len(perm), 1))
+            scale = torch.where(mask[:, None], torch.tensor(sign, dtype=x.dtype, device=x.device),
+                                torch.ones(len(sign), dtype=x.dtype, device=x.device))
+            return torch.gather(x, -2, index.expand(x.shape)) * scale.view(view + (1, len(sign)))
+        mask = np.asarray(mask, dtype=bool)
+        index = np.where(mask[:, None], perm, np.arange(len(perm))).reshape(view + (len(perm), 1))
+        scale = np.where(mask[:, None], np.array(sign, dtype=x.dtype), np.ones(len(sign), dtype=x.dtype))
+        return np.take_along_axis(x, index, axis=-2) * scale.reshape(view + (1, len(sign)))
+
+    def flip_2d(self, x, mask=None):
+        """ x -- 2D keypoints (B, ..., K, C); mask -- boolean (B,) selecting the samples to flip """
+        return self._flip(x, 'perm_2d', mask, 0)
+
+    def flip_3d(self, x, mask=None):
+        """ x -- 3D joints (B, ..., J, 3); mask -- boolean (B,) selecting the samples to flip """
+        return self._flip(x, 'perm_3d', mask, 0)
+
+    def flip_camera(self, camera, mask=None):
+        """
+        camera -- intrinsic vectors (B, 9); the horizontal tangential distortion (index 7) changes sign.
+        """
+        if camera.shape[-1] <= 7:
+            return camera
+        sign = [1] * camera.shape[-1]
+        sign[7] = -1
+        if torch.is_tensor(camera):
+            sign = torch.tensor(sign, dtype=camera.dtype, device=camera.device)
+            if mask is not None:
+                sign = torch.where(torch.as_tensor(mask, device=camera.device)[:, None], sign, torch.ones_like(sign))
+        else:
+            sign = np.array(sign, dtype=camera.dtype)
+            if mask is not None:
+                sign = np.where(np.asarray(mask, dtype=bool)[:, None], sign, np.ones_like(sign))
+        return camera * sign
+
+
+class FlipTTA(nn.Module):
+    """
+    Flip test-time augmentation (following VideoPose3D) around a pose model.
+    The input and its mirrored copy go through the model as one batch; the prediction of the
+    mirrored copy is flipped back and averaged with the original one.
+
+    The wrapped model is not copied, so loading weights into it is picked up by the wrapper.
+
+    Arguments:
+    model -- maps 2D keypoints (B, F, K, 2) to 3D joints (B, F, J, 3)
+    pose_flip -- PoseFlip holding the left/right tables
+    """
+    def __init__(self, model, pose_flip):
+        super().__init__()
+        self.model = model
+        self.pose_flip = pose_flip
+
+    def forward(self, inputs_2d):
+        predicted = self.model(torch.cat((inputs_2d, self.pose_flip.flip_2d(inputs_2d))))
+        predicted = predicted.view((2, inputs_2d.shape[0]) + predicted.shape[1:])
+        return (predicted[0] + self.pose_flip.flip_3d(predicted[1])) * 0.5
@@ -0,0 +1,116 @@
+import numpy as np
+import torch
+
+from common.h36m_dataset import h36m_skeleton_17
+
+
+class BoneGeometry:
+    """
+    Bone-level quantities of a skeleton (lengths, directions, re-targeting, symmetry, temporal
+    consistency), computed with single gathers over index tables derived once from the joint
+    parents. Every non-root joint is the child of one bone; bones are ordered by child joint,
+    which for the 17-joint Human3.6M skeleton is the usual 16-bone list
+    [0,1],[1,2],[2,3],[0,4],...,[15,16]. Tables are cached per device (and dtype).
+
+    Arguments:
+    parents -- parent of every joint (-1 for the root)
+    joints_left and joints_right -- symmetric joints (optional, for symmetry())
+    """
+    def __init__(self, parents, joints_left=None, joints_right=None):
+        parents = np.asarray(parents, dtype='int64')
+        self.num_joints = len(parents)
+        self.child = np.flatnonzero(parents >= 0)
+        self.parent = parents[self.child]
+        self.num_bones = len(self.child)
+
+        # bone of every child joint; the root points past the last bone
+        self.joint_bone = np.full(self.num_joints, self.num_bones, dtype='int64')
+        self.joint_bone[self.child] = np.arange(self.num_bones)
+
+        # bones on the path from the root to every joint, and the root of every joint
+        self.ancestors = np.zeros((self.num_joints, self.num_bones), dtype='float32')
+        self.root_of = np.arange(self.num_joints)
+        for joint in range(self.num_joints):
+            j = joint
+            while parents[j] >= 0:
+                self.ancestors[joint, self.joint_bone[j]] = 1
+                j = parents[j]
+            self.root_of[joint] = j
+
+        # pairs of symmetric bones, matched through their child joints
+        self.sym_left = np.zeros(0, dtype='int64')
+        self.sym_right = np.zeros(0, dtype='int64')
+        if joints_left is not None and joints_right is not None:
+            pairs = [(l, r) for l, r in zip(joints_left, joints_right) if parents[l] >= 0 and parents[r] >= 0]
+            self.sym_left = self.joint_bone[[l for l, _ in pairs]].astype('int64')
+            self.sym_right = self.joint_bone[[r for _, r in pairs]].astype('int64')
+        self._tables = {}
+
+    @classmethod
+    def from_skeleton(cls, skeleton):
+        """ Geometry of a common.skeleton.Skeleton, e.g. dataset.skeleton() """
+        return cls(skeleton.parents(), skeleton.joints_left(), skeleton.joints_right())
+
+    def _table(self, name, like):
+        key = (name, like.device, like.dtype if name == 'ancestors' else None)
+        if key not in self._tables:
+            table = torch.from_numpy(getattr(self, name)).to(like.device)
+            self._tables[key] = table.to(like.dtype) if name == 'ancestors' else table
+        return self._tables[key]
+
+    def vectors(self, p3d):
+        """ Bone vectors child - parent (..., K, 3) of joints p3d (..., J, 3) """
+        return p3d[..., self._table('child', p3d), :] - p3d[..., self._table('parent', p3d), :]
+
+    def lengths(self, p3d):
+        """ Bone lengths (..., K) """
+        return torch.norm(self.vectors(p3d), dim=-1)
+
+    def directions(self, p3d, epsilon=1e-6):
+        """ Unit bone directions (..., K, 3) and lengths (..., K, 1), clamped to epsilon """
+        vectors = self.vectors(p3d)
+        lengths = torch.norm(vectors, dim=-1, keepdim=True).clamp(min=epsilon)
+        return vectors / lengths, lengths
+
+    def retarget(self, p3d, lengths, epsilon=1e-6):
+        """
+        Keep the bone directions of p3d (..., J, 3) and the position of the root, and set the bone
+        lengths (broadcastable to (..., K)). Every joint is its root plus the sum of the re-scaled
+        bones along its kinematic chain, i.e. one product with the ancestor table.
+
+        Returns the re-targeted joints (..., J, 3) and the original bone lengths of p3d (..., K, 1).
+        """
+        directions, old_lengths = self.directions(p3d, epsilon)
+        offsets = directions * lengths.unsqueeze(-1)
+        joints = p3d[..., self._table('root_of', p3d), :] + torch.matmul(self._table('ancestors', p3d), offsets)
+        return joints, old_lengths
+
+    def to_joints(self, values, fill=1.):
+        """ Per-bone values (..., K, C) to per-joint values (..., J, C), stored at the child joint; roots get fill """
+        values = torch.cat((values, torch.full_like(values[..., :1, :], fill)), dim=-2)
+        return values[..., self._table('joint_bone', values), :]
+
+    def symmetry(self, p3d):
+        """ Length differences |left - right| of the symmetric bone pairs (..., P) """
+        lengths = self.lengths(p3d)
+        return torch.abs(lengths[..., self._table('sym_left', p3d)] - lengths[..., self._table('sym_right', p3d)])
+
+    def symmetrize(self, lengths):
+        """ Bone lengths (..., K) with both bones of every symmetric pair set to the mean of the pair """
+        left, right = self._table('sym_left', lengths), self._table('sym_right', lengths)
+        mean = (lengths[..., left] + lengths[..., right]) / 2
+        return lengths.index_copy(-1, left, mean).index_copy(-1, right, mean)
+
+    def temporal_change(self, p3d):
+        """ Change of every bone vector between consecutive frames of p3d (B, T, J, 3), (B, T-1, K) """
+        vectors = self.vectors(p3d)
+        return torch.norm(vectors[:, 1:] - vectors[:, :-1], dim=-1)
+
+
+# Default geometry: Human3.6M skeleton after removing the static joints (17 joints)
+H36M_BONES = BoneGeometry.from_skeleton(h36m_skeleton_17())
+
+# T-pose template of the 17-joint Human3.6M skeleton (unit bones), used by tmpjpe
+H36M_TPOSE = np.array([[0., 0, 0], [1, 0, 0], [1, -1, 0], [1, -2, 0], [-1, 0, 0], [-1, -1, 0], [-1, -2, 0],
+                       [0, 1, 0], [0, 2, 0], [0, 3, 0], [0, 4, 0], [-1, 2, 0], [-2, 2, 0], [-3, 2, 0],
+                       [1, 2, 0], [2, 2, 0], [3, 2, 0]], dtype='float32')
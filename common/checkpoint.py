@@ -0,0 +1,172 @@
+import os
+import re
+import json
+import queue
+import threading
+import torch
+
+
+def to_cpu(state):
+    """ Copy of a (nested) state dict with every tensor detached and copied to the CPU """
+    if torch.is_tensor(state):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {k: to_cpu(v) for k, v in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(to_cpu(v) for v in state)
+    return state
+
+
+def atomic_save(obj, path):
+    """ torch.save to a temporary file next to path, renamed over path once complete """
+    tmp_path = path + '.tmp'
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(path, optimizer=True):
+    """
+    Load a checkpoint written by CheckpointManager (or a single-file checkpoint); with optimizer,
+    the optimizer state stored in its own file is loaded as checkpoint['optimizer'].
+    """
+    checkpoint = torch.load(path, map_location=lambda storage, loc: storage)
+    optimizer_file = checkpoint.get('optimizer_file')
+    if optimizer and optimizer_file is not None:
+        optimizer_path = os.path.join(os.path.dirname(path), optimizer_file)
+        checkpoint['optimizer'] = torch.load(optimizer_path, map_location=lambda storage, loc: storage) \
+            if os.path.exists(optimizer_path) else None
+    return checkpoint
+
+
+class CheckpointManager:
+    """
+    Writes checkpoints on a background thread, so that training does not stall at epoch boundaries.
+    save() copies the weights and the optimizer state to the CPU and returns; the thread writes them
+    with atomic_save. The optimizer state of an epoch is written once, to optimizer_epoch_{epoch}.bin,
+    and every weights file of the epoch (periodic and best checkpoints) refers to it by name.
+
+    Retention: only the keep most recent periodic checkpoints are kept (0 keeps all); optimizer files
+    that no kept checkpoint refers to are removed. Checkpoints already in the directory (e.g. of the run
+    that is resumed) are adopted first, by epoch, and count for retention from the next write on; which
+    optimizer file a checkpoint refers to is kept in the small index file checkpoints.json, so that the
+    checkpoints themselves are never read.
+
+    Arguments:
+    directory -- directory of the checkpoint files
+    keep -- number of periodic checkpoints to keep (0: all)
+    """
+    index_file = 'checkpoints.json'
+
+    def __init__(self, directory, keep=0):
+        self.directory = directory
+        self.keep = keep
+        self.periodic = []
+        self.references = {}
+        self.optimizer_files = set()
+        self.error = None
+        self._scan()
+        self.jobs = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def save(self, epoch, names, model_state, optimizer_state=None, periodic=None, **meta):
+        """
+        Write the weights file names[i] of every name (epoch, meta, 'model_pos' and the name of the
+        optimizer file) and the optimizer state of the epoch. periodic is the name among names that
+        counts for retention.
+        """
+        self._check()
+        if not names:
+            return
+        optimizer_file = None if optimizer_state is None else 'optimizer_epoch_{}.bin'.format(epoch)
+        checkpoint = dict(meta, epoch=epoch, model_pos=to_cpu(model_state), optimizer_file=optimizer_file)
+        optimizer_state = None if optimizer_state is None else to_cpu(optimizer_state)
+        self.jobs.put((list(names), checkpoint, optimizer_state, periodic))
+
+    def wait(self):
+        """ Block until every queued checkpoint is written """
+        self.jobs.join()
+        self._check()
+
+    def close(self):
+        self.wait()
+        self.jobs.put(None)
+        self.thread.join()
+
+    def _check(self):
+        if self.error is not None:
+            raise RuntimeError('checkpoint writer failed') from self.error
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _scan(self):
+        """
+        Adopt the periodic, best and optimizer files of earlier runs in the directory. Checkpoints
+        missing from the index refer to optimizer_epoch_{epoch}.bin if they are periodic and it exists,
+        otherwise they are single-file checkpoints.
+        """
+        if not os.path.isdir(self.directory):
+            return
+        index = {}
+        if os.path.exists(self._path(self.index_file)):
+            with open(self._path(self.index_file)) as f:
+                index = json.load(f)
+        files = set(os.listdir(self.directory))
+        periodic = []
+        for name in files:
+            match = re.fullmatch(r'(optimizer_)?epoch_(\d+)\.bin', name)
+            if match and match.group(1):
+                self.optimizer_files.add(name)
+                continue
+            if match:
+                periodic.append((int(match.group(2)), name))
+                derived = 'optimizer_epoch_{}.bin'.format(match.group(2))
+                self.references[name] = index.get(name, derived if derived in files else None)
+            elif re.fullmatch(r'best_epoch.*\.bin', name):
+                self.references[name] = index.get(name)
+        self.periodic = [name for _, name in sorted(periodic)]
+
+    def _write_index(self):
+        tmp_path = self._path(self.index_file) + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.references, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self._path(self.index_file))
+
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                if job is None:
+                    return
+                self._write(*job)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.jobs.task_done()
+
+    def _write(self, names, checkpoint, optimizer_state, periodic):
+        optimizer_file = checkpoint['optimizer_file']
+        if optimizer_file is not None:
+            atomic_save(optimizer_state, self._path(optimizer_file))
+            self.optimizer_files.add(optimizer_file)
+        for name in names:
+            atomic_save(checkpoint, self._path(name))
+            self.references[name] = optimizer_file
+
+        if periodic is not None:
+            if periodic in self.periodic:
+                self.periodic.remove(periodic)
+            self.periodic.append(periodic)
+            while self.keep > 0 and len(self.periodic) > self.keep:
+                name = self.periodic.pop(0)
+                if name not in names and os.path.exists(self._path(name)):
+                    os.remove(self._path(name))
+                self.references.pop(name, None)
+
+        # optimizer files that no kept checkpoint refers to any more
+        for name in self.optimizer_files - set(self.references.values()):
+            if os.path.exists(self._path(name)):
+                os.remove(self._path(name))
+        self.optimizer_files &= set(self.references.values())
+        self._write_index()
@@ -1,8 +1,14 @@
 import numpy as np
+import torch
 from common.skeleton import Skeleton
+from common.augmentation import PoseFlip
+from common.prepared_dataset import flatten_sequences, MappedArray
 from torch.utils.data import Dataset
 from itertools import zip_longest
 
+# (seq_idx, start_frame, end_frame, flip) record of one training chunk
+PAIR_DTYPE = np.dtype([('seq', 'int32'), ('start', 'int64'), ('end', 'int64'), ('flip', 'bool')])
+
 class ChunkedDataset_Seq(Dataset):
     """
     Batched data generator (re-written as a PyTorch Dataset).
@@ -23,6 +29,8 @@ class ChunkedDataset_Seq(Dataset):
     shuffle -- if True, shuffle the order of chunked pairs on initialization
     """
 
+    _buffers = ('buffer_2d', 'buffer_3d', 'camera_table')
+
     def __init__(self, 
                  cameras,
                  poses_3d,
@@ -49,9 +57,15 @@ class ChunkedDataset_Seq(Dataset):
             len(cameras), len(poses_2d)
         )
         
-        self.cameras = cameras
-        self.poses_3d = poses_3d
-        self.poses_2d = poses_2d
+        # (2) 모든 시퀀스를 하나의 연속 버퍼로 합침
+        # Every sequence lives in one flat buffer and is addressed through integer start rows, so
+        # DataLoader workers share these few arrays instead of touching thousands of per-sequence objects.
+        # Sequences of a prepared store are used in place (see flatten_sequences), without a private copy.
+        self.lengths = np.array([p.shape[0] for p in poses_2d], dtype='int64')
+        self.buffer_2d, self.starts_2d = flatten_sequences(poses_2d)
+        self.buffer_3d, self.starts_3d = (None, None) if poses_3d is None else flatten_sequences(poses_3d)
+        self.camera_table = None if cameras is None else np.ascontiguousarray(np.stack(cameras))
+        self._shared = {} # shared-memory tensors behind the buffers, see share_memory()
         
         self.chunk_length = chunk_length
         self.pad = pad
@@ -62,9 +76,11 @@ class ChunkedDataset_Seq(Dataset):
         self.kps_right = kps_right
         self.joints_left = joints_left
         self.joints_right = joints_right
+        self.flipper = PoseFlip(kps_left, kps_right, joints_left, joints_right, num_keypoints=poses_2d[0].shape[-2],
+                                num_joints=None if poses_3d is None else poses_3d[0].shape[-2])
         self.stride = stride
 
-        pairs = [] # (seq_idx, start_frame, end_frame, flip) tuples
+        pairs = [] # (seq_idx, start_frame, end_frame, flip) records
         for i in range(len(poses_2d)):
             assert poses_3d is None or poses_2d[i].shape[0] == poses_3d[i].shape[0]
             n_chunks = (poses_2d[i].shape[0] + stride - 1) // stride
@@ -76,11 +92,49 @@ class ChunkedDataset_Seq(Dataset):
             ends = starts + chunk_length
             ends[-1] = min(ends[-1], poses_2d[i].shape[0])
             starts[-1] = min(starts[-1], poses_2d[i].shape[0] - chunk_length)
-            augment_vector = np.full(len(starts), False, dtype=bool)
-            pairs += zip(np.repeat(i, len(starts)), starts, ends, augment_vector)
+            chunks = np.zeros(len(starts), dtype=PAIR_DTYPE)
+            chunks['seq'] = i
+            chunks['start'] = starts
+            chunks['end'] = ends
+            pairs.append(chunks)
             if augment:
-                pairs += zip(np.repeat(i, len(starts)), starts, ends, ~augment_vector)
-        self.pairs = pairs
+                flipped = chunks.copy()
+                flipped['flip'] = True
+                pairs.append(flipped)
+        self.pairs = np.concatenate(pairs)
+
+    def share_memory(self):
+        """
+        Move the flat buffers into shared memory, so that DataLoader workers (forked or spawned) use
+        them without a copy each. Memory-mapped store buffers already are shared through the page
+        cache and stay as they are.
+        """
+        for name in self._buffers:
+            buffer = getattr(self, name)
+            if buffer is not None and name not in self._shared and not MappedArray.wraps(buffer):
+                self._shared[name] = torch.from_numpy(buffer).clone().share_memory_()
+                setattr(self, name, self._shared[name].numpy())
+        return self
+
+    def __getstate__(self):
+        # Shared buffers travel as their tensors, for which torch's multiprocessing pickler sends
+        # shared-memory handles instead of the data; memory-mapped buffers are mapped again by the
+        # worker. Other buffers are copied.
+        state = self.__dict__.copy()
+        for name in self._buffers:
+            if name in self._shared:
+                state[name] = None
+            elif MappedArray.wraps(state[name]):
+                state[name] = MappedArray(state[name])
+        return state
+
+    def __setstate__(self, state):
+        for name in self._buffers:
+            if name in state['_shared']:
+                state[name] = state['_shared'][name].numpy()
+            elif isinstance(state[name], MappedArray):
+                state[name] = state[name].open()
+        self.__dict__.update(state)
 
     def __len__(self):
         """
@@ -93,81 +147,39 @@ class ChunkedDataset_Seq(Dataset):
         index번째 chunk를 가져와서 2D, 3D, camera 데이터를 추출하고
         flip이 True면 좌우 반전 수행 후,
         최종적으로 (cam, pose_3d, pose_2d)의 형태로 반환.
+        A list of indices (e.g. from a BatchSampler) returns the whole batch at once, see get_batch().
         """
-        seq_i, start_3d, end_3d, flip = self.pairs[index]
-        seq_i = int(seq_i)  # numpy에서 튜플을 가져오면 dtype=object라 int 캐스팅
-        
-        # ----------------------------
-        # 2D poses 추출
-        # ----------------------------
-        seq_2d = self.poses_2d[seq_i]
-        random_shift = np.random.randint(-self.stride / 2, self.stride / 2)
-        start_3d += random_shift
-        end_3d += random_shift
-        start_2d = start_3d  # pad, causal_shift 반영하려면 추가할 수도 있음
-        end_2d   = end_3d
+        if np.ndim(index) > 0:
+            return self.get_batch(index)
+        return tuple(None if x is None else x[0] for x in self.get_batch([index]))
 
-        low_2d  = max(start_2d, 0)
-        high_2d = min(end_2d, seq_2d.shape[0])
-        pad_left_2d  = low_2d - start_2d
-        pad_right_2d = end_2d - high_2d
-
-        if pad_left_2d != 0 or pad_right_2d != 0:
-            chunk_2d = np.pad(
-                seq_2d[low_2d:high_2d],
-                ((pad_left_2d, pad_right_2d), (0, 0), (0, 0)), 
-                'edge'
-            )
-        else:
-            chunk_2d = seq_2d[low_2d:high_2d]
-
-        if flip:
-            # x 좌표 반전
-            chunk_2d[..., 0] *= -1
-            # 좌/우 keypoint swap
-            if (self.kps_left is not None) and (self.kps_right is not None):
-                left = self.kps_left
-                right = self.kps_right
-                # chunk_2d[:, left + right] 이런 식으로 스왑
-                chunk_2d[..., left + right, :] = chunk_2d[..., right + left, :]
-        # ----------------------------
-        # 3D poses 추출 (optional)
-        # ----------------------------
-        chunk_3d = None
-        if self.poses_3d is not None:
-            seq_3d = self.poses_3d[seq_i]
-            low_3d  = max(start_3d, 0)
-            high_3d = min(end_3d, seq_3d.shape[0])
-            pad_left_3d  = low_3d - start_3d
-            pad_right_3d = end_3d - high_3d
-
-            if pad_left_3d != 0 or pad_right_3d != 0:
-                chunk_3d = np.pad(
-                    seq_3d[low_3d:high_3d],
-                    ((pad_left_3d, pad_right_3d), (0, 0), (0, 0)),
-                    'edge'
-                )
-            else:
-                chunk_3d = seq_3d[low_3d:high_3d]
+    def get_batch(self, indices):
+        """
+        Gather the chunks of a whole batch with one fancy-index per buffer.
+        Window frames are clamped to their sequence, which is the same as 'edge' padding.
 
-            if flip:
-                chunk_3d[..., 0] *= -1
-                if (self.joints_left is not None) and (self.joints_right is not None):
-                    left = self.joints_left
-                    right = self.joints_right
-                    chunk_3d[..., left + right, :] = chunk_3d[..., right + left, :]
+        Returns (cam, pose_3d, pose_2d) batches of shape (B, 9), (B, T, J, 3) and (B, T, K, 2).
+        """
+        pairs = self.pairs[np.asarray(indices, dtype='int64')]
+        seq = pairs['seq']
+        flip = pairs['flip']
+        
+        # random temporal jitter of every chunk, up to half a stride
+        random_shift = np.random.randint(-self.stride / 2, self.stride / 2, size=len(pairs))
+        frames = (pairs['start'] + random_shift)[:, None] + np.arange(self.chunk_length)
+        frames = np.clip(frames, 0, self.lengths[seq][:, None] - 1)
 
         # ----------------------------
-        # Camera 추출 (optional)
+        # 2D / 3D poses, camera 추출 + flip된 샘플만 좌우 반전
         # ----------------------------
-        cam_param = None
-        if self.cameras is not None:
-            cam_param = self.cameras[seq_i].copy()
-            if flip:
-                # distortion 등 x 관련 파라미터 반전
-                # 원래는 cam[7] *= -1 하던 로직
-                if len(cam_param) > 7:
-                    cam_param[7] *= -1
-
+        chunk_2d = self.buffer_2d[frames + self.starts_2d[seq][:, None]]
+        chunk_3d = None if self.buffer_3d is None else self.buffer_3d[frames + self.starts_3d[seq][:, None]]
+        cam_param = None if self.camera_table is None else self.camera_table[seq]
+        if flip.any():
+            chunk_2d = self.flipper.flip_2d(chunk_2d, flip)
+            if chunk_3d is not None:
+                chunk_3d = self.flipper.flip_3d(chunk_3d, flip)
+            if cam_param is not None:
+                cam_param = self.flipper.flip_camera(cam_param, flip)
 
-        return cam_param, chunk_3d, chunk_2d
\ No newline at end of file
+        return cam_param, chunk_3d, chunk_2d
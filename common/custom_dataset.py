@@ -3,7 +3,8 @@ import copy
 from common.skeleton import Skeleton
 from common.mocap_dataset import MocapDataset
 from common.camera import normalize_screen_coordinates, image_coordinates
-from common.h36m_dataset import h36m_skeleton
+from common.h36m_dataset import h36m_skeleton, h36m_static_joints
+from common.prepared_dataset import is_prepared, load_prepared
        
 
 custom_camera_params = {
@@ -19,11 +20,16 @@ custom_camera_params = {
 
 class CustomDataset(MocapDataset):
     def __init__(self, detections_path, remove_static_joints=True):
-        super().__init__(fps=None, skeleton=h36m_skeleton)        
+        super().__init__(fps=None, skeleton=copy.deepcopy(h36m_skeleton))        
         
-        # Load serialized dataset
-        data = np.load(detections_path, allow_pickle=True)
-        resolutions = data['metadata'].item()['video_metadata']
+        store = load_prepared(detections_path) if is_prepared(detections_path) else None
+        if store is not None:
+            # Normalized keypoints written by prepare_data.py
+            resolutions = store['metadata']['video_metadata']
+        else:
+            # Load serialized dataset
+            data = np.load(detections_path, allow_pickle=True)
+            resolutions = data['metadata'].item()['video_metadata']
         
         self._cameras = {}
         self._data = {}
@@ -46,9 +52,12 @@ class CustomDataset(MocapDataset):
                 }
             }
                 
+        if store is not None:
+            self._load_prepared(detections_path, store)
+                
         if remove_static_joints:
             # Bring the skeleton to 17 joints instead of the original 32
-            self.remove_joints([4, 5, 9, 10, 11, 16, 20, 21, 22, 23, 24, 28, 29, 30, 31])
+            self.remove_joints(h36m_static_joints)
             
             # Rewire shoulders to the correct parents
             self._skeleton._parents[11] = 8
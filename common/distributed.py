@@ -0,0 +1,129 @@
+import os
+import numpy as np
+import torch
+import torch.distributed as dist
+
+
+def available_cpus():
+    """ Logical CPUs this process may run on """
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+def physical_cores(cpus=None):
+    """
+    Logical CPUs (default: available_cpus()) grouped by physical core, as (socket, [cpu ids]) ordered
+    by socket and core id; SMT siblings share a core. Without the sysfs topology every CPU is a core
+    of socket 0.
+    """
+    cores = {}
+    for cpu in available_cpus() if cpus is None else cpus:
+        topology = '/sys/devices/system/cpu/cpu{}/topology/'.format(cpu)
+        try:
+            with open(topology + 'physical_package_id') as f:
+                package = int(f.read())
+            with open(topology + 'core_id') as f:
+                core = int(f.read())
+        except (OSError, ValueError):
+            package, core = 0, cpu
+        cores.setdefault((package, core), []).append(cpu)
+    return [(package, cpus) for (package, _), cpus in sorted(cores.items())]
+
+
+def partition_cores(cores, local_rank, local_world_size):
+    """
+    Physical cores (see physical_cores) of local_rank: whole sockets when there are at least as many
+    sockets as ranks on the node, otherwise contiguous runs of physical cores, which stay within a
+    socket as far as possible.
+    """
+    sockets = sorted({package for package, _ in cores})
+    if local_world_size <= len(sockets):
+        mine = set(np.array_split(sockets, local_world_size)[local_rank].tolist())
+        return [core for core in cores if core[0] in mine]
+    index = np.array_split(np.arange(len(cores)), local_world_size)[local_rank]
+    return [cores[i] for i in index]
+
+
+def reserve_cores(cores, reserve):
+    """
+    Split reserve physical cores (see physical_cores) off the end of the sockets, always from the
+    socket with the most cores left, so that the sockets stay balanced for partition_cores.
+    Returns the remaining and the reserved cores.
+    """
+    sockets = {}
+    for core in cores:
+        sockets.setdefault(core[0], []).append(core)
+    reserved = []
+    for _ in range(reserve):
+        package = max(sorted(sockets), key=lambda p: len(sockets[p]))
+        reserved.append(sockets[package].pop())
+    return [core for core in cores if core not in reserved], sorted(reserved)
+
+
+def pin_cores(cores, threads=0):
+    """ Pin the process to physical cores (with their SMT siblings), one intra-op thread per core or threads """
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, [cpu for _, cpus in cores for cpu in cpus])
+    torch.set_num_threads(threads if threads > 0 else len(cores))
+
+
+def pin_cpu_threads(local_rank, local_world_size, threads=0, reserve=0):
+    """
+    Pin every rank of a node to its own sockets or physical cores (with their SMT siblings, see
+    partition_cores) and use one intra-op thread per physical core, or threads if it is set.
+    reserve physical cores of the node are kept out of the split (see reserve_cores; only if cores
+    remain for every rank), e.g. for the AsyncEvaluator worker.
+
+    Returns the number of intra-op threads and the reserved physical cores.
+    """
+    cores = physical_cores()
+    reserved = []
+    if 0 < reserve and len(cores) - reserve >= local_world_size:
+        cores, reserved = reserve_cores(cores, reserve)
+    if local_world_size > 1 and len(cores) >= local_world_size:
+        cores = partition_cores(cores, local_rank, local_world_size)
+    if local_world_size > 1 or reserved:
+        pin_cores(cores, threads)
+    else:
+        torch.set_num_threads(threads if threads > 0 else len(cores))
+    return torch.get_num_threads(), reserved
+
+
+def setup_distributed(threads=0, reserve=0):
+    """
+    Initialize torch.distributed from the environment set by torchrun (RANK, WORLD_SIZE,
+    LOCAL_RANK, LOCAL_WORLD_SIZE, MASTER_ADDR, MASTER_PORT); without torchrun a process group of
+    one rank is created on an in-process HashStore, so that single-process jobs on a node do not
+    compete for a port. Uses NCCL and one GPU per rank when CUDA is available,
+    otherwise gloo on the CPU, with the intra-op threads of every rank pinned by pin_cpu_threads.
+
+    Arguments:
+    threads -- intra-op threads per rank on the CPU (0: physical cores of the rank)
+    reserve -- physical cores of the first node kept out of the split of its ranks on the CPU, for the
+               asynchronous evaluation worker (-1: an equal share, cores of the node / (ranks of the node + 1))
+
+    Returns the global rank, the number of ranks, the device of this rank and the reserved physical cores.
+    """
+    launched = 'RANK' in os.environ and 'MASTER_ADDR' in os.environ
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', os.environ.get('WORLD_SIZE', 1)))
+
+    if torch.cuda.is_available():
+        torch.cuda.set_device(local_rank)
+        device = torch.device('cuda', local_rank)
+        backend = 'nccl'
+        reserved = []
+    else:
+        device = torch.device('cpu')
+        backend = 'gloo'
+        if int(os.environ.get('GROUP_RANK', 0)) > 0:
+            reserve = 0
+        elif reserve < 0:
+            reserve = len(physical_cores()) // (local_world_size + 1)
+        _, reserved = pin_cpu_threads(local_rank, local_world_size, threads, reserve)
+    if launched:
+        dist.init_process_group(backend)
+    else:
+        dist.init_process_group(backend, store=dist.HashStore(), rank=0, world_size=1)
+    return dist.get_rank(), dist.get_world_size(), device, reserved
@@ -0,0 +1,218 @@
+import os
+import queue
+import traceback
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.multiprocessing as mp
+
+from common.augmentation import FlipTTA
+from common.distributed import pin_cores
+from common.loss import mpjpe, p_mpjpe, mean_velocity_error
+from common.metrics import ActionErrors
+from common.utils import get_root_solver
+
+
+def evaluate_actions(generator, model, root_solver, device, pose_flip=None, zero_root=False, procrustes=False,
+                     absolute=False):
+    """
+    Run model over a PackedGenerator_Seq and return the errors as ActionErrors (mpjpe, mrpe, mpjve,
+    with procrustes p_mpjpe and with absolute abs_mpjpe), every frame counted once; the errors of
+    every window are kept too if the generator is a sample (see stratified_estimate).
+    With a sharded generator every rank only holds its own windows; errors.all_reduce()
+    (called by all ranks) combines them.
+
+    Arguments:
+    root_solver -- maps (predicted 3D pose, 2D keypoints, camera) to (root, mask), see get_root_solver
+    pose_flip -- if given, average the predictions of the original and the flipped input
+    zero_root -- set the predicted root joint to zero before solving for the trajectory
+    absolute -- also compute abs_mpjpe, the error of the pose placed at the solved root against the camera-space pose
+    """
+    names = ['mpjpe', 'mrpe', 'mpjve'] + (['p_mpjpe'] if procrustes else []) + (['abs_mpjpe'] if absolute else [])
+    actions = generator.actions if generator.actions is not None else [''] * len(generator.lengths)
+    errors = ActionErrors(actions, names=names, device=device,
+                          windows=len(generator.sample_seq) if generator.is_sampled() else 0)
+    if pose_flip is not None:
+        ##### apply test-time-augmentation (following Videopose3d)
+        model = FlipTTA(model, pose_flip)
+    with torch.no_grad():
+        start = 0
+        for cam, batch, batch_2d, seq, frames, valid, valid_velocity in generator.next_epoch():
+            window = generator.window_sample[start:start+len(seq)] if generator.is_sampled() else None
+            start += len(seq)
+            inputs_3d = torch.from_numpy(batch).to(device)
+            inputs_2d = torch.from_numpy(batch_2d).to(device)
+            cam = torch.from_numpy(cam).to(device)
+            inputs_traj = inputs_3d[:, :, :1].clone()
+            inputs_3d[:, :, 0] = 0
+
+            predicted_3d_pos = model(inputs_2d)
+            if zero_root:
+                predicted_3d_pos[:, :, 0] = 0
+            pred_root, _ = root_solver(predicted_3d_pos, inputs_2d, cam)
+
+            errors.add('mpjpe', seq, mpjpe(predicted_3d_pos, inputs_3d, return_joints_err=True).mean(-1), valid, window)
+            errors.add('mrpe', seq, mpjpe(pred_root, inputs_traj, return_joints_err=True).mean(-1), valid, window)
+            if absolute:
+                errors.add('abs_mpjpe', seq, mpjpe(predicted_3d_pos + pred_root, inputs_3d + inputs_traj,
+                                                   return_joints_err=True).mean(-1), valid, window)
+
+            # Velocity error of every frame against the previous frame of the same window
+            velocity_error = mean_velocity_error(predicted_3d_pos, inputs_3d, axis=1, return_frames_err=True)
+            errors.add('mpjve', seq, velocity_error, valid_velocity, window)
+
+            if procrustes:
+                errors.add('p_mpjpe', seq, p_mpjpe(predicted_3d_pos, inputs_3d, return_frames_err=True), valid, window)
+
+    return errors
+
+
+def action_mean(errors, name):
+    """ Action-wise average of metric name (every action weighted equally) """
+    actions = errors.action_names()
+    return sum(errors.result(name, k) for k in actions) / len(actions)
+
+
+def stratified_estimate(errors, generator, name='mpjpe', z=1.96):
+    """
+    Frame-weighted mean error over the whole set of generator, estimated from its sampled windows
+    (see PackedGenerator_Seq per_action): the mean error of the sampled windows of every action is
+    weighted by the frames of the action. The confidence interval is z standard errors of the
+    stratified estimate (with finite population correction, so a full pass has no interval).
+
+    Returns the estimate and the half-width of its confidence interval.
+    """
+    if not generator.is_sampled():
+        return errors.result(name), 0.
+    window_errors = errors.window_errors(name)
+    actions = np.array(generator.actions if generator.actions is not None else [''] * len(generator.lengths))
+    window_actions = actions[generator.sample_seq]
+
+    estimate, variance = 0., 0.
+    for action, size in zip(generator.strata, generator.strata_sizes):
+        sample = window_errors[window_actions == action]
+        weight = generator.lengths[actions == action].sum() / generator.num_frames()
+        estimate += weight * sample.mean()
+        if len(sample) > 1:
+            variance += weight ** 2 * sample.var(ddof=1) / len(sample) * (1 - len(sample) / size)
+    return estimate, z * np.sqrt(variance)
+
+
+def epoch_summary(valid_errors, train_errors=None, train_generator=None):
+    """
+    End-of-epoch numbers (m): action-wise MPJPE, MPJVE and MRPE of the test set and, if train_errors
+    is given, the (estimated) MPJPE of the training set with its confidence half-width.
+    """
+    summary = {
+        'valid': action_mean(valid_errors, 'mpjpe'),
+        'valid_velocity': action_mean(valid_errors, 'mpjve'),
+        'valid_root': action_mean(valid_errors, 'mrpe'),
+    }
+    if train_errors is not None:
+        summary['train_eval'], summary['train_eval_ci'] = stratified_estimate(train_errors, train_generator)
+    return summary
+
+
+def _evaluation_worker(jobs, results, model, test_generator, train_generator, pose_flip, root_solver, root_refine,
+                       device, cores, min_loss, min_root):
+    """ Main loop of the AsyncEvaluator process """
+    try:
+        if device.type == 'cpu' and cores:
+            # own cores, not the affinity inherited from the training rank that spawned the worker
+            pin_cores(cores)
+        # the snapshots hold the weights of the DDP model, whose keys start with 'module.'
+        model = nn.DataParallel(model).to(device)
+        model.eval()
+        solver = get_root_solver(root_solver, root_refine)
+        while True:
+            job = jobs.get()
+            if job is None:
+                break
+            path, evaluate_train = job
+            checkpoint = torch.load(path, map_location='cpu')
+            model.load_state_dict(checkpoint['model_pos'], strict=False)
+            train_errors = evaluate_actions(train_generator, model, solver, device) if evaluate_train else None
+            summary = epoch_summary(evaluate_actions(test_generator, model, solver, device, pose_flip),
+                                    train_errors, train_generator)
+
+            # best-checkpoint logic of run.py; the trainer writes them (see AsyncEvaluator)
+            best = []
+            if summary['valid'] * 1000 < min_loss:
+                min_loss = summary['valid'] * 1000
+                best.append('best_epoch.bin')
+            if summary['valid_root'] * 1000 < min_root:
+                min_root = summary['valid_root'] * 1000
+                best.append('best_epochR.bin')
+            os.remove(path)
+            results.put((checkpoint['epoch'], summary, min_loss, best))
+    except Exception:
+        results.put(traceback.format_exc())
+
+
+class AsyncEvaluator:
+    """
+    Scores weight snapshots in a separate process, so that training does not wait for the
+    end-of-epoch evaluation. submit() writes the snapshot to disk and queues it; the worker
+    evaluates the test set (with flip augmentation) and the training set like the synchronous
+    evaluation of run.py and reports the numbers, with the best checkpoints (by MPJPE and by MRPE)
+    the snapshot should be saved as, which poll() collects without blocking. Writing those is left
+    to the caller (run.py uses its CheckpointManager, like the synchronous evaluation).
+
+    Arguments:
+    model -- pose model (not wrapped); a CPU copy is sent to the worker once
+    test_generator and train_generator -- PackedGenerator_Seq of the test set and of the (sampled) training
+                                          set, not sharded
+    pose_flip -- PoseFlip used for test-time flipping of the test set
+    root_solver and root_refine -- root solver name and refinement iterations (see get_root_solver)
+    device -- device of the worker
+    min_loss and min_root -- best MPJPE and MRPE so far (mm)
+    cores -- physical cores of the worker on the CPU, one intra-op thread each (see setup_distributed reserve;
+             empty: the affinity of the spawning process and the torch default threads)
+    """
+    def __init__(self, model, test_generator, train_generator, pose_flip, root_solver, root_refine, device,
+                 min_loss, min_root, cores=()):
+        ctx = mp.get_context('spawn')
+        self.jobs = ctx.Queue()
+        self.results = ctx.Queue()
+        self.pending = 0
+        self.process = ctx.Process(target=_evaluation_worker, daemon=True,
+                                   args=(self.jobs, self.results, model, test_generator, train_generator, pose_flip,
+                                         root_solver, root_refine, device, list(cores), min_loss, min_root))
+        self.process.start()
+
+    def submit(self, path, checkpoint, evaluate_train=True):
+        """
+        Save checkpoint (epoch, lr, wandb_id and the CPU weights 'model_pos') to path and queue it;
+        the training set is only evaluated with evaluate_train.
+        """
+        torch.save(checkpoint, path)
+        self.jobs.put((path, evaluate_train))
+        self.pending += 1
+
+    def poll(self, block=False):
+        """
+        Finished evaluations as (epoch, summary, min_loss, best checkpoint names) tuples, in
+        submission order; with block, waits for all pending ones.
+        """
+        finished = []
+        while self.pending:
+            try:
+                result = self.results.get(timeout=1.) if block else self.results.get_nowait()
+            except queue.Empty:
+                if block and self.process.is_alive():
+                    continue
+                if block:
+                    raise RuntimeError('evaluation worker exited with {} snapshots pending'.format(self.pending))
+                break
+            if isinstance(result, str):
+                raise RuntimeError('evaluation worker failed:\n' + result)
+            finished.append(result)
+            self.pending -= 1
+        return finished
+
+    def close(self):
+        """ Wait for the pending evaluations, stop the worker and return the remaining results """
+        finished = self.poll(block=True)
+        self.jobs.put(None)
+        self.process.join()
+        return finished
@@ -8,6 +8,10 @@
 from itertools import zip_longest
 import numpy as np
 
+from common.augmentation import PoseFlip
+from common.prepared_dataset import flatten_sequences, MappedArray
+from common.windows import window_index
+
      
 class ChunkedGenerator_Seq:
     """
@@ -74,6 +78,8 @@ class ChunkedGenerator_Seq:
         self.kps_right = kps_right
         self.joints_left = joints_left
         self.joints_right = joints_right
+        self.flipper = PoseFlip(kps_left, kps_right, joints_left, joints_right, num_keypoints=poses_2d[0].shape[-2],
+                                num_joints=None if poses_3d is None else poses_3d[0].shape[-2])
         
     def num_frames(self):
         return self.num_batches * self.batch_size
@@ -120,11 +126,6 @@ class ChunkedGenerator_Seq:
                     else:
                         self.batch_2d[i] = seq_2d[low_2d:high_2d]
 
-                    if flip:
-                        # Flip 2D keypoints
-                        self.batch_2d[i, :, :, 0] *= -1
-                        self.batch_2d[i, :, self.kps_left + self.kps_right] = self.batch_2d[i, :, self.kps_right + self.kps_left]
-
                     # 3D poses
                     if self.poses_3d is not None:
                         seq_3d = self.poses_3d[seq_i]
@@ -137,19 +138,20 @@ class ChunkedGenerator_Seq:
                         else:
                             self.batch_3d[i] = seq_3d[low_3d:high_3d]
 
-                        if flip:
-                            # Flip 3D joints
-                            self.batch_3d[i, :, :, 0] *= -1
-                            self.batch_3d[i, :, self.joints_left + self.joints_right] = \
-                                    self.batch_3d[i, :, self.joints_right + self.joints_left]
-
                     # Cameras
                     if self.cameras is not None:
                         self.batch_cam[i] = self.cameras[seq_i]
-                        if flip:
-                            # Flip horizontal distortion coefficients
-                            # self.batch_cam[i, 2] *= -1
-                            self.batch_cam[i, 7] *= -1
+
+                # Flip the augmented chunks of the whole batch at once
+                flip = np.array([chunk[3] for chunk in chunks], dtype=bool)
+                if flip.any():
+                    n = len(chunks)
+                    self.batch_2d[:n] = self.flipper.flip_2d(self.batch_2d[:n], flip)
+                    if self.poses_3d is not None:
+                        self.batch_3d[:n] = self.flipper.flip_3d(self.batch_3d[:n], flip)
+                    if self.cameras is not None:
+                        # Flip horizontal distortion coefficients
+                        self.batch_cam[:n] = self.flipper.flip_camera(self.batch_cam[:n], flip)
 
                 if self.endless:
                     self.state = (b_i + 1, pairs)
@@ -197,6 +199,8 @@ class UnchunkedGenerator_Seq:
         self.kps_right = kps_right
         self.joints_left = joints_left
         self.joints_right = joints_right
+        self.flipper = PoseFlip(kps_left, kps_right, joints_left, joints_right, num_keypoints=poses_2d[0].shape[-2],
+                                num_joints=None if poses_3d is None or poses_3d[0] is None else poses_3d[0].shape[-2])
         
         self.pad = pad
         self.causal_shift = causal_shift
@@ -229,18 +233,12 @@ class UnchunkedGenerator_Seq:
             if self.augment:
                 # Append flipped version
                 if batch_cam is not None:
-                    batch_cam = np.concatenate((batch_cam, batch_cam), axis=0)
-                    # batch_cam[1, 2] *= -1
-                    batch_cam[1, 7] *= -1
+                    batch_cam = np.concatenate((batch_cam, self.flipper.flip_camera(batch_cam)), axis=0)
                 
                 if batch_3d is not None:
-                    batch_3d = np.concatenate((batch_3d, batch_3d), axis=0)
-                    batch_3d[1, :, :, 0] *= -1
-                    batch_3d[1, :, self.joints_left + self.joints_right] = batch_3d[1, :, self.joints_right + self.joints_left]
+                    batch_3d = np.concatenate((batch_3d, self.flipper.flip_3d(batch_3d)), axis=0)
 
-                batch_2d = np.concatenate((batch_2d, batch_2d), axis=0)
-                batch_2d[1, :, :, 0] *= -1
-                batch_2d[1, :, self.kps_left + self.kps_right] = batch_2d[1, :, self.kps_right + self.kps_left]
+                batch_2d = np.concatenate((batch_2d, self.flipper.flip_2d(batch_2d)), axis=0)
             # print(batch_2d.shape)
             yield batch_cam, batch_3d, batch_2d, seq_act
 
@@ -273,6 +271,8 @@ class UnchunkedGenerator_Seq2Seq:
         self.kps_right = kps_right
         self.joints_left = joints_left
         self.joints_right = joints_right
+        self.flipper = PoseFlip(kps_left, kps_right, joints_left, joints_right, num_keypoints=poses_2d[0].shape[-2],
+                                num_joints=None if poses_3d is None or poses_3d[0] is None else poses_3d[0].shape[-2])
         
         self.pad = pad
         self.causal_shift = causal_shift
@@ -304,17 +304,139 @@ class UnchunkedGenerator_Seq2Seq:
             if self.augment:
                 # Append flipped version
                 if batch_cam is not None:
-                    batch_cam = np.concatenate((batch_cam, batch_cam), axis=0)
-                    # batch_cam[1, 2] *= -1
-                    batch_cam[1, 7] *= -1
+                    batch_cam = np.concatenate((batch_cam, self.flipper.flip_camera(batch_cam)), axis=0)
                 
                 if batch_3d is not None:
-                    batch_3d = np.concatenate((batch_3d, batch_3d), axis=0)
-                    batch_3d[1, :, :, 0] *= -1
-                    batch_3d[1, :, self.joints_left + self.joints_right] = batch_3d[1, :, self.joints_right + self.joints_left]
+                    batch_3d = np.concatenate((batch_3d, self.flipper.flip_3d(batch_3d)), axis=0)
 
-                batch_2d = np.concatenate((batch_2d, batch_2d), axis=0)
-                batch_2d[1, :, :, 0] *= -1
-                batch_2d[1, :, self.kps_left + self.kps_right] = batch_2d[1, :, self.kps_right + self.kps_left]
+                batch_2d = np.concatenate((batch_2d, self.flipper.flip_2d(batch_2d)), axis=0)
 
             yield batch_cam, batch_3d, batch_2d
+
+
+def first_occurrence(keys):
+    """ Boolean mask of the entries of keys (in C order) whose value did not occur before """
+    mask = np.zeros(keys.size, dtype=bool)
+    mask[np.unique(keys.reshape(-1), return_index=True)[1]] = True
+    return mask.reshape(keys.shape)
+
+
+class PackedGenerator_Seq:
+    """
+    Batched data generator, used for testing.
+    Every sequence is split into windows of receptive_field frames (see common.windows) and the
+    windows of all sequences are packed into batches of batch_size windows, so that short and
+    long sequences share batches of the same size.
+
+    Every batch also yields the sequence id (B,) and the frame index (B, receptive_field) of its
+    windows, which map each output frame back to (sequence, frame); actions[sequence] is the
+    action of the sequence. The valid mask (B, receptive_field) marks the first occurrence of every
+    frame among the windows (of all ranks), so that frames repeated by the aligned last window or by
+    the clamped edges of short sequences count once; valid_velocity (B, receptive_field - 1) does the
+    same for the pairs of consecutive frames within a window. Test-time flipping is left to the caller
+    (see PoseFlip).
+
+    Arguments:
+    batch_size -- number of windows per batch (the last batch may be smaller)
+    cameras -- list of cameras, one element for each video (optional)
+    poses_3d -- list of ground-truth 3D poses, one element for each video (optional)
+    poses_2d -- list of input 2D keypoints, one element for each video
+    receptive_field -- number of frames per window
+    actions -- list of action names, one element for each video (optional)
+    stride -- distance between consecutive windows (defaults to receptive_field, i.e. no overlap)
+    per_action -- if > 0, only keep a random sample of per_action windows of every action (all windows
+                  of actions with fewer); the sample is fixed by random_seed and kept as
+                  sample_seq/sample_frames, strata_sizes holds the windows of every action in the whole set
+    random_seed -- seed of the sample
+    rank and num_replicas -- only yield the rank-th of num_replicas contiguous shards of the windows
+                             (distributed evaluation; the shards of all ranks cover every window once)
+    """
+
+    def __init__(self, batch_size, cameras, poses_3d, poses_2d, receptive_field, actions=None, stride=None,
+                 per_action=0, random_seed=1234, rank=0, num_replicas=1):
+        assert poses_3d is None or len(poses_3d) == len(poses_2d)
+        assert cameras is None or len(cameras) == len(poses_2d)
+        assert actions is None or len(actions) == len(poses_2d)
+
+        self.batch_size = batch_size
+        self.receptive_field = receptive_field
+        self.lengths = np.array([p.shape[0] for p in poses_2d], dtype='int64')
+        self.offsets = np.concatenate(([0], np.cumsum(self.lengths)[:-1]))
+        self.actions = actions
+
+        # sequences of a prepared store are used in place (see flatten_sequences), batches are cast to float32
+        self.buffer_2d, self.starts_2d = flatten_sequences(poses_2d)
+        self.buffer_3d, self.starts_3d = (None, None) if poses_3d is None else flatten_sequences(poses_3d)
+        self.cameras = None if cameras is None else np.stack(cameras).astype('float32')
+
+        windows = [window_index(n, receptive_field, stride) for n in self.lengths]
+        self.window_seq = np.repeat(np.arange(len(windows)), [w.shape[0] for w in windows])
+        self.window_frames = np.concatenate(windows)
+
+        # stratified sample, the same on every rank
+        window_actions = np.array(actions if actions is not None else [''] * len(windows))[self.window_seq]
+        strata, self.strata_sizes = np.unique(window_actions, return_counts=True)
+        self.strata = list(strata)
+        if per_action > 0:
+            random = np.random.RandomState(random_seed)
+            keep = [random.choice(np.flatnonzero(window_actions == a), min(per_action, n), replace=False)
+                    for a, n in zip(strata, self.strata_sizes)]
+            keep = np.sort(np.concatenate(keep))
+            self.window_seq = self.window_seq[keep]
+            self.window_frames = self.window_frames[keep]
+        self.sample_seq = self.window_seq
+        self.sample_frames = self.window_frames
+
+        # first occurrence of every frame, and of every pair of consecutive frames, among the (sampled) windows
+        rows = self.window_frames + self.offsets[self.window_seq, None]
+        self.window_valid = first_occurrence(rows)
+        pairs = np.where(rows[:, 1:] != rows[:, :-1], rows[:, 1:], -1)
+        self.window_valid_velocity = first_occurrence(pairs) & (pairs >= 0)
+
+        # position of every window in the sample (see sample_seq)
+        self.window_sample = np.arange(len(self.window_seq))
+        if num_replicas > 1:
+            shard = np.array_split(self.window_sample, num_replicas)[rank]
+            self.window_seq = self.window_seq[shard]
+            self.window_frames = self.window_frames[shard]
+            self.window_valid = self.window_valid[shard]
+            self.window_valid_velocity = self.window_valid_velocity[shard]
+            self.window_sample = self.window_sample[shard]
+
+    def __getstate__(self):
+        # memory-mapped store buffers are mapped again by the receiving process (e.g. AsyncEvaluator)
+        state = self.__dict__.copy()
+        for name in ('buffer_2d', 'buffer_3d'):
+            if MappedArray.wraps(state[name]):
+                state[name] = MappedArray(state[name])
+        return state
+
+    def __setstate__(self, state):
+        for name in ('buffer_2d', 'buffer_3d'):
+            if isinstance(state[name], MappedArray):
+                state[name] = state[name].open()
+        self.__dict__.update(state)
+
+    def num_frames(self):
+        return int(self.lengths.sum())
+
+    def num_windows(self):
+        return self.window_frames.shape[0]
+
+    def is_sampled(self):
+        """ True if only a sample of the windows is kept (see per_action) """
+        return len(self.sample_seq) < self.strata_sizes.sum()
+
+    def augment_enabled(self):
+        return False
+
+    def next_epoch(self):
+        for start in range(0, self.num_windows(), self.batch_size):
+            seq = self.window_seq[start:start+self.batch_size]
+            frames = self.window_frames[start:start+self.batch_size]
+            batch_cam = None if self.cameras is None else self.cameras[seq]
+            batch_3d = None if self.buffer_3d is None else \
+                self.buffer_3d[frames + self.starts_3d[seq, None]].astype('float32', copy=False)
+            batch_2d = self.buffer_2d[frames + self.starts_2d[seq, None]].astype('float32', copy=False)
+            yield batch_cam, batch_3d, batch_2d, seq, frames, self.window_valid[start:start+self.batch_size], \
+                self.window_valid_velocity[start:start+self.batch_size]
@@ -3,12 +3,26 @@ import copy
 from common.skeleton import Skeleton
 from common.mocap_dataset import MocapDataset
 from common.camera import normalize_screen_coordinates, image_coordinates
+from common.prepared_dataset import is_prepared
 
 h36m_skeleton = Skeleton(parents=[-1,  0,  1,  2,  3,  4,  0,  6,  7,  8,  9,  0, 11, 12, 13, 14, 12,
        16, 17, 18, 19, 20, 19, 22, 12, 24, 25, 26, 27, 28, 27, 30],
        joints_left=[6, 7, 8, 9, 10, 16, 17, 18, 19, 20, 21, 22, 23],
        joints_right=[1, 2, 3, 4, 5, 24, 25, 26, 27, 28, 29, 30, 31])
 
+# Joints that Human36mDataset removes by default, leaving the usual 17
+h36m_static_joints = [4, 5, 9, 10, 11, 16, 20, 21, 22, 23, 24, 28, 29, 30, 31]
+
+
+def h36m_skeleton_17():
+    """ Copy of the Human3.6M skeleton without the static joints, as used by Human36mDataset """
+    skeleton = copy.deepcopy(h36m_skeleton)
+    skeleton.remove_joints(h36m_static_joints)
+    # Rewire shoulders to the correct parents
+    skeleton._parents[11] = 8
+    skeleton._parents[14] = 8
+    return skeleton
+
 h36m_cameras_intrinsic_params = [
     {
         'id': '54138969',
@@ -201,7 +215,7 @@ h36m_cameras_extrinsic_params = {
 
 class Human36mDataset(MocapDataset):
     def __init__(self, path, remove_static_joints=True):
-        super().__init__(fps=50, skeleton=h36m_skeleton)
+        super().__init__(fps=50, skeleton=copy.deepcopy(h36m_skeleton))
         
         self._cameras = copy.deepcopy(h36m_cameras_extrinsic_params)
         for cameras in self._cameras.values():
@@ -223,20 +237,24 @@ class Human36mDataset(MocapDataset):
                                                    cam['radial_distortion'],
                                                    cam['tangential_distortion']))
         
-        # Load serialized dataset
-        data = np.load(path, allow_pickle=True)['positions_3d'].item()
-        
-        self._data = {}
-        for subject, actions in data.items():
-            self._data[subject] = {}
-            for action_name, positions in actions.items():
-                self._data[subject][action_name] = {
-                    'positions': positions,
-                    'cameras': self._cameras[subject],
-                }
+        if is_prepared(path):
+            # Camera-space poses and normalized keypoints written by prepare_data.py
+            self._load_prepared(path)
+        else:
+            # Load serialized dataset
+            data = np.load(path, allow_pickle=True)['positions_3d'].item()
+            
+            self._data = {}
+            for subject, actions in data.items():
+                self._data[subject] = {}
+                for action_name, positions in actions.items():
+                    self._data[subject][action_name] = {
+                        'positions': positions,
+                        'cameras': self._cameras[subject],
+                    }
                 
         if remove_static_joints:
-            self.remove_joints([4, 5, 9, 10, 11, 16, 20, 21, 22, 23, 24, 28, 29, 30, 31])
+            self.remove_joints(h36m_static_joints)
 
             self._skeleton._parents[11] = 8
             self._skeleton._parents[14] = 8
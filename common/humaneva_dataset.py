@@ -3,6 +3,7 @@ import copy
 from common.skeleton import Skeleton
 from common.mocap_dataset import MocapDataset
 from common.camera import normalize_screen_coordinates, image_coordinates
+from common.prepared_dataset import is_prepared
        
 humaneva_skeleton = Skeleton(parents=[-1, 0, 1, 2, 3, 1, 5, 6, 0, 8, 9, 0, 11, 12, 1],
        joints_left=[2, 3, 4, 8, 9, 10],
@@ -100,15 +101,19 @@ class HumanEvaDataset(MocapDataset):
             for prefix in ['Train/', 'Validate/', 'Unlabeled/Train/', 'Unlabeled/Validate/', 'Unlabeled/']:
                 self._cameras[prefix + subject] = data
         
-        # Load serialized dataset
-        data = np.load(path, allow_pickle=True)['positions_3d'].item()
-        
-        self._data = {}
-        for subject, actions in data.items():
-            self._data[subject] = {}
-            for action_name, positions in actions.items():
-                self._data[subject][action_name] = {
-                    'positions': positions,
-                    'cameras': self._cameras[subject],
-                }
+        if is_prepared(path):
+            # Camera-space poses and normalized keypoints written by prepare_data.py
+            self._load_prepared(path)
+        else:
+            # Load serialized dataset
+            data = np.load(path, allow_pickle=True)['positions_3d'].item()
+            
+            self._data = {}
+            for subject, actions in data.items():
+                self._data[subject] = {}
+                for action_name, positions in actions.items():
+                    self._data[subject][action_name] = {
+                        'positions': positions,
+                        'cameras': self._cameras[subject],
+                    }
    
\ No newline at end of file
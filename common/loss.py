@@ -1,7 +1,9 @@
-from matplotlib.pyplot import bone
+import math
 import torch
 import numpy as np
 
+from common.bones import H36M_BONES, H36M_TPOSE
+
 def mpjpe(predicted, target, return_joints_err=False):
     """
     Mean per-joint position error (i.e. mean Euclidean distance),
@@ -22,81 +24,50 @@ def weighted_mpjpe(predicted, target, w):
     # assert w.shape[0] == predicted.shape[0]
     return torch.mean(w * torch.norm(predicted - target, dim=len(target.shape)-1))
 
-def get_limb_lens(x):
+def get_limb_lens(x, bones=H36M_BONES):
     '''
         Input: (N, T, 17, 3)
         Output: (N, T, 16)
     '''
-    limbs_id = [[0,1], [1,2], [2,3],
-         [0,4], [4,5], [5,6],
-         [0,7], [7,8], [8,9], [9,10],
-         [8,11], [11,12], [12,13],
-         [8,14], [14,15], [15,16]
-        ]
-    limbs = x[:,:,limbs_id,:]
-    limbs = limbs[:,:,:,0,:]-limbs[:,:,:,1,:]
-    limb_lens = torch.norm(limbs, dim=-1)
-    return limb_lens
-
-def change_bone_length(p3d, bone_length):
-    joints = p3d + 0
-    index = [[0,1],[1,2],[2,3],[0,4],[4,5],[5,6],[0,7],[7,8],[8,9],[9,10],[8,11],[11,12],[12,13],[8,14], [14,15],[15,16]]
-    bone = []
-    conf = []
-    for i in index:
-        conf.append(torch.max(torch.linalg.norm(joints[:, :, i[1]] - joints[:, :, i[0]], axis=-1, keepdims=True), torch.tensor([1e-6]).cuda()))
-        bone.append((joints[:, :, i[1]] - joints[:, :, i[0]]) / conf[-1])
-    
-    for i in range(len(index)):
-        joints[:, :, index[i][1]] = joints[:, :, index[i][0]] + bone[i] * bone_length[:, :, i, None]
-    conf = torch.nn.Sigmoid()(torch.stack(conf, axis=-1).permute(0, 1, 3, 2))
-    conf = torch.cat([torch.ones_like(conf[:, :, :1]), conf], dim=-2)
-    return joints, conf
-
-def get_bone_length(p3d):
-    index = [[0,1],[1,2],[2,3],[0,4],[4,5],[5,6],[0,7],[7,8],[8,9],[9,10],[8,11],[11,12],[12,13],[8,14],[14,15],[15,16]]
-    bone = []
-    for i in index:
-        bone.append(torch.linalg.norm(p3d[:, :, i[1]] - p3d[:, :, i[0]], axis=-1))
-    bone = torch.stack(bone, axis=-1)
-    return bone
-
-def tmpjpe(predicted, target):
-    p_bone = get_bone_length(predicted)
-    t_bone = get_bone_length(target)    
-    tpose = torch.tensor([[[0.,0.,0],[1,0,0],[1,-1,0],[1,-2,0],[-1,0,0],[-1,-1,0],[-1,-2,0],[0,1,0],[0,2,0],[0,3,0],[0,4,0],[-1,2,0],[-2,2,0],[-3,2,0],[1,2,0],[2,2,0],[3,2,0]]]).squeeze(0).to(predicted.device)
-    tpose = tpose.repeat(predicted.shape[0], predicted.shape[1],1, 1)
+    return bones.lengths(x)
 
+def change_bone_length(p3d, bone_length, bones=H36M_BONES):
+    """
+    Re-target p3d (B, T, J, 3) to the bone lengths bone_length (B, T, K), keeping the bone
+    directions and the root. Also returns the sigmoid of the original bone lengths at every
+    child joint (1 at the root), (B, T, J, 1).
+    """
+    joints, lengths = bones.retarget(p3d, bone_length)
+    conf = bones.to_joints(torch.sigmoid(lengths), fill=1.)
+    return joints, conf
 
-    pred, conf = change_bone_length(tpose, p_bone)
+def get_bone_length(p3d, bones=H36M_BONES):
+    return bones.lengths(p3d)
 
-    targ, conf = change_bone_length(tpose, t_bone)
+def tmpjpe(predicted, target, bones=H36M_BONES, template=H36M_TPOSE):
+    """
+    MPJPE between a template pose (T-pose of the H36M skeleton by default) re-targeted to the
+    predicted and to the target bone lengths, i.e. an error on the bone lengths only.
+    """
+    template = torch.as_tensor(template, dtype=predicted.dtype, device=predicted.device)
+    pred, _ = bones.retarget(template, get_bone_length(predicted, bones))
+    targ, _ = bones.retarget(template, get_bone_length(target, bones))
     return mpjpe(pred, targ)
 
-
-
-def smpjpe(predicted, target):
+def smpjpe(predicted, target, bones=H36M_BONES):
     """
-    Weighted subject independent mean per-joint position error (i.e. mean Euclidean distance)
+    Weighted subject independent mean per-joint position error (i.e. mean Euclidean distance):
+    the prediction is re-targeted to the bone lengths of the first target frame.
     """
     assert predicted.shape == target.shape
     # assert w.shape[0] == predicted.shape[0]
-    index = [[0,1],[1,2],[2,3],[0,4],[4,5],[5,6],[0,7],[7,8],[8,9],[9,10],[8,11],[11,12],[12,13],[8,14], [14,15],[15,16]]
-
-    bone_length = []
-    for i in index:
-        bone_length.append(torch.linalg.norm(target[:,0,i[1]] - target[:,0,i[0]], axis=-1))
-    bone_length = torch.stack(bone_length, dim=-1)
-
-    bone = []
-    for i in index:
-        bone.append((predicted[:,:,i[1]] - predicted[:,:,i[0]]) / torch.linalg.norm(predicted[:,:,i[1]] - predicted[:,:,i[0]], axis=-1, keepdims=True))
-    
-    for i in range(len(index)):
-        predicted[:, :, index[i][1]] = predicted[:, :, index[i][0]] + bone[i] * bone_length[:, None, i, None]
-
+    predicted, _ = bones.retarget(predicted, get_bone_length(target[:, :1], bones), epsilon=0)
     return mpjpe(predicted, target)
 
+def normal_cdf(x, mean=0.0, std=1.0):
+    """ CDF of the normal distribution N(mean, std^2) at x (broadcast) """
+    return 0.5 * (1 + torch.erf((x - mean) / (std * math.sqrt(2.0))))
+
 def integrate_normal_pdf(a, b, mean=0.0, std=1.0):
     """
     정규분포의 주어진 구간 [a, b]에서의 적분 값을 계산합니다.
@@ -110,25 +81,65 @@ def integrate_normal_pdf(a, b, mean=0.0, std=1.0):
     반환값:
     float: 정규분포의 [a, b] 구간에서의 적분 값
     """
-    # 정규분포의 CDF (누적 분포 함수)
-    def normal_cdf(x, mean, std):
-        return 0.5 * (1 + torch.erf((x - mean) / (std * torch.sqrt(torch.tensor(2.0)))))
-
     return normal_cdf(b, mean, std) - normal_cdf(a, mean, std)
 
+_bin_edges = {}
+
+def get_bin_edges(bins_num, low, high, device, dtype=torch.float32):
+    """
+    Edges (bins_num + 1,) of bins_num bins centered on torch.linspace(low, high, bins_num),
+    cached per (bins, range, device, dtype), and the bin width.
+    """
+    key = (bins_num, low, high, torch.device(device), dtype)
+    if key not in _bin_edges:
+        bins = torch.linspace(low, high, bins_num, device=device, dtype=dtype)
+        term = (bins[1] - bins[0]) / 2
+        _bin_edges[key] = torch.cat((bins - term, bins[-1:] + term))
+    return _bin_edges[key], (high - low) / (bins_num - 1)
+
+def binned_normal(target, edges, width, std, num_std=6.0):
+    """
+    Probability mass of N(target, std^2) in every bin, evaluated with one broadcast erf over
+    the bin edges. Only the bins within num_std standard deviations of the target are kept
+    (the mass outside is below 1e-8), so the full (..., bins) distribution is never built.
+
+    Arguments:
+    target -- means (...)
+    edges and width -- bin edges (bins + 1,) and bin width, see get_bin_edges
+    std -- standard deviation
+
+    Returns the bin indices (..., W) and their probabilities (..., W).
+    """
+    bins_num = edges.shape[0] - 1
+    window = min(bins_num, 2 * math.ceil(num_std * std / width) + 2)
+    first = torch.floor((target - edges[0]) / width).long() - window // 2 + 1
+    index = first.clamp(0, bins_num - window).unsqueeze(-1) + torch.arange(window + 1, device=edges.device)
+    cdf = normal_cdf(edges[index], target.unsqueeze(-1), std)
+    return index[..., :-1], cdf[..., 1:] - cdf[..., :-1]
+
+def binned_cross_entropy(predicted, target, edges, width, std, normalize=False, weight=None):
+    """
+    -mean(target_dist * log(predicted) * weight) with target_dist the binned N(target, std^2)
+    (normalized over the bin range with normalize). log(predicted) is only taken at the bins of
+    binned_normal.
+    """
+    index, probs = binned_normal(target, edges, width, std)
+    if normalize:
+        total = normal_cdf(edges[-1], target, std) - normal_cdf(edges[0], target, std)
+        probs = probs / total.unsqueeze(-1)
+    terms = probs * torch.log(torch.gather(predicted, -1, index))
+    if weight is not None:
+        terms = terms * weight
+    return -terms.sum() / predicted.numel()
+
 def cross_entropy_loss(predicted, target, sigma=1.0):
     """
     Cross entropy loss
     """
 
     bins_num = predicted.shape[-1]
-    bins = torch.linspace(-1, 1, bins_num).to(predicted.device)
-    term = (bins[1] - bins[0]) / 2
-    sigma = term * sigma
-    target_dist = torch.zeros_like(predicted)
-    for i, j in enumerate(bins):
-        target_dist[..., i] = integrate_normal_pdf(j - term, j + term, mean=target, std=sigma)
-    
+    edges, width = get_bin_edges(bins_num, -1, 1, predicted.device)
+    sigma = width / 2 * sigma
 
     # import matplotlib.pyplot as plt
     # distributions = target_dist[:,:,:,2].detach().cpu()
@@ -145,7 +156,7 @@ def cross_entropy_loss(predicted, target, sigma=1.0):
     # plt.title(f'Distribution for sample {0}, frame {0}, joint {13}')
     # plt.show()
 
-    return -torch.mean(target_dist * torch.log(predicted))
+    return binned_cross_entropy(predicted, target, edges, width, sigma)
 
 def weighted_cross(predicted, p3d,target, sigma=0.1, w=None):
     """
@@ -153,14 +164,8 @@ def weighted_cross(predicted, p3d,target, sigma=0.1, w=None):
     """
 
     bins_num = predicted.shape[-1]
-    bins = torch.linspace(-1.2, 1.2, bins_num).to(predicted.device)
-    term = (bins[1] - bins[0]) / 2
-    sigma = term * sigma
-    target_dist = torch.zeros_like(predicted)
-    for i, j in enumerate(bins):
-        target_dist[..., i] = integrate_normal_pdf(j - term, j + term, mean= target, std=sigma)
-    
-    target_dist = target_dist / torch.sum(target_dist, dim=-1, keepdim=True)
+    edges, width = get_bin_edges(bins_num, -1.2, 1.2, predicted.device)
+    sigma = width / 2 * sigma
 
     # import matplotlib.pyplot as plt
     # distributions = target_dist[:,:,:,2].detach().cpu()
@@ -176,7 +181,7 @@ def weighted_cross(predicted, p3d,target, sigma=0.1, w=None):
     # plt.title(f'Distribution for sample {0}, frame {0}, joint {13}, gt: {target[0,0,13,2] * 1000}, mean: {mean * 1000}')
     # plt.show()
 
-    cross_entropy_loss = -torch.mean(target_dist * torch.log(predicted) * w.reshape(1,1,-1,1,1)) 
+    cross_entropy_loss = binned_cross_entropy(predicted, target, edges, width, sigma, normalize=True, weight=w.reshape(1,1,-1,1,1))
     mse_loss = torch.mean(torch.norm(p3d - target, dim= -1) * w.reshape(1,1,-1))
 
     loss = cross_entropy_loss + mse_loss * 0
@@ -188,26 +193,21 @@ def show_distribution(predicted, target, sigma=0.01):
     """
 
     bins_num = predicted.shape[-1]
-    bins = torch.linspace(-1.2, 1.2, bins_num).to(predicted.device)
-    term = (bins[1] - bins[0]) / 2
+    bins = torch.linspace(-1.2, 1.2, bins_num)
+    edges, _ = get_bin_edges(bins_num, -1.2, 1.2, 'cpu')
     # sigma = term * sigma
-    target_dist = torch.zeros_like(predicted)
-    for i, j in enumerate(bins):
-        target_dist[..., i] = integrate_normal_pdf(j - term, j + term, mean= target, std=sigma)
-    
-    target_dist = target_dist / torch.sum(target_dist, dim=-1, keepdim=True)
+    cdf = normal_cdf(edges, target[0, 0, 13, 2].detach().cpu(), sigma)
+    distribution = (cdf[1:] - cdf[:-1]) / (cdf[-1] - cdf[0])
 
     import matplotlib.pyplot as plt
-    distributions = target_dist[:,:,:,2].detach().cpu()
     dis = predicted[:,:,:,2].detach().cpu()
 
     plt.figure()
-    distribution = distributions[0, 0, 13].numpy()
     # plt.plot(np.linspace(-1.2, 1.2, bins_num), distribution, color='b', label='gt')
     plt.plot(np.linspace(-1.2, 1.2, bins_num), dis[0,0,13].numpy(), color='g', label='pred')
     plt.axvline(x=target[0,0,13,2].cpu(), color='b', linestyle='--')
-    mean = torch.sum(bins.cpu() * distribution)
-    predicted_mean = torch.sum(bins.cpu() * dis[0,0,13])
+    mean = torch.sum(bins * distribution)
+    predicted_mean = torch.sum(bins * dis[0,0,13])
     plt.axvline(x=predicted_mean, color='g', linestyle='--')
     plt.xlabel('Bins')
     plt.ylabel('Probability')
@@ -215,8 +215,17 @@ def show_distribution(predicted, target, sigma=0.01):
     plt.show()
 
 
-def p_mpjpe(predicted, target):
+def p_mpjpe(predicted, target, return_frames_err=False):
+    """
+    Pose error: MPJPE after rigid alignment (scale, rotation, and translation),
+    often referred to as "Protocol #2" in many papers.
+    With return_frames_err, the error of every frame is returned instead of the mean.
+    Torch tensors (..., J, 3) are aligned in batch on their device (see p_mpjpe_torch),
+    NumPy arrays are (N, J, 3).
+    """
     assert predicted.shape == target.shape
+    if torch.is_tensor(predicted):
+        return p_mpjpe_torch(predicted, target, return_frames_err)
 
     muX = np.mean(target, axis=1, keepdims=True)
     muY = np.mean(predicted, axis=1, keepdims=True)
@@ -250,18 +259,64 @@ def p_mpjpe(predicted, target):
     predicted_aligned = a * np.matmul(predicted, R) + t
 
     # Return MPJPE
-    return np.mean(np.linalg.norm(predicted_aligned - target, axis=len(target.shape) - 1))
+    errors = np.linalg.norm(predicted_aligned - target, axis=len(target.shape) - 1)
+    if return_frames_err:
+        return np.mean(errors, axis=-1)
+    return np.mean(errors)
     
-def n_mpjpe(predicted, target):
+def p_mpjpe_torch(predicted, target, return_frames_err=False):
+    """
+    Batched torch version of p_mpjpe for poses (..., J, 3): the similarity transform of every
+    frame comes from one batched 3x3 SVD, with the same reflection correction.
+    """
+    muX = torch.mean(target, dim=-2, keepdim=True)
+    muY = torch.mean(predicted, dim=-2, keepdim=True)
+
+    X0 = target - muX
+    Y0 = predicted - muY
+
+    normX = torch.sqrt(torch.sum(X0 ** 2, dim=(-2, -1), keepdim=True))
+    normY = torch.sqrt(torch.sum(Y0 ** 2, dim=(-2, -1), keepdim=True))
+
+    X0 = X0 / normX
+    Y0 = Y0 / normY
+
+    H = torch.matmul(X0.transpose(-2, -1), Y0)
+    U, s, Vt = torch.linalg.svd(H)
+    V = Vt.transpose(-2, -1)
+
+    # Avoid improper rotations (reflections), i.e. rotations with det(R) = -1
+    sign_detR = torch.sign(torch.linalg.det(torch.matmul(V, U.transpose(-2, -1))))
+    V = torch.cat((V[..., :-1], V[..., -1:] * sign_detR[..., None, None]), dim=-1)
+    s = torch.cat((s[..., :-1], s[..., -1:] * sign_detR[..., None]), dim=-1)
+    R = torch.matmul(V, U.transpose(-2, -1))  # Rotation
+
+    tr = torch.sum(s, dim=-1)[..., None, None]
+
+    a = tr * normX / normY  # Scale
+    t = muX - a * torch.matmul(muY, R)  # Translation
+
+    # Perform rigid transformation on the input
+    predicted_aligned = a * torch.matmul(predicted, R) + t
+
+    errors = torch.norm(predicted_aligned - target, dim=-1).mean(dim=-1)
+    if return_frames_err:
+        return errors
+    return torch.mean(errors)
+
+def n_mpjpe(predicted, target, return_frames_err=False):
     """
     Normalized MPJPE (scale only), adapted from:
     https://github.com/hrhodin/UnsupervisedGeometryAwareRepresentationLearning/blob/master/losses/poses.py
+    With return_frames_err, the error of every frame is returned instead of the mean.
     """
     assert predicted.shape == target.shape
     
-    norm_predicted = torch.mean(torch.sum(predicted**2, dim=3, keepdim=True), dim=2, keepdim=True)
-    norm_target = torch.mean(torch.sum(target*predicted, dim=3, keepdim=True), dim=2, keepdim=True)
+    norm_predicted = torch.mean(torch.sum(predicted**2, dim=-1, keepdim=True), dim=-2, keepdim=True)
+    norm_target = torch.mean(torch.sum(target*predicted, dim=-1, keepdim=True), dim=-2, keepdim=True)
     scale = norm_target / norm_predicted
+    if return_frames_err:
+        return mpjpe(scale * predicted, target, return_joints_err=True).mean(dim=-1)
     return mpjpe(scale * predicted, target)
 
 
@@ -276,51 +331,87 @@ def mean_velocity_error_train(predicted, target, axis=0):
 
     return torch.mean(torch.norm(velocity_predicted - velocity_target, dim=len(target.shape)-1))
 
-def mean_velocity_error(predicted, target, axis=0):
+def mean_velocity_error(predicted, target, axis=0, return_frames_err=False):
     """
     Mean per-joint velocity error (i.e. mean Euclidean distance of the 1st derivative)
+    Works on NumPy arrays and torch tensors. With return_frames_err, the error of every frame
+    (against the previous one along axis) is returned instead of the mean.
     """
     assert predicted.shape == target.shape
 
-    velocity_predicted = np.diff(predicted, axis=axis)
-    velocity_target = np.diff(target, axis=axis)
-    
-    return np.mean(np.linalg.norm(velocity_predicted - velocity_target, axis=len(target.shape)-1))
-
-def sym_penalty(dataset,keypoints,pred_out):
+    if torch.is_tensor(predicted):
+        errors = torch.norm(torch.diff(predicted, dim=axis) - torch.diff(target, dim=axis), dim=-1)
+    else:
+        velocity_predicted = np.diff(predicted, axis=axis)
+        velocity_target = np.diff(target, axis=axis)
+        errors = np.linalg.norm(velocity_predicted - velocity_target, axis=len(target.shape)-1)
+    if return_frames_err:
+        return errors.mean(-1)
+    return errors.mean()
+
+def sym_penalty(pred_out, bones=H36M_BONES):
     """
     get penalty for the symmetry of human body
     :return:
     """
-    loss_sym = 0
-    if dataset == 'h36m':
-        if keypoints.startswith('hr'):
-            left_bone = [(0,4),(4,5),(5,6),(8,10),(10,11),(11,12)]
-            right_bone = [(0,1),(1,2),(2,3),(8,13),(13,14),(14,15)]
-        else:
-            left_bone = [(0,4),(4,5),(5,6),(8,11),(11,12),(12,13)]
-            right_bone = [(0,1),(1,2),(2,3),(8,14),(14,15),(15,16)]
-        for (i_left,j_left),(i_right,j_right) in zip(left_bone,right_bone):
-            left_part = pred_out[:,:,i_left]-pred_out[:,:,j_left]
-            right_part = pred_out[:, :, i_right] - pred_out[:, :, j_right]
-            loss_sym += torch.mean(torch.abs(torch.norm(left_part, dim=-1) - torch.norm(right_part, dim=-1)))
-    elif dataset.startswith('STB'):
-        loss_sym = 0
+    loss_sym = bones.symmetry(pred_out).flatten(0, -2).mean(dim=0).sum()
     return 0.01*loss_sym
 
-def bonelen_consistency_loss(dataset,keypoints,pred_out):
-    loss_length = 0
-    if dataset == 'h36m':
-        if keypoints.startswith('hr'):
-            assert "hrnet has not completed"
-        else:
-            bones = [(0,1), (0,4), (1,2), (2,3), (4,5), (5,6), (0,7), (7,8), (8,9), (9,10), 
-                    (8,11), (11,12), (12,13), (8,14), (14,15), (15,16)]
-        for (i,j) in bones:
-            bonelen = pred_out[:,:,i]-pred_out[:,:,j]
-            bone_diff = bonelen[:,1:,:]-bonelen[:,:-1,:]
-            loss_length += torch.mean(torch.norm(bone_diff, dim=-1))
-    elif dataset.startswith('heva'):
-        loss_length = 0
-
-    return 0.01 * loss_length
\ No newline at end of file
+def bonelen_consistency_loss(pred_out, bones=H36M_BONES):
+    loss_length = bones.temporal_change(pred_out).flatten(0, -2).mean(dim=0).sum()
+    return 0.01 * loss_length
+
+def pose_root_losses(predicted_3d, target_3d, predicted_root, target_root, predicted_2d, target_2d, inputs_2d, mask, w):
+    """
+    Training loss of the root-relative pose and the solved root, with its logged components.
+    Every term is taken from shared per-joint differences and norms; the outlier joints of the
+    root solver are excluded with a multiplicative weight instead of zeroed copies.
+
+    Arguments:
+    predicted_3d and target_3d -- root-relative 3D joints (B, T, J, 3)
+    predicted_root and target_root -- root positions (B, T, 1, 3)
+    predicted_2d -- reprojection of the predicted pose (B, T, J, 2)
+    target_2d -- reprojection of the ground truth (B, T, J, 2)
+    inputs_2d -- 2D keypoints given to the model (B, T, J, 2)
+    mask -- outlier joints of the root solver (B, T, J)
+    w -- per-joint weights (J,)
+
+    Returns a dictionary with
+    'loss' -- loss_3d + 0.5 * loss_smooth + 2 * loss_velocity
+    'loss_3d' -- weighted MPJPE of the inlier joints, the root joint replaced by the root error
+    'loss_smooth' -- weighted mean squared frame-to-frame motion of the predicted joints (absolute root)
+    'loss_velocity' -- MPJVE with the absolute root
+    'loss_2d' -- 2D error of the inlier joints
+    'mpjpe', 'mrpe', 'error_2d', 'input_error_2d' -- monitored errors (not part of the loss)
+    """
+    diff = predicted_3d - target_3d
+    root_diff = predicted_root - target_root
+    root_error = torch.norm(root_diff, dim=-1)
+    keep = (~mask[..., 1:]).to(diff.dtype)
+
+    joint_error = torch.cat((root_error, torch.norm(diff[..., 1:, :], dim=-1) * keep), dim=-1)
+    loss_3d = torch.mean(w * joint_error)
+
+    # frame-to-frame motion with the absolute root in place of joint 0
+    motion = torch.diff(torch.cat((predicted_root, predicted_3d[..., 1:, :]), dim=-2), dim=1)
+    loss_smooth = torch.mean(w[:, None] * motion * motion)
+    velocity_error = torch.diff(torch.cat((root_diff, diff[..., 1:, :]), dim=-2), dim=1)
+    loss_velocity = torch.mean(torch.norm(velocity_error, dim=-1))
+
+    error_2d = torch.norm(predicted_2d - target_2d, dim=-1)
+    with torch.no_grad():
+        # the pose error is relative to the x coordinate of every joint, as logged before
+        mpjpe_error = torch.mean(torch.norm(diff - diff[..., :1], dim=-1))
+        input_error_2d = torch.mean(torch.norm(inputs_2d - target_2d, dim=-1))
+
+    return {
+        'loss': loss_3d + 0.5 * loss_smooth + 2.0 * loss_velocity,
+        'loss_3d': loss_3d,
+        'loss_smooth': loss_smooth,
+        'loss_velocity': loss_velocity,
+        'loss_2d': torch.mean(error_2d * (~mask).to(error_2d.dtype)),
+        'mpjpe': mpjpe_error,
+        'mrpe': torch.mean(root_error).detach(),
+        'error_2d': torch.mean(error_2d).detach(),
+        'input_error_2d': input_error_2d,
+    }
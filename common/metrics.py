@@ -0,0 +1,163 @@
+import numpy as np
+import torch
+import torch.distributed as dist
+
+
+def _all_reduce(tensors):
+    """ Sum a list of tensors over all ranks with a single all_reduce (no-op without torch.distributed) """
+    if not (dist.is_available() and dist.is_initialized()) or not tensors:
+        return tensors
+    flat = torch.cat([t.reshape(-1) for t in tensors])
+    dist.all_reduce(flat)
+    return [r.view_as(t) for r, t in zip(torch.split(flat, [t.numel() for t in tensors]), tensors)]
+
+
+class RunningMetrics:
+    """
+    Weighted running means of scalar metrics (losses, errors) kept as device tensors, so that
+    updating them never waits for the device. Values are only copied to the host, all at
+    once, by result() / snapshot(), e.g. when the progress bar is refreshed or at the end of
+    the epoch.
+    """
+
+    def __init__(self):
+        self.sums = {}
+        self.counts = {}
+        self.last = {}
+
+    def update(self, name, value, weight=1):
+        """ value -- scalar tensor (or number); weight -- e.g. the number of samples it averages """
+        value = torch.as_tensor(value).detach()
+        if name not in self.sums:
+            self.sums[name] = torch.zeros((), dtype=torch.float64, device=value.device)
+            self.counts[name] = torch.zeros((), dtype=torch.float64, device=value.device)
+        self.sums[name] += value * weight
+        self.counts[name] += weight
+        self.last[name] = value
+
+    def names(self):
+        return list(self.sums.keys())
+
+    def snapshot(self):
+        """ Weighted means and latest values of every metric, with one device-to-host copy """
+        names = self.names()
+        if not names:
+            return {}, {}
+        values = torch.stack([self.sums[k] / self.counts[k] for k in names] +
+                             [self.last[k].to(torch.float64) for k in names]).tolist()
+        return dict(zip(names, values[:len(names)])), dict(zip(names, values[len(names):]))
+
+    def result(self):
+        """ Weighted means of every metric """
+        return self.snapshot()[0]
+
+    def all_reduce(self):
+        """ Sum the sums and counts over all ranks (one all_reduce for every metric) """
+        names = self.names()
+        if not names:
+            return
+        reduced = _all_reduce([torch.stack([self.sums[k] for k in names] + [self.counts[k] for k in names])])[0]
+        for i, k in enumerate(names):
+            self.sums[k] = reduced[i]
+            self.counts[k] = reduced[len(names) + i]
+
+
+class ActionErrors:
+    """
+    Errors collected over a PackedGenerator_Seq pass, summed per action.
+    Every error counts with its frame, so results are averaged over the frames of an action (or
+    of all actions), which weights sequences by their length; frames covered by several windows
+    are masked out by the caller (see PackedGenerator_Seq valid) so that they count once.
+    Optionally the errors of every window are summed as well (see stratified_estimate).
+
+    Error sums and counts stay on the device of the errors, so adding errors never waits for the
+    device; they are copied to the host once, at the first result() after new errors were added.
+
+    Arguments:
+    actions -- action name of every sequence
+    names -- metrics to allocate up front on device, so that all_reduce() also works on ranks
+             that receive no errors
+    windows -- number of windows to keep sums of (0: none), addressed by the window argument of add()
+    """
+
+    def __init__(self, actions, names=(), device=None, windows=0):
+        self.actions = list(actions)
+        self.groups, self.seq_group = np.unique(np.array(self.actions, dtype=str), return_inverse=True)
+        self.num_groups = len(self.groups)
+        self.size = self.num_groups + windows
+        self.device = device
+        self.sums = {}
+        self.counts = {}
+        for name in names:
+            self._allocate(name, device)
+        self._host = None
+
+    def _allocate(self, name, device):
+        self.sums[name] = torch.zeros(self.size, dtype=torch.float64, device=device)
+        self.counts[name] = torch.zeros(self.size, dtype=torch.float64, device=device)
+
+    def add(self, name, seq, errors, valid=None, window=None):
+        """
+        name -- metric name
+        seq -- sequence id of every window (B,)
+        errors -- per-frame errors (B, F), NumPy array or tensor
+        valid -- optional boolean mask (B, F) of the entries to keep
+        window -- optional window id (B,) of every window, for the window sums
+        """
+        errors = torch.as_tensor(errors).detach().to(torch.float64)
+        seq = np.asarray(seq)
+        valid = np.ones(errors.shape, dtype=bool) if valid is None else np.asarray(valid)
+        index = np.broadcast_to(self.seq_group[seq][:, None], valid.shape)
+        if window is not None:
+            index = np.concatenate((index, np.broadcast_to(self.num_groups + np.asarray(window)[:, None], valid.shape)))
+            errors = torch.cat((errors, errors))
+            valid = np.concatenate((valid, valid))
+        if name not in self.sums:
+            self._allocate(name, errors.device)
+        # masked entries add zero, which keeps the scatter free of data-dependent shapes
+        mask = torch.from_numpy(valid).to(errors.device)
+        index = torch.from_numpy(np.ascontiguousarray(index).reshape(-1)).to(errors.device)
+        self.sums[name].index_add_(0, index, torch.where(mask, errors, torch.zeros_like(errors)).reshape(-1))
+        self.counts[name].index_add_(0, index, mask.reshape(-1).to(torch.float64))
+        self._host = None
+
+    def names(self):
+        return list(self.sums.keys())
+
+    def action_names(self):
+        """ Actions in order of first appearance """
+        return list(dict.fromkeys(self.actions))
+
+    def all_reduce(self):
+        """ Sum the per-action (and per-window) sums and counts of every metric over all ranks, with one all_reduce """
+        names = self.names()
+        if not names:
+            return
+        reduced = _all_reduce([torch.stack([self.sums[k] for k in names] + [self.counts[k] for k in names])])[0]
+        for i, k in enumerate(names):
+            self.sums[k] = reduced[i]
+            self.counts[k] = reduced[len(names) + i]
+        self._host = None
+
+    def _sums_counts(self, name):
+        """ Host copies of the sums and counts of metric name, with one device-to-host copy for all metrics """
+        if self._host is None:
+            names = self.names()
+            host = torch.stack([torch.stack((self.sums[k], self.counts[k])) for k in names]).cpu().numpy()
+            self._host = dict(zip(names, host))
+        return self._host[name]
+
+    def window_errors(self, name):
+        """ Mean error of every window (NaN for windows without errors) """
+        sums, counts = self._sums_counts(name)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return sums[self.num_groups:] / counts[self.num_groups:]
+
+    def result(self, name, action=None):
+        """ Mean error of metric name over the frames of action (all frames if None) """
+        sums, counts = self._sums_counts(name)
+        sums, counts = sums[:self.num_groups], counts[:self.num_groups]
+        if action is not None:
+            group = np.searchsorted(self.groups, action)
+            return float(sums[group] / counts[group])
+        return float(sums.sum() / counts.sum())
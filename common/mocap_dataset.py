@@ -1,5 +1,6 @@
 import numpy as np
 from common.skeleton import Skeleton
+from common.prepared_dataset import load_prepared
 from itertools import zip_longest
 
 
@@ -9,6 +10,31 @@ class MocapDataset:
         self._fps = fps
         self._data = None # Must be filled by subclass
         self._cameras = None # Must be filled by subclass
+        self._keypoints = None # Only filled when loading a prepared store
+        self._keypoints_metadata = None
+    
+    def _load_prepared(self, path, store=None):
+        """
+        Attach a store written by prepare_data.py. Camera-space 3D poses, normalized 2D keypoints
+        and intrinsic vectors are memory-mapped views, so no per-sequence preparation is repeated.
+        store is the result of load_prepared(path), if the caller has already loaded it.
+        """
+        if store is None:
+            store = load_prepared(path)
+        if self._data is None:
+            self._data = {}
+        for subject, actions in store['positions_3d'].items():
+            for action_name, positions_3d in actions.items():
+                self._data.setdefault(subject, {})[action_name] = {
+                    'positions_3d': positions_3d,
+                    'cameras': self._cameras[subject],
+                }
+        for subject, intrinsics in store['intrinsics'].items():
+            for cam_idx, intrinsic in intrinsics.items():
+                self._cameras[subject][cam_idx]['intrinsic'] = intrinsic
+        self._keypoints = store['positions_2d']
+        self._keypoints_metadata = store['metadata']
+        return store
     
     def remove_joints(self, joints_to_remove):
         kept_joints = self._skeleton.remove_joints(joints_to_remove)
@@ -34,6 +60,15 @@ class MocapDataset:
     def cameras(self):
         return self._cameras
     
+    def prepared(self):
+        return self._keypoints is not None
+    
+    def keypoints(self):
+        return self._keypoints
+    
+    def keypoints_metadata(self):
+        return self._keypoints_metadata
+    
     def supports_semi_supervised(self):
         # This method can be overridden
         return False
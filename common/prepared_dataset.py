@@ -0,0 +1,229 @@
+import os
+import json
+import numpy as np
+
+from common.camera import world_to_camera, normalize_screen_coordinates
+
+
+def prepare_data(dataset, keypoints_path):
+    """
+    Bring a freshly loaded dataset and its 2D detections into the form used for training:
+    3D poses in camera space (root-relative, with the trajectory kept in the first joint),
+    2D keypoints trimmed to the mocap length and normalized to screen coordinates.
+
+    Arguments:
+    dataset -- a MocapDataset; 'positions_3d' is added to every action with mocap data
+    keypoints_path -- path of the data_2d_*.npz detections file
+
+    Returns the nested keypoints dictionary and the keypoints metadata.
+    """
+    for subject in dataset.subjects():
+        for action in dataset[subject].keys():
+            anim = dataset[subject][action]
+
+            if 'positions' in anim:
+                positions_3d = []
+                for cam in anim['cameras']:
+                    pos_3d = world_to_camera(anim['positions'], R=cam['orientation'], t=cam['translation'])
+                    pos_3d[:, 1:] -= pos_3d[:, :1] # Remove global offset, but keep trajectory in first position
+                    positions_3d.append(pos_3d)
+                anim['positions_3d'] = positions_3d
+
+    keypoints = np.load(keypoints_path, allow_pickle=True)
+    keypoints_metadata = keypoints['metadata'].item()
+    keypoints = keypoints['positions_2d'].item()
+
+    for subject in dataset.subjects():
+        assert subject in keypoints, 'Subject {} is missing from the 2D detections dataset'.format(subject)
+        for action in dataset[subject].keys():
+            assert action in keypoints[subject], 'Action {} of subject {} is missing from the 2D detections dataset'.format(action, subject)
+            if 'positions_3d' not in dataset[subject][action]:
+                continue
+
+            for cam_idx in range(len(keypoints[subject][action])):
+
+                # We check for >= instead of == because some videos in H3.6M contain extra frames
+                mocap_length = dataset[subject][action]['positions_3d'][cam_idx].shape[0]
+                assert keypoints[subject][action][cam_idx].shape[0] >= mocap_length
+
+                if keypoints[subject][action][cam_idx].shape[0] > mocap_length:
+                    # Shorten sequence
+                    keypoints[subject][action][cam_idx] = keypoints[subject][action][cam_idx][:mocap_length]
+
+            assert len(keypoints[subject][action]) == len(dataset[subject][action]['positions_3d'])
+
+    for subject in keypoints.keys():
+        for action in keypoints[subject]:
+            for cam_idx, kps in enumerate(keypoints[subject][action]):
+                # Normalize camera frame
+                cam = dataset.cameras()[subject][cam_idx]
+                kps[..., :2] = normalize_screen_coordinates(kps[..., :2], w=cam['res_w'], h=cam['res_h'])
+                keypoints[subject][action][cam_idx] = kps
+
+    return keypoints, keypoints_metadata
+
+
+def write_prepared(path, dataset, keypoints, keypoints_metadata):
+    """
+    Write the output of prepare_data() as a flat, memory-mappable store:
+
+    positions_2d.npy -- all 2D sequences concatenated along the frame axis
+    positions_3d.npy -- all camera-space 3D sequences concatenated along the frame axis
+    cameras.npy -- one intrinsic vector per (subject, camera)
+    index.npz -- (subject, action, camera) offset index into the arrays above
+    metadata.json -- the keypoints metadata
+    """
+    os.makedirs(path, exist_ok=True)
+
+    entries = [] # (subject, action, cam_idx, 2d sequence, 3d sequence or None)
+    for subject in keypoints.keys():
+        for action in keypoints[subject]:
+            poses_3d = None
+            if subject in dataset.subjects() and action in dataset[subject]:
+                poses_3d = dataset[subject][action].get('positions_3d')
+            for cam_idx, kps in enumerate(keypoints[subject][action]):
+                entries.append((subject, action, cam_idx, kps, None if poses_3d is None else poses_3d[cam_idx]))
+
+    camera_rows = {}
+    intrinsics = []
+    for subject, cams in dataset.cameras().items():
+        for cam_idx, cam in enumerate(cams):
+            if 'intrinsic' in cam:
+                camera_rows[(subject, cam_idx)] = len(intrinsics)
+                intrinsics.append(cam['intrinsic'])
+
+    length = np.array([e[3].shape[0] for e in entries], dtype='int64')
+    offset_2d = np.concatenate(([0], np.cumsum(length)[:-1])).astype('int64')
+    has_3d = np.array([e[4] is not None for e in entries], dtype=bool)
+    offset_3d = np.full(len(entries), -1, dtype='int64')
+    offset_3d[has_3d] = np.concatenate(([0], np.cumsum(length[has_3d])[:-1]))
+    camera = np.array([camera_rows.get((e[0], e[2]), -1) for e in entries], dtype='int64')
+
+    # Fill the flat arrays in place so that the full dataset is never held twice in memory
+    sample_2d = entries[0][3]
+    out_2d = np.lib.format.open_memmap(os.path.join(path, 'positions_2d.npy'), mode='w+',
+                                       dtype=sample_2d.dtype, shape=(int(length.sum()),) + sample_2d.shape[1:])
+    for (_, _, _, kps, _), o, n in zip(entries, offset_2d, length):
+        out_2d[o:o+n] = kps
+    out_2d.flush()
+
+    if has_3d.any():
+        sample_3d = next(e[4] for e in entries if e[4] is not None)
+        out_3d = np.lib.format.open_memmap(os.path.join(path, 'positions_3d.npy'), mode='w+',
+                                           dtype=sample_3d.dtype, shape=(int(length[has_3d].sum()),) + sample_3d.shape[1:])
+        for (_, _, _, _, pos_3d), o, n in zip(entries, offset_3d, length):
+            if pos_3d is not None:
+                out_3d[o:o+n] = pos_3d
+        out_3d.flush()
+
+    if len(intrinsics) > 0:
+        np.save(os.path.join(path, 'cameras.npy'), np.stack(intrinsics).astype('float32'))
+
+    np.savez(os.path.join(path, 'index.npz'),
+             subject=np.array([e[0] for e in entries]),
+             action=np.array([e[1] for e in entries]),
+             camera_index=np.array([e[2] for e in entries], dtype='int64'),
+             offset_2d=offset_2d,
+             offset_3d=offset_3d,
+             length=length,
+             camera=camera,
+             camera_subject=np.array([k[0] for k in camera_rows] if camera_rows else [], dtype=str),
+             camera_subject_index=np.array([k[1] for k in camera_rows], dtype='int64'))
+
+    with open(os.path.join(path, 'metadata.json'), 'w') as f:
+        json.dump(keypoints_metadata, f, default=lambda o: o.tolist())
+
+
+def load_prepared(path):
+    """
+    Open a store written by write_prepared(). The arrays are memory-mapped read-only and every
+    returned sequence is a view into them, so nothing is copied until it is actually indexed.
+
+    Returns a dictionary with
+    positions_2d -- keypoints[subject][action][cam_idx] views, already trimmed and normalized
+    positions_3d -- positions_3d[subject][action][cam_idx] views (only for actions with mocap data)
+    intrinsics -- intrinsics[subject][cam_idx] intrinsic vectors
+    metadata -- the keypoints metadata
+    """
+    index = np.load(os.path.join(path, 'index.npz'))
+    flat_2d = np.load(os.path.join(path, 'positions_2d.npy'), mmap_mode='r')
+    flat_3d = None
+    if os.path.exists(os.path.join(path, 'positions_3d.npy')):
+        flat_3d = np.load(os.path.join(path, 'positions_3d.npy'), mmap_mode='r')
+
+    positions_2d = {}
+    positions_3d = {}
+    for subject, action, o_2d, o_3d, n in zip(index['subject'], index['action'], index['offset_2d'],
+                                              index['offset_3d'], index['length']):
+        subject, action = str(subject), str(action)
+        positions_2d.setdefault(subject, {}).setdefault(action, []).append(flat_2d[o_2d:o_2d+n])
+        if o_3d >= 0:
+            positions_3d.setdefault(subject, {}).setdefault(action, []).append(flat_3d[o_3d:o_3d+n])
+
+    intrinsics = {}
+    if os.path.exists(os.path.join(path, 'cameras.npy')):
+        table = np.load(os.path.join(path, 'cameras.npy'), mmap_mode='r')
+        for row, (subject, cam_idx) in enumerate(zip(index['camera_subject'], index['camera_subject_index'])):
+            intrinsics.setdefault(str(subject), {})[int(cam_idx)] = table[row]
+
+    with open(os.path.join(path, 'metadata.json')) as f:
+        metadata = json.load(f)
+
+    return {
+        'positions_2d': positions_2d,
+        'positions_3d': positions_3d,
+        'intrinsics': intrinsics,
+        'metadata': metadata,
+    }
+
+
+def _mapped_root(array):
+    """ Memory-mapped array (with a file) that array is a view of, or None """
+    while isinstance(array.base, np.ndarray):
+        array = array.base
+    return array if isinstance(array, np.memmap) and array.filename is not None else None
+
+
+def flatten_sequences(sequences):
+    """
+    All sequences in one flat array, and the row of the first frame of every sequence.
+    Sequences that are row ranges of the same memory-mapped array of a prepared store (see
+    load_prepared) are addressed in place, without reading or copying them; any others (e.g.
+    downsampled ones) are concatenated.
+    """
+    root = _mapped_root(sequences[0])
+    if root is not None and root.flags.c_contiguous:
+        starts = []
+        for seq in sequences:
+            offset = seq.__array_interface__['data'][0] - root.__array_interface__['data'][0]
+            if (_mapped_root(seq) is not root or seq.dtype != root.dtype or seq.strides != root.strides
+                    or offset % root.strides[0] != 0):
+                break
+            starts.append(offset // root.strides[0])
+        else:
+            return root, np.array(starts, dtype='int64')
+    lengths = [seq.shape[0] for seq in sequences]
+    return np.concatenate(sequences), np.concatenate(([0], np.cumsum(lengths)[:-1])).astype('int64')
+
+
+class MappedArray:
+    """
+    Picklable reference to a read-only memory-mapped array (e.g. a flat store array): spawned
+    processes map the file again with open() instead of receiving a copy of the data.
+    """
+    def __init__(self, array):
+        self.filename = array.filename
+        self.offset = array.offset
+        self.dtype = array.dtype
+        self.shape = array.shape
+
+    @staticmethod
+    def wraps(array):
+        return isinstance(array, np.memmap) and array.filename is not None and array.flags.c_contiguous
+
+    def open(self):
+        return np.memmap(self.filename, dtype=self.dtype, mode='r', offset=self.offset, shape=self.shape)
+
+
+def is_prepared(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, 'index.npz'))
@@ -1,6 +1,7 @@
 import torch
 import numpy as np
 import hashlib
+import math
 
 def wrap(func, *args, unsqueeze=False):
     """
@@ -82,369 +83,629 @@ def differentiable_pinv(A):
     
     return pinv
 
-def torrent_hyb(X, y, beta, tol=0.1):
+def torrent_hyb(f, uv, d, beta, tol=0.1, max_iter=100):
     """
-    Solve the Lasso problem using the hybrid method.
+    TORRENT (hybrid) robust regression on the root system (see root_system): the least-squares
+    root is recomputed without the beta fraction of rows with the largest residuals until the
+    residual norm of a sample drops below tol or its set of rows stops changing. Every sample
+    stops as soon as it has converged, so later iterations only cost work for the samples that
+    are still active.
+
     Args:
-        X (torch.Tensor): Input data of shape (n_samples, n_features).
-        y (torch.Tensor): Target values of shape (n_samples,).
-        tau (float): Threshold for the L1 regularization.
-        beta (float): Threshold for the active set.
+        f, uv, d: output of root_system, with uv and d of shape (..., N, 2).
+        beta (float): Fraction of rows left out of each fit.
+        tol (float): Tolerance on the residual norm of a sample.
         max_iter (int): Maximum number of iterations.
-        tol (float): Tolerance for the stopping criterion.
-        eta (float): Learning rate for the gradient descent.
+
     Returns:
-        w (torch.Tensor): Solution to the Lasso problem of shape (n_features,).
-    """ 
-    beta = torch.tensor(beta, device=X.device)
-    batch_size, n_samples, n_features = X.shape
-    w = torch.zeros(batch_size, n_features, 1).to(X.device)
-    active_set = torch.zeros(batch_size, n_samples,1, dtype=torch.bool).to(X.device)
-    residuals = y
-    scores = torch.norm(y, dim=-1).mean().item()
-    t = 0
-    while scores > tol:
-        X_active = X.clone()
-        y_active = y.clone()
-        X_active[active_set.expand_as(X_active)] = 0
-        y_active[active_set] = 0
-
-        w = torch.matmul(differentiable_pinv(X_active), y_active).squeeze(-1)
-        residuals = (X_active @ w.unsqueeze(-1)).squeeze(-1) - y_active.squeeze()
-        scores = torch.norm(residuals, dim=-1).mean()
-
-        # Select the top beta percent of the largest residuals
-        threshold = torch.quantile(residuals.abs(), 1 - beta, dim=-1, keepdim=True)
-        active_set = (residuals.abs() > threshold).view_as(residuals).unsqueeze(-1)
-        t += 1
-        if t > 100:
-            break
+        root (torch.Tensor): Root positions of shape (..., 3).
+        residuals (torch.Tensor): Residuals of shape (..., N, 2), zero for the rows left out.
+        iterations (torch.Tensor): Number of iterations of every sample, of shape (...).
+    """
+    shape = d.shape[:-2]
+    num_joints = d.shape[-2]
+    num_rows = 2 * num_joints
+    f = f.expand(shape + (1, 2)).reshape(-1, 1, 2)
+    uv = uv.reshape(-1, num_joints, 2)
+    d = d.reshape(-1, num_joints, 2)
+    num_samples = d.shape[0]
+
+    # Rows strictly above the (1 - beta) quantile of the residuals
+    k = num_rows - 1 - int(math.floor((num_rows - 1) * (1 - beta)))
+
+    weights = torch.ones_like(d)
+    iterations = torch.zeros(num_samples, dtype=torch.long, device=d.device)
+    top_values = torch.empty(num_samples, k, dtype=d.dtype, device=d.device)
+    top_indices = torch.empty(num_samples, k, dtype=torch.long, device=d.device)
+    next_weights = torch.empty(num_samples, num_rows, dtype=d.dtype, device=d.device)
+    active = torch.arange(num_samples, device=d.device)
+    with torch.no_grad():
+        for _ in range(max_iter):
+            m = active.shape[0]
+            w = weights[active]
+            root = solve_root_system(f[active], uv[active], d[active], weights=w)
+            residuals = (root_residuals(f[active], uv[active], d[active], root) * w).view(m, num_rows)
+            iterations[active] += 1
+
+            # Samples below the tolerance keep their current active set, and so do samples whose
+            # active set is a fixed point (every further iteration would give the same root)
+            torch.topk(residuals.abs(), k, dim=-1, out=(top_values[:m], top_indices[:m]))
+            next_w = next_weights[:m].fill_(1).scatter_(-1, top_indices[:m], 0)
+            running = (torch.norm(residuals, dim=-1) > tol) & (next_w != w.view(m, num_rows)).any(dim=-1)
+            active = active[running]
+            if active.shape[0] == 0:
+                break
+            weights[active] = next_w[running].view(-1, num_joints, 2)
+
+    root = solve_root_system(f, uv, d, weights=weights)
+    residuals = root_residuals(f, uv, d, root) * weights
+    return root.view(shape + (3,)), residuals.view(shape + (num_joints, 2)), iterations.view(shape)
+
+def root_system(p3d, p2d, camera):
+    """
+    Per-joint terms of the linear system A x = d that gives the root position x.
+    Every joint i contributes two rows,
+        [-fx, 0, u_i] x = fx * X_i - u_i * Z_i
+        [0, -fy, v_i] x = fy * Y_i - v_i * Z_i
+    with (u_i, v_i) = p2d_i - (cx, cy), so A is never built: A^T A and A^T d are sums over joints.
 
-    return w.squeeze(), residuals.squeeze()
+    Args:
+        p3d (torch.Tensor): root-relative 3D joints of shape (B, T, N, 3).
+        p2d (torch.Tensor): 2D joints of shape (B, T, N, 2).
+        camera (torch.Tensor): camera intrinsics of shape (B, 9).
 
-def get_root(p3d, p2d, camera):
+    Returns:
+        f (torch.Tensor): focal lengths of shape (B, 1, 1, 2).
+        uv (torch.Tensor): centered 2D joints of shape (B, T, N, 2).
+        d (torch.Tensor): right-hand side of shape (B, T, N, 2).
     """
-    Calculate the root position (X_r, Y_r, Z_r) from 3D joint coordinates, 2D joint projections, and camera parameters.
+    f = camera[:, None, None, :2]
+    uv = p2d - camera[:, None, None, 2:4]
+    d = f * p3d[..., :2] - uv * p3d[..., 2:]
+    return f, uv, d
+
+def root_normal_equations(f, uv, d, weights=None, epsilon=1e-6):
+    """
+    Non-zero entries of the (weighted) normal equations (A^T W A + epsilon I) x = A^T W d,
+    accumulated from per-joint sums. (A^T A)_01 is always zero.
+
+    Returns:
+        a (torch.Tensor): (A^T A)_00 and (A^T A)_11, of shape (..., 2).
+        c (torch.Tensor): (A^T A)_02 and (A^T A)_12, of shape (..., 2).
+        a_zz (torch.Tensor): (A^T A)_22, of shape (...).
+        b (torch.Tensor): (A^T d)_0 and (A^T d)_1, of shape (..., 2).
+        b_z (torch.Tensor): (A^T d)_2, of shape (...).
+    """
+    f = f[..., 0, :]
+    if weights is None:
+        weights = torch.ones_like(d)
+    wuv = weights * uv
+    a = f * f * weights.sum(dim=-2) + epsilon
+    c = -f * wuv.sum(dim=-2)
+    a_zz = (wuv * uv).sum(dim=(-2, -1)) + epsilon
+    b = -f * (weights * d).sum(dim=-2)
+    b_z = (wuv * d).sum(dim=(-2, -1))
+    return a, c, a_zz, b, b_z
+
+def solve_normal_equations(a, c, a_zz, b, b_z):
+    """ Solve the 3x3 system of root_normal_equations by eliminating x and y, returns (..., 3) """
+    z = (b_z - (c * b / a).sum(dim=-1)) / (a_zz - (c * c / a).sum(dim=-1))
+    xy = (b - c * z.unsqueeze(-1)) / a
+    return torch.cat((xy, z.unsqueeze(-1)), dim=-1)
+
+def solve_root_system(f, uv, d, weights=None, epsilon=1e-6):
+    """
+    Closed-form solution of the (weighted) normal equations (A^T W A + epsilon I) x = A^T W d.
+    A^T A has a zero (0, 1) entry, so eliminating x and y leaves one scalar equation for z.
 
     Args:
-        p3d (np.ndarray): 3D joint coordinates of shape (..., N, 3), where N is the number of joints.
-        p2d (np.ndarray): 2D joint projections of shape (..., N, 2).
-        camera (np.ndarray): Camera intrinsic parameters of shape (3, 4).
+        f, uv, d: output of root_system.
+        weights (torch.Tensor): optional per-row weights of shape (B, T, N, 2), e.g. an inlier mask.
+        epsilon (float): ridge term, as in differentiable_pinv.
 
     Returns:
-        root_position (torch.Tensor): Root position of shape (..., 3) containing (X_r, Y_r, Z_r).
-        residuals (torch.Tensor): Residuals of the least squares fit.
-    """
-    # Extract camera parameters
-    fx = camera[..., 0][:, None]
-    fy = camera[..., 1][:, None]
-    cx = camera[..., 2][:, None]
-    cy = camera[..., 3][:, None]
-
-    # Prepare A and b matrices
-    b, t, N = p3d.shape[0], p3d.shape[1], p3d.shape[2]
-    d = torch.zeros_like(p2d).reshape(b, t, -1)
-    A = torch.stack([d.clone(), d.clone(), d.clone()], dim=-1)
- 
-
-    for i in range(N):
-        x = p2d[..., i, 0] - cx
-        y = p2d[..., i, 1] - cy
-
-        # Populate A matrix
-        A[..., 2 * i, 0] = -fx
-        A[..., 2 * i, 2] = x
-        A[..., 2 * i + 1, 1] = -fy
-        A[..., 2 * i + 1, 2] = y
-
-        # Populate b vector
-        d[..., 2 * i] = fx * p3d[..., i, 0] - x * p3d[..., i, 2]
-        d[..., 2 * i + 1] = fy * p3d[..., i, 1] - y * p3d[..., i, 2]
-
-    A = A.view(-1, N * 2, 3)  # Flatten batch and time
-    d = d.view(-1, N * 2, 1)     # Flatten batch and time
-
-    A_pinv = differentiable_pinv(A)
-    x = torch.matmul(A_pinv, d).squeeze(-1)
-    residuals = (A @ x.unsqueeze(-1)).squeeze(-1) - d.squeeze()
-
-    thresholds = torch.tensor(170 / 1000, device=residuals.device)
-    mask = residuals.abs() > thresholds
-    d[mask] = 0
-    A[mask.unsqueeze(-1).expand_as(A)] = 0
-
-    A_pinv = differentiable_pinv(A)
-    x = torch.matmul(A_pinv, d).squeeze(-1)
-    residuals = (A @ x.unsqueeze(-1)).squeeze(-1) - d.squeeze()
-    
-    x = x.view(b, t, 3)
-    residuals = residuals.view(b, t, N , 2)
-    mask = mask.view(b, t, N, 2)
-    mask = mask.any(dim=-1)
-
-    return x.unsqueeze(2), mask
-
-def get_root_torrent(p3d, p2d, camera, beta=170 / 1000):
-    # Extract camera parameters
-    fx = camera[..., 0][:, None]
-    fy = camera[..., 1][:, None]
-    cx = camera[..., 2][:, None]
-    cy = camera[..., 3][:, None]
-
-    # Prepare A and b matrices
-    b, t, N = p3d.shape[0], p3d.shape[1], p3d.shape[2]
-    d = torch.zeros_like(p2d).reshape(b, t, -1)
-    A = torch.stack([d.clone(), d.clone(), d.clone()], dim=-1)
-    for i in range(N):
-        x = p2d[..., i, 0] - cx
-        y = p2d[..., i, 1] - cy
-
-        # Populate A matrix
-        A[..., 2 * i, 0] = -fx
-        A[..., 2 * i, 2] = x
-        A[..., 2 * i + 1, 1] = -fy
-        A[..., 2 * i + 1, 2] = y
-
-        # Populate b vector
-        d[..., 2 * i] = fx * p3d[..., i, 0] - x * p3d[..., i, 2]
-        d[..., 2 * i + 1] = fy * p3d[..., i, 1] - y * p3d[..., i, 2]
-
-    A = A.view(-1, N * 2, 3)  # Flatten batch and time
-    d = d.view(-1, N * 2, 1)     # Flatten batch and time
-
-    x, residuals = torrent_hyb(A, d, beta)
-    x = x.view(b, t, 3)
-    residuals = residuals.view(b, t, N , 2)
-    return x.unsqueeze(2), residuals
+        root (torch.Tensor): root positions of shape (B, T, 3).
+    """
+    return solve_normal_equations(*root_normal_equations(f, uv, d, weights, epsilon))
 
+class RootSolve(torch.autograd.Function):
+    """
+    solve_root_system with a backward pass from the implicit function theorem: with
+    M x = A^T W d and lambda = M^-1 grad_x, the gradient of row r is w_r (lambda . a_r) for d_r
+    and -w_r (lambda r_r + x (lambda . a_r)) for a_r, where r_r is its residual.
+    Only the 3x3 system is saved; residuals are recomputed from the inputs in backward.
+    The weights are treated as constants.
+    """
 
-def LSR(p3d, p2d, camera):
+    @staticmethod
+    def forward(ctx, p3d, p2d, camera, weights=None):
+        f, uv, d = root_system(p3d, p2d, camera)
+        a, c, a_zz, b, b_z = root_normal_equations(f, uv, d, weights)
+        x = solve_normal_equations(a, c, a_zz, b, b_z)
+        ctx.save_for_backward(p3d, p2d, camera, weights, x, a, c, a_zz)
+        return x
+
+    @staticmethod
+    def backward(ctx, grad_x):
+        p3d, p2d, camera, weights, x, a, c, a_zz = ctx.saved_tensors
+        lam = solve_normal_equations(a, c, a_zz, grad_x[..., :2], grad_x[..., 2])
+        return root_system_backward(ctx.needs_input_grad[:3], p3d, p2d, camera, weights, x, lam) + (None,)
+
+def root_system_backward(needs_input_grad, p3d, p2d, camera, weights, x, lam):
+    """
+    Gradients of p3d, p2d and camera for a root x solved from the (weighted) root system,
+    given lambda = M^-1 grad_x (see RootSolve). Returns None for the inputs without needs_input_grad.
+    """
+    f, uv, d = root_system(p3d, p2d, camera)
+    if weights is None:
+        weights = torch.ones_like(d)
+    s = root_residuals(f, uv, 0, lam)   # lambda . a_r for every row
+    r = root_residuals(f, uv, d, x)
+    grad_d = weights * s
+
+    grad_p3d = grad_p2d = grad_camera = None
+    if needs_input_grad[0]:
+        grad_p3d = torch.cat((f * grad_d, -(uv * grad_d).sum(dim=-1, keepdim=True)), dim=-1)
+    if needs_input_grad[1] or needs_input_grad[2]:
+        grad_uv = -weights * (lam[..., None, 2:] * r + x[..., None, 2:] * s) - grad_d * p3d[..., 2:]
+        grad_p2d = grad_uv if needs_input_grad[1] else None
+    if needs_input_grad[2]:
+        grad_f = weights * (lam[..., None, :2] * r + x[..., None, :2] * s) + grad_d * p3d[..., :2]
+        grad_camera = torch.zeros_like(camera)
+        grad_camera[:, :2] = grad_f.sum(dim=(1, 2)).sum_to_size(camera.shape[0], 2)
+        grad_camera[:, 2:4] = -grad_uv.sum(dim=(1, 2)).sum_to_size(camera.shape[0], 2)
+    return grad_p3d, grad_p2d, grad_camera
+
+def solve_root(p3d, p2d, camera, weights=None):
+    """ Weighted least-squares root (B, T, 3) with the memory-light backward of RootSolve """
+    return RootSolve.apply(p3d, p2d, camera, weights)
+
+def root_residuals(f, uv, d, root):
+    """ Residuals A x - d of the root system, of shape (B, T, N, 2) """
+    return -f * root[..., None, :2] + uv * root[..., None, 2:] - d
+
+def get_root(p3d, p2d, camera):
     """
     Calculate the root position (X_r, Y_r, Z_r) from 3D joint coordinates, 2D joint projections, and camera parameters.
+    The least-squares fit is solved twice: the second time without the residuals above 170 mm.
 
     Args:
-        p3d (np.ndarray): 3D joint coordinates of shape (..., N, 3), where N is the number of joints.
-        p2d (np.ndarray): 2D joint projections of shape (..., N, 2).
-        camera (np.ndarray): Camera intrinsic parameters of shape (3, 4).
+        p3d (torch.Tensor): 3D joint coordinates of shape (B, T, N, 3), where N is the number of joints.
+        p2d (torch.Tensor): 2D joint projections of shape (B, T, N, 2).
+        camera (torch.Tensor): Camera intrinsic parameters of shape (B, 9).
 
     Returns:
-        root_position (torch.Tensor): Root position of shape (..., 3) containing (X_r, Y_r, Z_r).
-        residuals (torch.Tensor): Residuals of the least squares fit.
-    """
-    # Extract camera parameters
-    # Extract camera parameters
-    fx = camera[..., 0][:, None]
-    fy = camera[..., 1][:, None]
-    cx = camera[..., 2][:, None]
-    cy = camera[..., 3][:, None]
-
-    # Prepare A and b matrices
-    b, t, N = p3d.shape[0], p3d.shape[1], p3d.shape[2]
-    d = torch.zeros_like(p2d).reshape(b, t, -1)
-    A = torch.stack([d.clone(), d.clone(), d.clone()], dim=-1)
- 
-
-    for i in range(N):
-        x = p2d[..., i, 0] - cx
-        y = p2d[..., i, 1] - cy
-
-        # Populate A matrix
-        A[..., 2 * i, 0] = -fx
-        A[..., 2 * i, 2] = x
-        A[..., 2 * i + 1, 1] = -fy
-        A[..., 2 * i + 1, 2] = y
-
-        # Populate b vector
-        d[..., 2 * i] = fx * p3d[..., i, 0] - x * p3d[..., i, 2]
-        d[..., 2 * i + 1] = fy * p3d[..., i, 1] - y * p3d[..., i, 2]
-
-    A = A.view(-1, N * 2, 3)  # Flatten batch and time
-    d = d.view(-1, N * 2, 1)     # Flatten batch and time
-
-    A_pinv = differentiable_pinv(A)
-    x = torch.matmul(A_pinv, d).squeeze(-1)
-    residuals = (A @ x.unsqueeze(-1)).squeeze(-1) - d.squeeze()
-    
-    return x.unsqueeze(2), A, d, residuals
+        root_position (torch.Tensor): Root position of shape (B, T, 1, 3) containing (X_r, Y_r, Z_r).
+        mask (torch.Tensor): Joints rejected as outliers, of shape (B, T, N).
+    """
+    with torch.no_grad():
+        f, uv, d = root_system(p3d, p2d, camera)
+        x = solve_root_system(f, uv, d)
+        mask = root_residuals(f, uv, d, x).abs() > 170 / 1000
+
+    x = solve_root(p3d, p2d, camera, weights=(~mask).to(d.dtype))
 
-def get_root_m_estimation(p3d, p2d, camera, huber_delta=170 / 1000):
+    return x.unsqueeze(2), mask.any(dim=-1)
+
+def get_root_lstsq(p3d, p2d, camera):
     """
-    M-estimation version: Applies Huber loss weighting to mitigate the impact of outliers.
+    Plain least-squares root over all joints.
+    Returns the root (B, T, 1, 3) and the residuals (B, T, N, 2).
     """
-    root, A, d, residuals = LSR(p3d, p2d, camera)
-
-    # Compute Huber weights
-    huber_weights = torch.where(residuals.abs() < huber_delta, torch.ones_like(residuals), huber_delta / residuals.abs())
-    
-    # Apply weights to A and d
-    A_weighted = huber_weights.unsqueeze(-1) * A
-    d_weighted = huber_weights.unsqueeze(-1) * d
-    # Solve weighted least squares
-    A_pinv = differentiable_pinv(A_weighted)
-    x = torch.matmul(A_pinv, d_weighted).squeeze(-1)
-    x = x.view(p3d.shape[0], p3d.shape[1], 3)
+    x = solve_root(p3d, p2d, camera)
+    with torch.no_grad():
+        f, uv, d = root_system(p3d, p2d, camera)
+        residuals = root_residuals(f, uv, d, x)
     return x.unsqueeze(2), residuals
 
-def get_root_ransac(p3d, p2d, camera, num_samples=50, threshold=170 / 1000, inlier_ratio=0.6):
+def root_normal_matrix(a, c, a_zz):
+    """ Dense 3x3 matrices (..., 3, 3) of the normal equations from root_normal_equations """
+    zero = torch.zeros_like(a_zz)
+    entries = (a[..., 0], zero, c[..., 0], zero, a[..., 1], c[..., 1], c[..., 0], c[..., 1], a_zz)
+    return torch.stack(entries, dim=-1).view(a_zz.shape + (3, 3))
+
+def solve_block_tridiagonal(diag, lower, upper, rhs):
     """
-    RANSAC-based root position estimation.
+    Solve a batch of block-tridiagonal systems
+        lower_t x_{t-1} + diag_t x_t + upper_t x_{t+1} = rhs_t,    t = 0..T-1
+    by block cyclic reduction: every level eliminates the odd frames with one batched k x k solve
+    and halves the system, so the work is O(T) and the depth O(log T).
+    lower_0 and upper_{T-1} are ignored.
 
     Args:
-        p3d (torch.Tensor): 3D joint coordinates of shape (B, T, N, 3).
-        p2d (torch.Tensor): 2D joint projections of shape (B, T, N, 2).
-        camera (torch.Tensor): Camera intrinsic parameters of shape (B, 4).
-        num_samples (int): Number of RANSAC iterations.
-        threshold (float): Error threshold to classify inliers.
-        inlier_ratio (float): Minimum ratio of inliers required for a valid model.
+        diag, lower, upper (torch.Tensor): blocks of shape (..., T, k, k).
+        rhs (torch.Tensor): right-hand side of shape (..., T, k).
 
     Returns:
-        best_root (torch.Tensor): Best estimated root positions (B, T, 3).
-        best_inliers (torch.Tensor): Inlier masks used in final estimation (B, T, N).
-    """
-    batch_size, seq_len, _, _ = p3d.shape
-    num_joints = 16
-    best_root = torch.zeros(batch_size, seq_len, 3, device=p3d.device)
-    best_inlier_counts = torch.zeros(batch_size, seq_len, device=p3d.device)
-
-    for _ in range(num_samples):
-        # Step 1: Randomly select 50% of the joints for model fitting
-        sample_idx = torch.randint(0, num_joints, (batch_size, seq_len, 17 // 2), device=p3d.device)
-        sampled_p3d = torch.gather(p3d, 2, sample_idx.unsqueeze(-1).expand(-1, -1, -1, 3))
-        sampled_p2d = torch.gather(p2d, 2, sample_idx.unsqueeze(-1).expand(-1, -1, -1, 2))
-        # Step 2: Compute root position using least squares regression (LSR)
-        root, A, d, residuals = LSR(sampled_p3d, sampled_p2d, camera)  # Assumes LSR returns residuals
-        root = root.reshape(batch_size, seq_len, 3)  # Shape: [B, T, 3]
-
-        # Step 3: Compute inliers - residuals below threshold
-        residuals = residuals.view(batch_size, seq_len, num_joints)  # Shape: [B, T, N]
-        inlier_mask = residuals < threshold  # Boolean mask: [B, T, N]
-        inlier_count = inlier_mask.sum(dim=-1)  # Shape: [B, T]
-
-        # Step 4: Check if the current model is better (i.e., has more inliers)
-        update_mask = inlier_count > best_inlier_counts  # Shape: [B, T]
-        best_root[update_mask] = root[update_mask]  # Ensure shape is [B, T, 3]
-        best_inlier_counts[update_mask] = inlier_count[update_mask].float()
-
-    # Step 5: Recompute final root using best inliers
-    final_mask = best_inlier_counts / num_joints >= inlier_ratio  # Ensure we have enough inliers
-    best_root[~final_mask] = 0  # Discard unreliable estimates
-    return best_root.unsqueeze(2), final_mask
+        x (torch.Tensor): solution of shape (..., T, k).
+    """
+    lower = torch.cat((torch.zeros_like(lower[..., :1, :, :]), lower[..., 1:, :, :]), dim=-3)
+    upper = torch.cat((upper[..., :-1, :, :], torch.zeros_like(upper[..., -1:, :, :])), dim=-3)
+    return _cyclic_reduction(diag, lower, upper, rhs.unsqueeze(-1)).squeeze(-1)
+
+def _cyclic_reduction(diag, lower, upper, rhs):
+    num_frames, k = diag.shape[-3], diag.shape[-1]
+    if num_frames == 1:
+        return torch.linalg.solve(diag, rhs)
+    num_even = (num_frames + 1) // 2
+
+    # D_o^-1 [L_o, U_o, r_o] of the odd frames in one solve
+    odd = torch.linalg.solve(diag[..., 1::2, :, :], torch.cat((lower[..., 1::2, :, :], upper[..., 1::2, :, :],
+                                                               rhs[..., 1::2, :, :]), dim=-1))
+    pad = torch.zeros_like(odd[..., :1, :, :])
+    left = torch.cat((pad, odd), dim=-3)[..., :num_even, :, :]   # odd neighbour t-1 of every even frame t
+    right = torch.cat((odd, pad), dim=-3)[..., :num_even, :, :]  # odd neighbour t+1 (zero after the last frame)
+    lower_e, upper_e = lower[..., ::2, :, :], upper[..., ::2, :, :]
+    x_even = _cyclic_reduction(
+        diag[..., ::2, :, :] - lower_e @ left[..., k:2 * k] - upper_e @ right[..., :k],
+        -lower_e @ left[..., :k],
+        -upper_e @ right[..., k:2 * k],
+        rhs[..., ::2, :, :] - lower_e @ left[..., 2 * k:] - upper_e @ right[..., 2 * k:])
+
+    num_odd = num_frames // 2
+    x_next = torch.cat((x_even[..., 1:, :, :], torch.zeros_like(x_even[..., :1, :, :])), dim=-3)[..., :num_odd, :, :]
+    x_odd = odd[..., 2 * k:] - odd[..., :k] @ x_even[..., :num_odd, :, :] - odd[..., k:2 * k] @ x_next
+    x = torch.stack((x_even[..., :num_odd, :, :], x_odd), dim=-3).flatten(-4, -3)
+    return torch.cat((x, x_even[..., num_odd:, :, :]), dim=-3)
+
+def temporal_root_system(a, c, a_zz, smoothness):
+    """
+    Blocks of the normal equations of the whole window with the first-order smoothness prior
+    smoothness * sum_t ||x_{t+1} - x_t||^2: diagonal M_t + smoothness * (number of neighbours) I,
+    off-diagonal -smoothness * I.
+    """
+    num_frames = a_zz.shape[-1]
+    eye = torch.eye(3, dtype=a_zz.dtype, device=a_zz.device)
+    neighbours = torch.full((num_frames,), 2., dtype=a_zz.dtype, device=a_zz.device)
+    neighbours[0] -= 1
+    neighbours[-1] -= 1
+    diag = root_normal_matrix(a, c, a_zz) + smoothness * neighbours[:, None, None] * eye
+    coupling = (-smoothness * eye).expand(diag.shape)
+    return diag, coupling
+
+class TemporalRootSolve(torch.autograd.Function):
+    """
+    Root trajectory (B, T, 3) minimizing sum_t ||W_t (A_t x_t - d_t)||^2 + smoothness * sum_t ||x_{t+1} - x_t||^2.
+    The system is symmetric block-tridiagonal, so the backward pass solves it once more with
+    grad_x (lambda) and reuses root_system_backward, like RootSolve.
+    """
 
-def get_root_lms(p3d, p2d, camera):
+    @staticmethod
+    def forward(ctx, p3d, p2d, camera, weights=None, smoothness=1.):
+        f, uv, d = root_system(p3d, p2d, camera)
+        a, c, a_zz, b, b_z = root_normal_equations(f, uv, d, weights)
+        diag, coupling = temporal_root_system(a, c, a_zz, smoothness)
+        x = solve_block_tridiagonal(diag, coupling, coupling, torch.cat((b, b_z.unsqueeze(-1)), dim=-1))
+        ctx.save_for_backward(p3d, p2d, camera, weights, x, diag)
+        ctx.smoothness = smoothness
+        return x
+
+    @staticmethod
+    def backward(ctx, grad_x):
+        p3d, p2d, camera, weights, x, diag = ctx.saved_tensors
+        coupling = (-ctx.smoothness * torch.eye(3, dtype=diag.dtype, device=diag.device)).expand(diag.shape)
+        lam = solve_block_tridiagonal(diag, coupling, coupling, grad_x)
+        return root_system_backward(ctx.needs_input_grad[:3], p3d, p2d, camera, weights, x, lam) + (None, None)
+
+def get_root_temporal(p3d, p2d, camera, smoothness=1.):
     """
-    Least Median of Squares (LMS) version: Finds the root position that minimizes the median residual.
+    Root trajectory of every window solved jointly: the per-frame least-squares fits of get_root
+    (without the residuals above 170 mm) coupled by a first-order smoothness prior.
+    smoothness weights the squared frame-to-frame root motion against the squared residuals of
+    the root system; 0 gives the per-frame get_root solution.
+
+    Returns the root (B, T, 1, 3) and the outlier joints (B, T, N), like get_root.
     """
-    root, A, d, residuals = LSR(p3d, p2d, camera)
+    with torch.no_grad():
+        f, uv, d = root_system(p3d, p2d, camera)
+        x = solve_root_system(f, uv, d)
+        mask = root_residuals(f, uv, d, x).abs() > 170 / 1000
 
-    # Compute median of residuals
-    median_residual = torch.median(residuals.abs(), dim=-1, keepdim=True)[0]
+    x = TemporalRootSolve.apply(p3d, p2d, camera, (~mask).to(d.dtype), smoothness)
 
-    # Select inliers where residuals are within a threshold of the median
-    threshold = 1.5 * median_residual
-    inlier_mask = residuals.abs() < threshold
+    return x.unsqueeze(2), mask.any(dim=-1)
 
-    # Apply inliers to refine estimation
-    A_inliers = A * inlier_mask.unsqueeze(-1)
-    d_inliers = d * inlier_mask.unsqueeze(-1)
+class StreamingRootSolver:
+    """
+    Online version of get_root_temporal for frames arriving one at a time (or in chunks).
+    Forward elimination of the block-tridiagonal system is carried from frame to frame, so every
+    update costs O(frames added) and the root of the newest frame is the exact solution of the
+    system over all frames seen so far. The last `history` frames are kept and re-solved by back
+    substitution, i.e. earlier roots are refined as new frames arrive (fixed-lag smoothing).
+    Inference only: no gradients flow through the carried state.
 
-    A_pinv = differentiable_pinv(A_inliers)
-    x = torch.matmul(A_pinv, d_inliers).squeeze(-1)
-    x = x.view(p3d.shape[0], p3d.shape[1], 3)
+    Arguments:
+    smoothness -- weight of the smoothness prior (see get_root_temporal)
+    history -- number of recent frames whose roots are returned by update()
+    """
+    def __init__(self, smoothness=1., history=1):
+        self.smoothness = smoothness
+        self.history = history
+        self.reset()
+
+    def reset(self):
+        self.schur = []   # Schur complements S_t of the eliminated system (without the next frame)
+        self.rhs = []     # eliminated right-hand sides
+
+    @torch.no_grad()
+    def update(self, p3d, p2d, camera):
+        """
+        p3d -- root-relative 3D joints of the new frames (B, F, N, 3)
+        p2d -- their 2D joints (B, F, N, 2)
+        camera -- intrinsics (B, 9)
+
+        Returns the roots of the last min(history, frames seen) frames (B, H, 1, 3).
+        """
+        f, uv, d = root_system(p3d, p2d, camera)
+        x = solve_root_system(f, uv, d)
+        weights = (root_residuals(f, uv, d, x).abs() <= 170 / 1000).to(d.dtype)
+        a, c, a_zz, b, b_z = root_normal_equations(f, uv, d, weights)
+        matrices = root_normal_matrix(a, c, a_zz)
+        vectors = torch.cat((b, b_z.unsqueeze(-1)), dim=-1).unsqueeze(-1)
+        eye = self.smoothness * torch.eye(3, dtype=d.dtype, device=d.device)
+
+        for t in range(matrices.shape[1]):
+            schur, rhs = matrices[:, t], vectors[:, t]
+            if self.schur:
+                # the previous frame gains its right neighbour, then is eliminated
+                gain = torch.linalg.solve(self.schur[-1] + eye, torch.cat((eye.expand_as(schur), self.rhs[-1]), dim=-1))
+                schur = schur + eye - self.smoothness * gain[..., :3]
+                rhs = rhs + self.smoothness * gain[..., 3:]
+            self.schur.append(schur)
+            self.rhs.append(rhs)
+        del self.schur[:-self.history], self.rhs[:-self.history]
+
+        # back substitution over the kept frames
+        roots = [torch.linalg.solve(self.schur[-1], self.rhs[-1])]
+        for schur, rhs in zip(reversed(self.schur[:-1]), reversed(self.rhs[:-1])):
+            roots.append(torch.linalg.solve(schur + eye, rhs + self.smoothness * roots[-1]))
+        return torch.stack(roots[::-1], dim=1).transpose(-2, -1)
+
+def get_root_torrent(p3d, p2d, camera, beta=170 / 1000, tol=0.1, max_iter=100, return_stats=False):
+    """
+    Root position with TORRENT (see torrent_hyb), ignoring the beta fraction of worst-fitting rows.
+
+    Returns the root (B, T, 1, 3) and the residuals (B, T, N, 2); with return_stats, also a
+    dictionary with the per-sample iteration counts and their mean and maximum.
+    """
+    f, uv, d = root_system(p3d, p2d, camera)
+    x, residuals, iterations = torrent_hyb(f, uv, d, beta, tol=tol, max_iter=max_iter)
+    if return_stats:
+        stats = {
+            'iterations': iterations,
+            'mean_iterations': iterations.float().mean().item(),
+            'max_iterations': iterations.max().item(),
+        }
+        return x.unsqueeze(2), residuals, stats
     return x.unsqueeze(2), residuals
 
-def refine_pose(p3d, p2d, camera, iterations=3, alpha=10):
+
+# Weight functions of the robust losses for IRLS, w(r) with the residuals r scaled by the loss scale.
+ROBUST_WEIGHTS = {
+    'huber': lambda r: 1 / r.abs().clamp(min=1),
+    'cauchy': lambda r: 1 / (1 + r * r),
+    'tukey': lambda r: (1 - r * r).clamp(min=0) ** 2,
+    'truncated': lambda r: (r.abs() < 1).to(r.dtype),
+}
+
+def robust_weights(residuals, loss, scale, relative_scale=False):
     """
-    Refine 3D joint coordinates using accurate gradient calculation based on residuals
-    from get_root.
+    IRLS weights of the rows of the root system, of shape (..., N, 2).
+    With relative_scale, the scale is a multiple of the median absolute residual of each sample.
+    """
+    if relative_scale:
+        scale = scale * residuals.abs().flatten(-2).median(dim=-1)[0].clamp(min=1e-12)[..., None, None]
+    return ROBUST_WEIGHTS[loss](residuals / scale)
+
+def irls_root(f, uv, d, loss='huber', scale=170 / 1000, relative_scale=False, max_iter=10, tol=1e-4):
+    """
+    Iteratively reweighted least squares for the root, starting from the plain least-squares fit.
+    Every iteration reweights the rows from the current residuals and re-solves the 3x3 normal
+    equations in closed form. Only the samples that have not converged are processed: a sample
+    stops when its root moves less than tol (max_iter iterations with tol=0).
 
     Args:
-        p3d (torch.Tensor): Initial 3D joint coordinates of shape (B, t, N, 3).
-        p2d (torch.Tensor): 2D joint projections of shape (B, t, N, 2).
-        camera (torch.Tensor): Camera intrinsic parameters of shape (B, 4).
-        iterations (int): Number of refinement iterations.
-        alpha (float): Learning rate for updating 3D and 2D coordinates.
+        f, uv, d: output of root_system, with uv and d of shape (B, T, N, 2).
+        loss (str): 'huber', 'cauchy', 'tukey' or 'truncated' (truncated L2), see ROBUST_WEIGHTS.
+        scale (float): residual scale of the loss (the Huber delta, the Tukey/truncation cutoff).
+        relative_scale (bool): use scale * median |residual| of each sample instead.
+        max_iter (int): maximum number of reweighting iterations.
+        tol (float): convergence threshold on the root update.
 
     Returns:
-        refined_p3d (torch.Tensor): Refined 3D joint coordinates of shape (B, t, N, 3).
-        pred_root (torch.Tensor): Predicted root position of shape (B, t, 1, 3).
-        refined_p2d (torch.Tensor): Refined 2D joint projections of shape (B, t, N, 2).
+        root (torch.Tensor): root positions of shape (B, T, 3).
+        weights (torch.Tensor): final row weights of shape (B, T, N, 2).
+        iterations (torch.Tensor): iterations run for every sample, of shape (B, T).
     """
+    shape = uv.shape[:2]
+    num_joints = uv.shape[2]
+    f = f.expand(shape + (1, 2)).reshape(-1, 1, 2)
+    uv = uv.reshape(-1, num_joints, 2)
+    d = d.reshape(-1, num_joints, 2)
+
+    x = solve_root_system(f, uv, d)
+    weights = torch.ones_like(d)
+    iterations = torch.zeros(x.shape[0], dtype=torch.long, device=x.device)
+    active = torch.arange(x.shape[0], device=x.device)
+    for _ in range(max_iter):
+        f_a, uv_a, d_a, x_a = f[active], uv[active], d[active], x[active]
+        w = robust_weights(root_residuals(f_a, uv_a, d_a, x_a), loss, scale, relative_scale)
+        x_new = solve_root_system(f_a, uv_a, d_a, weights=w)
+        x[active] = x_new
+        weights[active] = w
+        iterations[active] += 1
+        active = active[(x_new - x_a).abs().amax(dim=-1) >= tol]
+        if active.numel() == 0:
+            break
+    return x.view(shape + (3,)), weights.view(shape + (num_joints, 2)), iterations.view(shape)
 
-    for _ in range(iterations):
-        # Forward pass: Calculate residuals and root position
-        pred_root, residuals = get_root(p3d, p2d, camera)
-
-        # Compute A^T * residuals (gradient w.r.t. x)
-        B_t, _, N, _ = residuals.shape  # Extract batch and temporal dimensions
-        residuals_flat = residuals.view(B_t * N, -1)  # Flatten for batched matrix operations
-
-        # Backpropagation through A and d
-        grad_p3d = compute_grad_p3d(residuals_flat, p3d, camera)
-        grad_p2d = compute_grad_p2d(residuals_flat, p2d, camera)
+def get_root_irls(p3d, p2d, camera, loss='huber', scale=170 / 1000, relative_scale=False, max_iter=10, tol=1e-4,
+                  unroll=False):
+    """
+    Robust root position with IRLS (see irls_root).
 
-        # Update p3d and p2d using computed gradients
-        p3d = p3d - alpha * grad_p3d
-        # p2d = p2d - alpha * grad_p2d
+    By default the iterations run without gradients and the root is re-solved with the final
+    weights held constant, with the backward pass of RootSolve. With unroll, all samples run
+    max_iter iterations under autograd, so gradients also flow through the weights.
 
-    return p3d, pred_root, p2d
+    Returns the root (B, T, 1, 3) and the final row weights (B, T, N, 2).
+    """
+    if unroll:
+        f, uv, d = root_system(p3d, p2d, camera)
+        x = solve_root_system(f, uv, d)
+        for _ in range(max_iter):
+            weights = robust_weights(root_residuals(f, uv, d, x), loss, scale, relative_scale)
+            x = solve_root_system(f, uv, d, weights=weights)
+        return x.unsqueeze(2), weights
+
+    with torch.no_grad():
+        f, uv, d = root_system(p3d, p2d, camera)
+        _, weights, _ = irls_root(f, uv, d, loss, scale, relative_scale, max_iter, tol)
+    x = solve_root(p3d, p2d, camera, weights=weights)
+    return x.unsqueeze(2), weights
+
+def get_root_m_estimation(p3d, p2d, camera, huber_delta=170 / 1000, max_iter=10):
+    """
+    M-estimation version: IRLS with Huber weights to mitigate the impact of outliers.
+    """
+    return get_root_irls(p3d, p2d, camera, loss='huber', scale=huber_delta, max_iter=max_iter)
 
-def compute_grad_p3d(residuals_flat, p3d, camera):
+def get_root_ransac(p3d, p2d, camera, num_samples=50, threshold=170 / 1000, inlier_ratio=0.6):
     """
-    Compute the gradient of the loss w.r.t. p3d using residuals.
+    RANSAC-based root position estimation.
+    All hypotheses (random subsets of half of the joints) are solved at once as weighted root
+    systems, scored in one reduction, and the root is refit on the inliers of the best one.
 
     Args:
-        residuals_flat (torch.Tensor): Flattened residuals of shape (B * t * N, 2).
-        p3d (torch.Tensor): 3D joint coordinates of shape (B, t, N, 3).
-        camera (torch.Tensor): Camera intrinsic parameters of shape (B, 4).
+        p3d (torch.Tensor): 3D joint coordinates of shape (B, T, N, 3).
+        p2d (torch.Tensor): 2D joint projections of shape (B, T, N, 2).
+        camera (torch.Tensor): Camera intrinsic parameters of shape (B, 9).
+        num_samples (int): Number of RANSAC hypotheses.
+        threshold (float): Error threshold to classify inliers.
+        inlier_ratio (float): Minimum ratio of inliers required for a valid model.
 
     Returns:
-        grad_p3d (torch.Tensor): Gradient of the loss w.r.t. p3d of shape (B, t, N, 3).
+        best_root (torch.Tensor): Root positions refit on the inliers, (B, T, 1, 3). Frames without
+            enough inliers fall back to the least-squares fit on all joints.
+        final_mask (torch.Tensor): Frames with enough inliers (B, T).
     """
-    B, t, N, _ = p3d.shape
-
-    # Reshape residuals back to (B, t, N, 2)
-    residuals = residuals_flat.view(B, t, N, 2)
-
-    # Extract camera parameters and expand dimensions
-    fx = camera[..., 0].unsqueeze(-1).unsqueeze(-1).repeat(1, t, N)
-    fy = camera[..., 1].unsqueeze(-1).unsqueeze(-1).repeat(1, t, N)
+    batch_size, seq_len, num_joints, _ = p3d.shape
+
+    # Step 1: Draw every hypothesis at once, (H, B, T, k) joint indices
+    sample_idx = torch.rand(num_samples, batch_size, seq_len, num_joints, device=p3d.device).topk(num_joints // 2, dim=-1)[1]
+    sample = torch.zeros(num_samples, batch_size, seq_len, num_joints, device=p3d.device, dtype=p3d.dtype)
+    sample.scatter_(-1, sample_idx, 1)
+
+    with torch.no_grad():
+        f, uv, d = root_system(p3d, p2d, camera)
+        # Step 2: Solve all hypotheses in one batched closed-form solve
+        roots = solve_root_system(f, uv, d, weights=sample.unsqueeze(-1).expand(-1, -1, -1, -1, 2))
+
+        # Step 3: Joints whose residuals are below the threshold are inliers, (H, B, T, N)
+        inliers = (root_residuals(f, uv, d, roots).abs() < threshold).all(dim=-1)
+        inlier_count = inliers.sum(dim=-1)
+
+        # Step 4: Keep the hypothesis with the most inliers
+        best = inlier_count.argmax(dim=0)
+        best_inliers = torch.gather(inliers, 0, best[None, :, :, None].expand(1, -1, -1, num_joints))[0]
+        final_mask = best_inliers.sum(dim=-1) >= inlier_ratio * num_joints
+
+    # Step 5: Recompute the root on the inliers of the best hypothesis
+    weights = torch.where(final_mask.unsqueeze(-1), best_inliers, torch.ones_like(best_inliers))
+    best_root = solve_root(p3d, p2d, camera, weights=weights.unsqueeze(-1).expand(-1, -1, -1, 2).to(d.dtype))
+    return best_root.unsqueeze(2), final_mask
 
-    # Compute gradient for p3d
-    grad_p3d = torch.zeros_like(p3d)
-    grad_p3d[..., 0] = fx * residuals[..., 0]
-    grad_p3d[..., 1] = fy * residuals[..., 1]
-    grad_p3d[..., 2] = -(fx * residuals[..., 0] + fy * residuals[..., 1])
+def get_root_lms(p3d, p2d, camera):
+    """
+    Least Median of Squares (LMS) version: refits the least-squares root on the rows whose
+    residuals are within 1.5 times the median residual (one truncated IRLS step).
+    """
+    return get_root_irls(p3d, p2d, camera, loss='truncated', scale=1.5, relative_scale=True, max_iter=1)
 
-    return grad_p3d
+def project_to_2d_jacobian(X, camera_params):
+    """
+    project_to_2d (Human3.6M camera with radial and tangential distortion) together with its
+    closed-form Jacobian with respect to the 3D points. Everything is kept per component so that
+    every operation is elementwise over (B, *).
 
+    Arguments:
+    X -- 3D points in *camera space* (B, *, 3)
+    camera_params -- intrinsic parameters (B, 2+2+3+2=9)
 
-def compute_grad_p2d(residuals_flat, p2d, camera):
+    Returns the 2D coordinates u and v (B, *) and their derivatives with respect to (X, Y, Z),
+    as two tuples of three (B, *) tensors. Coordinates clamped by project_to_2d get a zero derivative.
     """
-    Compute the gradient of the loss w.r.t. p2d using residuals.
+    camera_params = camera_params.view(camera_params.shape[:1] + (1,) * (X.ndim - 2) + (9,))
+    fx, fy, cx, cy, k1, k2, k3, p1, p2 = camera_params.unbind(-1)
+
+    qx, qy = X[..., 0] / X[..., 2], X[..., 1] / X[..., 2]
+    x, y = qx.clamp(min=-1, max=1), qy.clamp(min=-1, max=1)
+    r2 = x * x + y * y
+    radial = 1 + r2 * (k1 + r2 * (k2 + r2 * k3))
+    scale = radial + p1 * x + p2 * y
+    u = fx * (x * scale + p1 * r2) + cx
+    v = fy * (y * scale + p2 * r2) + cy
+
+    # d distorted / d (x, y), then through the normalization x = X / Z, y = Y / Z
+    d_radial = 2 * (k1 + r2 * (2 * k2 + 3 * k3 * r2))
+    dx = (qx.abs() <= 1) / X[..., 2]
+    dy = (qy.abs() <= 1) / X[..., 2]
+    u_x = fx * dx * (scale + x * (d_radial * x + 3 * p1))
+    u_y = fx * dy * (x * (d_radial * y + p2) + 2 * p1 * y)
+    v_x = fy * dx * (y * (d_radial * x + p1) + 2 * p2 * x)
+    v_y = fy * dy * (scale + y * (d_radial * y + 3 * p2))
+    return u, v, (u_x, u_y, -(u_x * qx + u_y * qy)), (v_x, v_y, -(v_x * qx + v_y * qy))
+
+def refine_root(p3d, p2d, camera, root, weights=None, iterations=3, damping=1e-3, epsilon=1e-6):
+    """
+    Levenberg-Marquardt refinement of the root under the full camera model of project_to_2d,
+    starting from a linear solution (which ignores the distortion coefficients).
+    All frames are refined at once: every iteration builds the 3x3 Gauss-Newton system from the
+    closed-form Jacobians, takes the damped step, and keeps it only where the reprojection
+    error decreases (the damping of that frame is then lowered, otherwise raised).
 
     Args:
-        residuals_flat (torch.Tensor): Flattened residuals of shape (B * t * N, 2).
-        p2d (torch.Tensor): 2D joint projections of shape (B, t, N, 2).
-        camera (torch.Tensor): Camera intrinsic parameters of shape (B, 4).
+        p3d (torch.Tensor): root-relative 3D joints of shape (B, T, N, 3).
+        p2d (torch.Tensor): 2D joints of shape (B, T, N, 2).
+        camera (torch.Tensor): camera intrinsics of shape (B, 9).
+        root (torch.Tensor): initial root of shape (B, T, 1, 3).
+        weights (torch.Tensor): optional joint weights of shape (B, T, N), e.g. the inliers.
+        iterations (int): number of iterations.
+        damping (float): initial damping of the diagonal of J^T J.
+        epsilon (float): ridge term.
 
     Returns:
-        grad_p2d (torch.Tensor): Gradient of the loss w.r.t. p2d of shape (B, t, N, 2).
+        root (torch.Tensor): refined root of shape (B, T, 1, 3).
     """
-    B, t, N, _ = p2d.shape
-
-    # Reshape residuals back to (B, t, N, 2)
-    residuals = residuals_flat.view(B, t, N, 2)
+    weights = torch.ones_like(p2d[..., 0]) if weights is None else weights.to(p2d.dtype)
+    pairs = [(0, 0), (0, 1), (0, 2), (1, 1), (1, 2), (2, 2)]
 
-    # Extract camera parameters and expand dimensions
-    fx = camera[..., 0].unsqueeze(-1).unsqueeze(-1).repeat(1, t, N)
-    fy = camera[..., 1].unsqueeze(-1).unsqueeze(-1).repeat(1, t, N)
+    def linearize(root):
+        u, v, J_u, J_v = project_to_2d_jacobian(p3d + root, camera)
+        r_u, r_v = u - p2d[..., 0], v - p2d[..., 1]
+        cost = (weights * (r_u * r_u + r_v * r_v)).sum(dim=-1)
+        return [r_u, r_v, *J_u, *J_v], cost
 
-    # Compute gradient for p2d
-    grad_p2d = torch.zeros_like(p2d)
-    grad_p2d[..., 0] = -fx * residuals[..., 0]
-    grad_p2d[..., 1] = -fy * residuals[..., 1]
-
-    return grad_p2d
+    state, cost = linearize(root)
+    mu = torch.full_like(cost, damping)
+    for _ in range(iterations):
+        r_u, r_v, J_u, J_v = state[0], state[1], state[2:5], state[5:]
+        wJ_u = [weights * J for J in J_u]
+        wJ_v = [weights * J for J in J_v]
+        JtJ = {(j, k): (wJ_u[j] * J_u[k] + wJ_v[j] * J_v[k]).sum(dim=-1) for j, k in pairs}
+        Jtr = torch.stack([(wJ_u[j] * r_u + wJ_v[j] * r_v).sum(dim=-1) for j in range(3)], dim=-1)
+        H = torch.stack([JtJ[min(j, k), max(j, k)] * (1 + mu * (j == k)) + epsilon * (j == k)
+                         for j in range(3) for k in range(3)], dim=-1).view(cost.shape + (3, 3))
+        candidate = root - torch.linalg.solve(H, Jtr).unsqueeze(-2)
+
+        state_c, cost_c = linearize(candidate)
+        better = cost_c < cost
+        keep = better.unsqueeze(-1)
+        root = torch.where(keep.unsqueeze(-1), candidate, root)
+        state = [torch.where(keep, new, old) for new, old in zip(state_c, state)]
+        cost = torch.where(better, cost_c, cost)
+        mu = torch.where(better, mu * 0.1, mu * 10)
+    return root
 
 
 def project_to_2d_linear(X, camera_params):
@@ -471,38 +732,44 @@ def project_to_2d_linear(X, camera_params):
     return f*XX + c
 
 def get_residuals(p3d, p2d, root,camera):
-    # Extract camera parameters
-    fx = camera[..., 0][:, None]
-    fy = camera[..., 1][:, None]
-    cx = camera[..., 2][:, None]
-    cy = camera[..., 3][:, None]
-
-    # Prepare A and b matrices
-    b, t, N = p3d.shape[0], p3d.shape[1], p3d.shape[2]
-    d = torch.zeros_like(p2d).reshape(b, t, -1)
-    A = torch.stack([d.clone(), d.clone(), d.clone()], dim=-1)
- 
-
-    for i in range(N):
-        x = p2d[..., i, 0] - cx
-        y = p2d[..., i, 1] - cy
-
-        # Populate A matrix
-        A[..., 2 * i, 0] = -fx
-        A[..., 2 * i, 2] = x
-        A[..., 2 * i + 1, 1] = -fy
-        A[..., 2 * i + 1, 2] = y
-
-        # Populate b vector
-        d[..., 2 * i] = fx * p3d[..., i, 0] - x * p3d[..., i, 2]
-        d[..., 2 * i + 1] = fy * p3d[..., i, 1] - y * p3d[..., i, 2]
-
-    A = A.view(-1, N * 2, 3)  # Flatten batch and time
-    d = d.view(-1, N * 2, 1)     # Flatten batch and time
-    root = root.reshape(-1, 3, 1)
-    
-    residuals = (A @ root).squeeze(-1) - d.squeeze()
-
-    residuals = residuals.view(b, t, N , 2)
-
-    return residuals
\ No newline at end of file
+    f, uv, d = root_system(p3d, p2d, camera)
+    return root_residuals(f, uv, d, root.reshape(p3d.shape[0], p3d.shape[1], 3))
+
+
+def _with_outlier_mask(solver):
+    """ Adapt a root solver to the get_root outputs: joints off by more than 170 mm are outliers """
+    def solve(p3d, p2d, camera):
+        root = solver(p3d, p2d, camera)[0]
+        with torch.no_grad():
+            f, uv, d = root_system(p3d, p2d, camera)
+            mask = (root_residuals(f, uv, d, root[..., 0, :]).abs() > 170 / 1000).any(dim=-1)
+        return root, mask
+    return solve
+
+# Root solvers by name (--root-solver). Every solver maps (p3d, p2d, camera) to the root
+# (B, T, 1, 3) and the outlier joints (B, T, N), like get_root.
+ROOT_SOLVERS = {
+    'lstsq': _with_outlier_mask(get_root_lstsq),
+    'trimmed': get_root,
+    'torrent': _with_outlier_mask(get_root_torrent),
+    'm_estimation': _with_outlier_mask(get_root_m_estimation),
+    'ransac': _with_outlier_mask(get_root_ransac),
+    'lms': _with_outlier_mask(get_root_lms),
+    'irls': _with_outlier_mask(get_root_irls),
+    'temporal': get_root_temporal,
+}
+
+def _with_refinement(solver, iterations):
+    """ Refine the root of a solver under the full camera model (refine_root), on its inlier joints """
+    def solve(p3d, p2d, camera):
+        root, mask = solver(p3d, p2d, camera)
+        return refine_root(p3d, p2d, camera, root, weights=~mask, iterations=iterations), mask
+    return solve
+
+def get_root_solver(name, refine_iterations=0):
+    """ Root solver registered as name, followed by refine_iterations Levenberg-Marquardt steps if > 0 """
+    if name not in ROOT_SOLVERS:
+        raise KeyError('Invalid root solver: {} (available: {})'.format(name, ', '.join(ROOT_SOLVERS)))
+    if refine_iterations > 0:
+        return _with_refinement(ROOT_SOLVERS[name], refine_iterations)
+    return ROOT_SOLVERS[name]
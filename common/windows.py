@@ -0,0 +1,79 @@
+import numpy as np
+import torch
+
+
+def window_index(num_frames, size, stride=None, pad=0):
+    """
+    Frame index table of the sliding windows over a sequence of num_frames frames.
+
+    Arguments:
+    num_frames -- length of the sequence
+    size -- number of frames per window (receptive field)
+    stride -- distance between consecutive window starts (defaults to size, i.e. non-overlapping)
+    pad -- number of virtual frames added on both sides (replicating the edge frames)
+
+    The last window is aligned to the end of the (padded) sequence so every frame is covered;
+    indices outside the sequence are clamped, which replicates the first/last frame.
+    Returns an int64 array of shape (N, size).
+    """
+    if stride is None:
+        stride = size
+    if num_frames == 0:
+        return np.zeros((0, size), dtype='int64')
+    last = max(num_frames + 2 * pad - size, 0)
+    starts = np.arange(0, last + 1, stride)
+    if starts[-1] != last:
+        starts = np.append(starts, last)
+    index = starts[:, None] - pad + np.arange(size)
+    return np.clip(index, 0, num_frames - 1)
+
+
+def sliding_windows(x, size, stride=None, pad=0):
+    """
+    Split a sequence (T, ...) into windows (N, size, ...).
+
+    When the windows tile the sequence without clamping, the result is a strided view of x
+    (no copy; do not write into it when stride < size). Otherwise the windows are gathered
+    with a single indexing operation. Works on NumPy arrays and torch tensors.
+
+    Returns the windows and the frame index table from window_index(), which maps every
+    output frame back to the sequence (see merge_windows).
+    """
+    if stride is None:
+        stride = size
+    index = window_index(x.shape[0], size, stride, pad)
+    n = index.shape[0]
+    if pad == 0 and x.shape[0] >= size and (x.shape[0] - size) % stride == 0:
+        if torch.is_tensor(x):
+            windows = x.as_strided((n, size) + tuple(x.shape[1:]),
+                                   (stride * x.stride(0),) + x.stride(), x.storage_offset())
+        else:
+            windows = np.lib.stride_tricks.as_strided(x, (n, size) + x.shape[1:],
+                                                      (stride * x.strides[0],) + x.strides, writeable=False)
+        return windows, index
+    if torch.is_tensor(x):
+        return x[torch.from_numpy(index).to(x.device)], index
+    return x[index], index
+
+
+def merge_windows(windows, index, num_frames=None):
+    """
+    Stitch per-window predictions (N, size, ...) back into a sequence (T, ...).
+    Frames covered by several windows (overlapping stride, aligned tail, clamped edges)
+    are averaged.
+    """
+    if num_frames is None:
+        num_frames = int(index.max()) + 1
+    flat_index = index.reshape(-1)
+    if torch.is_tensor(windows):
+        flat_index = torch.from_numpy(flat_index).to(windows.device)
+        values = windows.reshape((-1,) + tuple(windows.shape[2:]))
+        out = torch.zeros((num_frames,) + tuple(values.shape[1:]), dtype=values.dtype, device=values.device)
+        out.index_add_(0, flat_index, values)
+        count = torch.bincount(flat_index, minlength=num_frames).to(values.dtype)
+        return out / count.view((-1,) + (1,) * (values.ndim - 1))
+    values = windows.reshape((-1,) + windows.shape[2:])
+    out = np.zeros((num_frames,) + values.shape[1:], dtype=values.dtype)
+    np.add.at(out, flat_index, values)
+    count = np.bincount(flat_index, minlength=num_frames).astype(values.dtype)
+    return out / count.reshape((-1,) + (1,) * (values.ndim - 1))
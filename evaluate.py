@@ -19,6 +19,7 @@ import os
 import sys
 import errno
 import math
+import inspect
 from einops import rearrange, repeat
 from copy import deepcopy
 
@@ -29,11 +30,15 @@ from common.skeleton import *
 
 import random
 from common.loss import *
-from common.generators import ChunkedGenerator_Seq, UnchunkedGenerator_Seq
+from common.generators import ChunkedGenerator_Seq, UnchunkedGenerator_Seq, PackedGenerator_Seq
 from common.chunk_dataset import *
 from time import time
 from common.utils import *
 from common.logging import Logger
+from common.prepared_dataset import prepare_data
+from common.bones import BoneGeometry
+from common.augmentation import PoseFlip
+from common.evaluation import evaluate_actions
 from model.load_model import load_model
 from model.stcformer import STCFormer
 # from model.PoseMamba import PoseMamba
@@ -59,6 +64,9 @@ torch.backends.cudnn.benchmark = False
 args = parse_args()
 os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
 os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+if device.type == 'cpu' and args.threads > 0:
+    torch.set_num_threads(args.threads)
 
 
 # initial setting
@@ -69,6 +77,9 @@ TIMESTAMP = "{0:%Y%m%dT%H-%M-%S/}".format(datetime.now())
 
 print('Loading dataset...')
 dataset_path = 'data/data_3d_' + args.dataset + '.npz'
+keypoints_path = 'data/data_2d_' + args.dataset + '_' + args.keypoints + '.npz'
+if args.prepared_data:
+    dataset_path = keypoints_path = args.prepared_data
 if args.dataset == 'h36m':
     from common.h36m_dataset import Human36mDataset
     dataset = Human36mDataset(dataset_path)
@@ -77,58 +88,20 @@ elif args.dataset.startswith('humaneva'):
     dataset = HumanEvaDataset(dataset_path)
 elif args.dataset.startswith('custom'):
     from common.custom_dataset import CustomDataset
-    dataset = CustomDataset('data/data_2d_' + args.dataset + '_' + args.keypoints + '.npz')
+    dataset = CustomDataset(keypoints_path)
 else:
     raise KeyError('Invalid dataset')
-
-print('Preparing data...')
-for subject in dataset.subjects():
-    for action in dataset[subject].keys():
-        anim = dataset[subject][action]
-
-        if 'positions' in anim:
-            positions_3d = []
-            for cam in anim['cameras']:
-                pos_3d = world_to_camera(anim['positions'], R=cam['orientation'], t=cam['translation'])
-                pos_3d[:, 1:] -= pos_3d[:, :1] # Remove global offset, but keep trajectory in first position
-                positions_3d.append(pos_3d)
-            anim['positions_3d'] = positions_3d
-
-print('Loading 2D detections...')
-keypoints = np.load('data/data_2d_' + args.dataset + '_' + args.keypoints + '.npz', allow_pickle=True)
-keypoints_metadata = keypoints['metadata'].item()
+if dataset.prepared():
+    keypoints, keypoints_metadata = dataset.keypoints(), dataset.keypoints_metadata()
+else:
+    print('Preparing data...')
+    keypoints, keypoints_metadata = prepare_data(dataset, keypoints_path)
 keypoints_symmetry = keypoints_metadata['keypoints_symmetry']
 kps_left, kps_right = list(keypoints_symmetry[0]), list(keypoints_symmetry[1])
 joints_left, joints_right = list(dataset.skeleton().joints_left()), list(dataset.skeleton().joints_right())
-keypoints = keypoints['positions_2d'].item()
-
-###################
-for subject in dataset.subjects():
-    assert subject in keypoints, 'Subject {} is missing from the 2D detections dataset'.format(subject)
-    for action in dataset[subject].keys():
-        assert action in keypoints[subject], 'Action {} of subject {} is missing from the 2D detections dataset'.format(action, subject)
-        if 'positions_3d' not in dataset[subject][action]:
-            continue
-
-        for cam_idx in range(len(keypoints[subject][action])):
-
-            # We check for >= instead of == because some videos in H3.6M contain extra frames
-            mocap_length = dataset[subject][action]['positions_3d'][cam_idx].shape[0]
-            assert keypoints[subject][action][cam_idx].shape[0] >= mocap_length
-
-            if keypoints[subject][action][cam_idx].shape[0] > mocap_length:
-                # Shorten sequence
-                keypoints[subject][action][cam_idx] = keypoints[subject][action][cam_idx][:mocap_length]
-
-        assert len(keypoints[subject][action]) == len(dataset[subject][action]['positions_3d'])
-
-for subject in keypoints.keys():
-    for action in keypoints[subject]:
-        for cam_idx, kps in enumerate(keypoints[subject][action]):
-            # Normalize camera frame
-            cam = dataset.cameras()[subject][cam_idx]
-            kps[..., :2] = normalize_screen_coordinates(kps[..., :2], w=cam['res_w'], h=cam['res_h'])
-            keypoints[subject][action][cam_idx] = kps
+pose_flip = PoseFlip.from_metadata(keypoints_metadata, dataset.skeleton())
+bones = BoneGeometry.from_skeleton(dataset.skeleton())
+root_solver = get_root_solver(args.root_solver, args.root_refine)
 
 subjects_train = args.subjects_train.split(',')
 subjects_semi = [] if not args.subjects_unlabeled else args.subjects_unlabeled.split(',')
@@ -221,8 +194,6 @@ cameras_valid, poses_valid, poses_valid_2d = fetch(subjects_test, action_filter)
 receptive_field = args.number_of_frames
 pad = (receptive_field -1) // 2 # Padding on each side
 min_loss = args.min_loss
-width = cam['res_w']
-height = cam['res_h']
 num_joints = keypoints_metadata['num_joints']
 
 #########################################PoseTransformer
@@ -234,11 +205,14 @@ elif args.model == 'STCFormer':
     model_pos = STCFormer()
 else:
     try:
-        model_pos_train =  eval(args.model)(num_frame=receptive_field, num_joints=num_joints, in_chans=2, embed_dim_ratio=args.cs, depth=args.dep,
-            num_heads=8, mlp_ratio=2., qkv_bias=True, qk_scale=None,drop_path_rate=0.1)
-
-        model_pos =  eval(args.model)(num_frame=receptive_field, num_joints=num_joints, in_chans=2, embed_dim_ratio=args.cs, depth=args.dep,
-                num_heads=8, mlp_ratio=2., qkv_bias=True, qk_scale=None,drop_path_rate=0)
+        model_class = eval(args.model)
+        # models with a bone-length head take the geometry of the dataset skeleton
+        model_kwargs = {'bones': bones} if 'bones' in inspect.signature(model_class).parameters else {}
+        model_pos_train =  model_class(num_frame=receptive_field, num_joints=num_joints, in_chans=2, embed_dim_ratio=args.cs, depth=args.dep,
+            num_heads=8, mlp_ratio=2., qkv_bias=True, qk_scale=None,drop_path_rate=0.1, **model_kwargs)
+
+        model_pos =  model_class(num_frame=receptive_field, num_joints=num_joints, in_chans=2, embed_dim_ratio=args.cs, depth=args.dep,
+                num_heads=8, mlp_ratio=2., qkv_bias=True, qk_scale=None,drop_path_rate=0, **model_kwargs)
     except:
         raise Exception("Undefined model name")
 
@@ -257,9 +231,9 @@ for parameter in model_pos.parameters():
 
 wandb_id = args.wandb_id if args.wandb_id != '' else wandb.util.generate_id()
 # make model parallel
-if torch.cuda.is_available():
-    model_pos = nn.DataParallel(model_pos)
-    model_pos = model_pos.cuda()
+# without GPUs DataParallel only adds the 'module.' prefix of the training checkpoints
+model_pos = nn.DataParallel(model_pos)
+model_pos = model_pos.to(device)
 
 if args.resume or args.evaluate:
     chk_filename = os.path.join(args.checkpoint, args.resume if args.resume else args.evaluate)
@@ -284,163 +258,20 @@ test_generator = UnchunkedGenerator_Seq(cameras_valid, poses_valid, poses_valid_
 
 print('INFO: Testing on {} frames'.format(test_generator.num_frames()))
 
-
-def eval_data_prepare(receptive_field, inputs_2d, inputs_3d):
-    # inputs_2d_p = torch.squeeze(inputs_2d)
-    # inputs_3d_p = inputs_3d.permute(1,0,2,3)
-    # out_num = inputs_2d_p.shape[0] - receptive_field + 1
-    # eval_input_2d = torch.empty(out_num, receptive_field, inputs_2d_p.shape[1], inputs_2d_p.shape[2])
-    # for i in range(out_num):
-    #     eval_input_2d[i,:,:,:] = inputs_2d_p[i:i+receptive_field, :, :]
-    # return eval_input_2d, inputs_3d_p
-    ### split into (f/f1, f1, n, 2)
-    assert inputs_2d.shape[:-1] == inputs_3d.shape[:-1], "2d and 3d inputs shape must be same! "+str(inputs_2d.shape)+str(inputs_3d.shape)
-    inputs_2d_p = torch.squeeze(inputs_2d)
-    inputs_3d_p = torch.squeeze(inputs_3d)
-
-    if inputs_2d_p.shape[0] / receptive_field > inputs_2d_p.shape[0] // receptive_field: 
-        out_num = inputs_2d_p.shape[0] // receptive_field+1
-    elif inputs_2d_p.shape[0] / receptive_field == inputs_2d_p.shape[0] // receptive_field:
-        out_num = inputs_2d_p.shape[0] // receptive_field
-
-    eval_input_2d = torch.empty(out_num, receptive_field, inputs_2d_p.shape[1], inputs_2d_p.shape[2])
-    eval_input_3d = torch.empty(out_num, receptive_field, inputs_3d_p.shape[1], inputs_3d_p.shape[2])
-
-    for i in range(out_num-1):
-        eval_input_2d[i,:,:,:] = inputs_2d_p[i*receptive_field:i*receptive_field+receptive_field,:,:]
-        eval_input_3d[i,:,:,:] = inputs_3d_p[i*receptive_field:i*receptive_field+receptive_field,:,:]
-    if inputs_2d_p.shape[0] < receptive_field:
-        from torch.nn import functional as F
-        pad_right = receptive_field-inputs_2d_p.shape[0]
-        inputs_2d_p = rearrange(inputs_2d_p, 'b f c -> f c b')
-        inputs_2d_p = F.pad(inputs_2d_p, (0,pad_right), mode='replicate')
-        # inputs_2d_p = np.pad(inputs_2d_p, ((0, receptive_field-inputs_2d_p.shape[0]), (0, 0), (0, 0)), 'edge')
-        inputs_2d_p = rearrange(inputs_2d_p, 'f c b -> b f c')
-    if inputs_3d_p.shape[0] < receptive_field:
-        pad_right = receptive_field-inputs_3d_p.shape[0]
-        inputs_3d_p = rearrange(inputs_3d_p, 'b f c -> f c b')
-        inputs_3d_p = F.pad(inputs_3d_p, (0,pad_right), mode='replicate')
-        inputs_3d_p = rearrange(inputs_3d_p, 'f c b -> b f c')
-    eval_input_2d[-1,:,:,:] = inputs_2d_p[-receptive_field:,:,:]
-    eval_input_3d[-1,:,:,:] = inputs_3d_p[-receptive_field:,:,:]
-
-    return eval_input_2d, eval_input_3d
-
-
 ###################
 
 # Evaluate
-def evaluate(test_generator, action=None, return_predictions=False, use_trajectory_model=False, newmodel=None):
-    epoch_loss_3d_pos = 0
-    epoch_loss_3d_pos_procrustes = 0
-    epoch_loss_3d_pos_scale = 0
-    epoch_mrpe = 0
-    epoch_loss_3d_vel = 0
-    with torch.no_grad():
-        model_eval = model_pos
-        model_eval.eval()
-        N = 0
-        for cam, batch, batch_2d, _ in test_generator.next_epoch():
-            inputs_2d = torch.from_numpy(batch_2d.astype('float32'))
-            inputs_3d = torch.from_numpy(batch.astype('float32'))
-            cam = torch.from_numpy(cam.astype('float32'))
-
-
-            ##### apply test-time-augmentation (following Videopose3d)
-            inputs_2d_flip = inputs_2d.clone()
-            inputs_2d_flip [:, :, :, 0] *= -1
-            inputs_2d_flip[:, :, kps_left + kps_right,:] = inputs_2d_flip[:, :, kps_right + kps_left,:]
-
-            ##### convert size
-            inputs_3d_p = inputs_3d
-            if newmodel is not None:
-                def eval_data_prepare_pf(receptive_field, inputs_2d, inputs_3d):
-                    inputs_2d_p = torch.squeeze(inputs_2d)
-                    inputs_3d_p = inputs_3d.permute(1,0,2,3)
-                    padding = int(receptive_field//2)
-                    inputs_2d_p = rearrange(inputs_2d_p, 'b f c -> f c b')
-                    inputs_2d_p = F.pad(inputs_2d_p, (padding,padding), mode='replicate')
-                    inputs_2d_p = rearrange(inputs_2d_p, 'f c b -> b f c')
-                    out_num = inputs_2d_p.shape[0] - receptive_field + 1
-                    eval_input_2d = torch.empty(out_num, receptive_field, inputs_2d_p.shape[1], inputs_2d_p.shape[2])
-                    for i in range(out_num):
-                        eval_input_2d[i,:,:,:] = inputs_2d_p[i:i+receptive_field, :, :]
-                    return eval_input_2d, inputs_3d_p
-                
-                inputs_2d, inputs_3d = eval_data_prepare_pf(81, inputs_2d, inputs_3d_p)
-                inputs_2d_flip, _ = eval_data_prepare_pf(81, inputs_2d_flip, inputs_3d_p)
-            else:
-                inputs_2d, inputs_3d = eval_data_prepare(receptive_field, inputs_2d, inputs_3d_p)
-                inputs_2d_flip, _ = eval_data_prepare(receptive_field, inputs_2d_flip, inputs_3d_p)
-
-            if torch.cuda.is_available():
-                inputs_2d = inputs_2d.cuda()
-                inputs_2d_flip = inputs_2d_flip.cuda()
-                inputs_3d = inputs_3d.cuda()
-                b = inputs_3d.shape[0]
-                cam = cam.cuda()
-                cam = cam.repeat(b,1)
-            
-            inputs_traj = inputs_3d[:, :, :1].clone()
-            inputs_3d[:, :, 0] = 0
-            
-            predicted_3d_pos = model_eval(inputs_2d)
-            predicted_3d_pos_flip = model_eval(inputs_2d_flip)
-            predicted_3d_pos_flip[:, :, :, 0] *= -1
-            predicted_3d_pos_flip[:, :, joints_left + joints_right] = predicted_3d_pos_flip[:, :,
-                                                                    joints_right + joints_left]
-            for i in range(predicted_3d_pos.shape[0]):
-                predicted_3d_pos[i,:,:,:] = (predicted_3d_pos[i,:,:,:] + predicted_3d_pos_flip[i,:,:,:])/2
-            predicted_3d_pos[:, :, 0] = 0
-            pred_root, residuals = get_root(predicted_3d_pos, inputs_2d, cam)
-            
-            # gt_2d = project_to_2d_linear(inputs_3d + inputs_traj, cam)
-            # pred_2d = project_to_2d_linear(predicted_3d_pos + pred_root, cam)
-            # best_2d = project_to_2d_linear(predicted_3d_pos + inputs_traj, cam)
-            # predicted_3d_pos, pred_root, pred_2d = refine_pose(predicted_3d_pos, pred_2d, cam)
-            # torch.set_printoptions(sci_mode=False, precision=6)
-            # print((gt_2d[2,0] - pred_2d[2,0]) * 1000)
-            # print(residuals[2,0] * 1000)
-            # print((inputs_traj[2,0] - pred_root[2,0]) * 1000)
-
-            # print(f"{'MPJPE:':<10} {mpjpe(predicted_3d_pos, inputs_3d).item() * 1000:.2f}")
-            # print(f"{'MRPE:':<10} {mpjpe(pred_root, inputs_traj).item() * 1000:.2f}")
-            # print(f"{'Original:':<10} {mpjpe(inputs_2d, gt_2d).item() * 1000:.2f}")
-            # print(f"{'Refined:':<10} {mpjpe(pred_2d, gt_2d).item() * 1000 - mpjpe(inputs_2d, gt_2d).item() * 1000:.2f}")
-            # print(f"{'Best:':<10} {mpjpe(best_2d, gt_2d).item() * 1000 - mpjpe(inputs_2d, gt_2d).item() * 1000:.2f}")
-            # print(f"{'Changed:':<10} {mpjpe(inputs_2d, pred_2d).item() * 1000:.2f}")
-            # print('----------')
-            # exit()
-
-            if return_predictions:
-                return predicted_3d_pos.squeeze().cpu().numpy()
-            
-
-            error = mpjpe(predicted_3d_pos, inputs_3d)
-
-            epoch_loss_3d_pos_scale += inputs_3d.shape[0]*inputs_3d.shape[1] * mpjpe(predicted_3d_pos + pred_root, inputs_3d + inputs_traj).item()
-            epoch_mrpe += inputs_3d.shape[0]*inputs_3d.shape[1] * mpjpe(pred_root, inputs_traj).item()
-
-            epoch_loss_3d_pos += inputs_3d.shape[0]*inputs_3d.shape[1] * error.item()
-            N += inputs_3d.shape[0] * inputs_3d.shape[1]
-
-            inputs = inputs_3d.cpu().numpy().reshape(-1, inputs_3d.shape[-2], inputs_3d.shape[-1])
-            predicted_3d_pos = predicted_3d_pos.cpu().numpy().reshape(-1, inputs_3d.shape[-2], inputs_3d.shape[-1])
-
-            epoch_loss_3d_pos_procrustes += inputs_3d.shape[0]*inputs_3d.shape[1] * p_mpjpe(predicted_3d_pos, inputs)
-
-            # Compute velocity error
-            epoch_loss_3d_vel += inputs_3d.shape[0]*inputs_3d.shape[1] * mean_velocity_error(predicted_3d_pos, inputs)
+def print_errors(errors, action=None):
     if action is None:
         print('----------')
     else:
         print('----'+action+'----')
-    e1 = (epoch_loss_3d_pos / N)*1000
-    e2 = (epoch_loss_3d_pos_procrustes / N)*1000
-    e3 = (epoch_loss_3d_pos_scale / N)*1000
-    e4 = (epoch_mrpe / N)*1000
-    ev = (epoch_loss_3d_vel / N)*1000
-    print('Test time augmentation:', test_generator.augment_enabled())
+    e1 = errors.result('mpjpe', action)*1000
+    e2 = errors.result('p_mpjpe', action)*1000
+    e3 = errors.result('abs_mpjpe', action)*1000
+    e4 = errors.result('mrpe', action)*1000
+    ev = errors.result('mpjve', action)*1000
+    print('Test time augmentation:', args.test_time_augmentation)
     print(f'Protocol #1 Error (MPJPE)    :', f'{e1:.1f}', 'mm')
     print(f'Protocol #2 Error (Abs-MPJPE):', f'{e3:.1f}', 'mm')
     print(f'Protocol #3 Error (MRPE)     :', f'{e4:.1f}', 'mm')
@@ -451,8 +282,6 @@ def evaluate(test_generator, action=None, return_predictions=False, use_trajecto
     return e1, e2, e3, e4, ev
 
 
-
-
 print('Evaluating...')
 all_actions = {}
 all_actions_by_subject = {}
@@ -473,11 +302,13 @@ def fetch_actions(actions):
     out_poses_3d = []
     out_poses_2d = []
     out_camera_params = []
+    out_actions = []
 
     for subject, action in actions:
         poses_2d = keypoints[subject][action]
         for i in range(len(poses_2d)): # Iterate across cameras
             out_poses_2d.append(poses_2d[i])
+            out_actions.append(action.split(' ')[0])
 
         poses_3d = dataset[subject][action]['positions_3d']
         assert len(poses_3d) == len(poses_2d), 'Camera count mismatch'
@@ -500,7 +331,7 @@ def fetch_actions(actions):
             if out_poses_3d is not None:
                 out_poses_3d[i] = out_poses_3d[i][::stride]
 
-    return out_camera_params ,out_poses_3d, out_poses_2d
+    return out_camera_params ,out_poses_3d, out_poses_2d, out_actions
 
 def run_evaluation(actions, action_filter=None):
     errors_p1 = []
@@ -510,6 +341,8 @@ def run_evaluation(actions, action_filter=None):
     errors_vel = []
     # joints_errs_list=[]
 
+    # All selected actions are evaluated in one pass, with windows of different sequences packed together
+    selected = []
     for action_key in actions.keys():
         # action_key = 'SittingDown' # 제일 루트 안 좋은 예
         # action_key = 'Greeting' # p2d가 제일 안 좋은 예
@@ -521,13 +354,16 @@ def run_evaluation(actions, action_filter=None):
                     break
             if not found:
                 continue
+        selected += actions[action_key]
+
+    cams_act, poses_act, poses_2d_act, actions_act = fetch_actions(selected)
+    gen = PackedGenerator_Seq(args.eval_batch_size, cams_act, poses_act, poses_2d_act, receptive_field, actions=actions_act)
+    model_pos.eval()
+    errors = evaluate_actions(gen, model_pos, root_solver, device, pose_flip, zero_root=True, procrustes=True,
+                              absolute=True)
 
-        cams_act ,poses_act, poses_2d_act = fetch_actions(actions[action_key])
-        gen = UnchunkedGenerator_Seq(cams_act, poses_act, poses_2d_act,
-                                pad=pad, causal_shift=causal_shift, augment=args.test_time_augmentation,
-                                kps_left=kps_left, kps_right=kps_right, joints_left=joints_left,
-                                joints_right=joints_right)
-        e1, e2, e3, e4, ev = evaluate(gen, action_key)
+    for action_key in errors.action_names():
+        e1, e2, e3, e4, ev = print_errors(errors, action_key)
         
         # joints_errs_list.append(joints_errs)
 
@@ -22,6 +22,8 @@ from timm.models.registry import register_model
 from model.rela import RectifiedLinearAttention
 from model.routing_transformer import KmeansAttention
 from model.linearattention import LinearMultiheadAttention
+from common.bones import H36M_BONES
+from common.loss import change_bone_length
 
 import torch
 import torch.nn as nn
@@ -1121,7 +1123,7 @@ class  CSTE(nn.Module):
 class  MixSTE_seperate(nn.Module):
     def __init__(self, num_frame=9, num_joints=17, in_chans=2, embed_dim_ratio=32, depth=4,
                  num_heads=8, mlp_ratio=2., qkv_bias=True, qk_scale=None,
-                 drop_rate=0., attn_drop_rate=0., drop_path_rate=0.2,  norm_layer=None):
+                 drop_rate=0., attn_drop_rate=0., drop_path_rate=0.2,  norm_layer=None, bones=None):
         """    ##########hybrid_backbone=None, representation_size=None,
         Args:
             num_frame (int, tuple): input frame number
@@ -1137,8 +1139,10 @@ class  MixSTE_seperate(nn.Module):
             attn_drop_rate (float): attention dropout rate
             drop_path_rate (float): stochastic depth rate
             norm_layer: (nn.Module): normalization layer
+            bones (BoneGeometry): skeleton of the bone lengths (default: 17-joint Human3.6M)
         """
         super().__init__()
+        self.bones = bones if bones is not None else H36M_BONES
 
         norm_layer = norm_layer or partial(nn.LayerNorm, eps=1e-6)
         embed_dim = embed_dim_ratio   #### temporal embed_dim is num_joints * spatial embedding dim ratio
@@ -1186,7 +1190,7 @@ class  MixSTE_seperate(nn.Module):
         )
         self.head_bone = nn.Sequential(
             nn.LayerNorm(embed_dim * num_joints),
-            nn.Linear(embed_dim * num_joints, 16),
+            nn.Linear(embed_dim * num_joints, self.bones.num_bones),
         )
         # nn.init.kaiming_normal_(self.head[1].weight)
         # torch.nn.init.xavier_uniform_(self.head[1].weight)
@@ -1255,23 +1259,10 @@ class  MixSTE_seperate(nn.Module):
         return x
 
     def change_bone_length(self, p3d, bone_length):
-        index = [[0,1],[1,2],[2,3],[0,4],[4,5],[5,6],[0,7],[7,8],[8,9],[9,10],[8,11],[11,12],[12,13],[8,14], [14,15],[15,16]]
-        bone = []
-        for i in index:
-            bone.append((p3d[:, :, i[1]] - p3d[:, :, i[0]]) / torch.max(torch.linalg.norm(p3d[:, :, i[1]] - p3d[:, :, i[0]], axis=-1, keepdims=True), torch.tensor([1e-6]).cuda()))
-        
-        for i in range(len(index)):
-            p3d[:, :, index[i][1]] = p3d[:, :, index[i][0]] + bone[i] * bone_length[:, None, i, None]
-
-        return p3d
+        return self.bones.retarget(p3d, bone_length[:, None])[0]
     
     def get_bone_length(self, p3d):
-        index = [[0,1],[1,2],[2,3],[0,4],[4,5],[5,6],[0,7],[7,8],[8,9],[9,10],[8,11],[11,12],[12,13],[8,14], [14,15],[15,16]]
-        bone = []
-        for i in index:
-            bone.append(torch.linalg.norm(p3d[:, :, i[1]] - p3d[:, :, i[0]], axis=-1))
-        bone = torch.stack(bone, axis=-1)
-        return bone
+        return self.bones.lengths(p3d)
 
     def forward(self, x):
         b, f, n, c = x.shape
@@ -1306,7 +1297,7 @@ class  MixSTE_seperate(nn.Module):
 class  MixSTE_conf(nn.Module):
     def __init__(self, num_frame=9, num_joints=17, in_chans=2, embed_dim_ratio=32, depth=4,
                  num_heads=8, mlp_ratio=2., qkv_bias=True, qk_scale=None,
-                 drop_rate=0., attn_drop_rate=0., drop_path_rate=0.2,  norm_layer=None):
+                 drop_rate=0., attn_drop_rate=0., drop_path_rate=0.2,  norm_layer=None, bones=None):
         """    ##########hybrid_backbone=None, representation_size=None,
         Args:
             num_frame (int, tuple): input frame number
@@ -1322,8 +1313,10 @@ class  MixSTE_conf(nn.Module):
             attn_drop_rate (float): attention dropout rate
             drop_path_rate (float): stochastic depth rate
             norm_layer: (nn.Module): normalization layer
+            bones (BoneGeometry): skeleton of the bone lengths (default: 17-joint Human3.6M)
         """
         super().__init__()
+        self.bones = bones if bones is not None else H36M_BONES
 
         norm_layer = norm_layer or partial(nn.LayerNorm, eps=1e-6)
         embed_dim = embed_dim_ratio   #### temporal embed_dim is num_joints * spatial embedding dim ratio
@@ -1448,14 +1441,12 @@ class  MixSTE_conf(nn.Module):
         x_b = self.Temporal_norm(x_b)
         x_b = rearrange(x_b, '(b n) f cw -> b f n cw', n=n)
 
-        bone = torch.clamp(nn.Softplus()(self.head_bone(x_b.clone())[:,:,1:,0]), min=1e-6)
-        bone_conf = nn.Softmax(dim = 1)(self.head_bone_conf(x_b)[:,:,1:,0])
+        # one bone per child joint
+        bone = torch.clamp(nn.Softplus()(self.head_bone(x_b.clone())[:,:,self.bones.child,0]), min=1e-6)
+        bone_conf = nn.Softmax(dim = 1)(self.head_bone_conf(x_b)[:,:,self.bones.child,0])
 
         bone = (bone * bone_conf).mean(dim = 1, keepdim=True)
-        bone[..., :3] = bone[..., 3:6] / 2 + bone[..., :3] / 2
-        bone[..., 10:13] = bone[..., 13:16] / 2 + bone[..., 10:13] / 2
-        bone[..., 3:6] = bone[..., :3] * 1
-        bone[..., 13:16] = bone[..., 10:13] * 1
+        bone = self.bones.symmetrize(bone)
 
         x, conf = self.change_bone_length(x_j, bone)
         x = x.view(b, f, n, -1)
@@ -1466,26 +1457,10 @@ class  MixSTE_conf(nn.Module):
 
 
     def change_bone_length(self, p3d, bone_length):
-        index = [[0,1],[1,2],[2,3],[0,4],[4,5],[5,6],[0,7],[7,8],[8,9],[9,10],[8,11],[11,12],[12,13],[8,14], [14,15],[15,16]]
-        bone = []
-        conf = []
-        for i in index:
-            conf.append(torch.max(torch.linalg.norm(p3d[:, :, i[1]] - p3d[:, :, i[0]], axis=-1, keepdims=True), torch.tensor([1e-6]).cuda()))
-            bone.append((p3d[:, :, i[1]] - p3d[:, :, i[0]]) / conf[-1])
-        
-        for i in range(len(index)):
-            p3d[:, :, index[i][1]] = p3d[:, :, index[i][0]] + bone[i] * bone_length[:, :, i, None]
-        conf = nn.Sigmoid()(torch.stack(conf, axis=-1).permute(0, 1, 3, 2))
-        conf = torch.cat([torch.ones_like(conf[:, :, :1]), conf], dim=-2)
-        return p3d, conf
+        return change_bone_length(p3d, bone_length, self.bones)
     
     def get_bone_length(self, p3d):
-        index = [[0,1],[1,2],[2,3],[0,4],[4,5],[5,6],[0,7],[7,8],[8,9],[9,10],[8,11],[11,12],[12,13],[8,14], [14,15],[15,16]]
-        bone = []
-        for i in index:
-            bone.append(torch.linalg.norm(p3d[:, :, i[1]] - p3d[:, :, i[0]], axis=-1))
-        bone = torch.stack(bone, axis=-1)
-        return bone
+        return self.bones.lengths(p3d)
 
     def forward(self, x):
         b, f, n, c = x.shape
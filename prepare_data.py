@@ -0,0 +1,31 @@
+# command:
+# python prepare_data.py -d h36m -k cpn_ft_h36m_dbb
+# then pass --prepared-data data/prepared_h36m_cpn_ft_h36m_dbb to run.py / evaluate.py
+
+from common.arguments import parse_args
+from common.prepared_dataset import prepare_data, write_prepared
+
+args = parse_args()
+
+output_path = args.prepared_data if args.prepared_data else 'data/prepared_' + args.dataset + '_' + args.keypoints
+keypoints_path = 'data/data_2d_' + args.dataset + '_' + args.keypoints + '.npz'
+
+print('Loading dataset...')
+dataset_path = 'data/data_3d_' + args.dataset + '.npz'
+if args.dataset == 'h36m':
+    from common.h36m_dataset import Human36mDataset
+    dataset = Human36mDataset(dataset_path)
+elif args.dataset.startswith('humaneva'):
+    from common.humaneva_dataset import HumanEvaDataset
+    dataset = HumanEvaDataset(dataset_path)
+elif args.dataset.startswith('custom'):
+    from common.custom_dataset import CustomDataset
+    dataset = CustomDataset(keypoints_path)
+else:
+    raise KeyError('Invalid dataset')
+
+print('Preparing data...')
+keypoints, keypoints_metadata = prepare_data(dataset, keypoints_path)
+
+print('Writing prepared dataset to', output_path)
+write_prepared(output_path, dataset, keypoints, keypoints_metadata)
@@ -19,6 +19,7 @@ import os
 import sys
 import errno
 import math
+import inspect
 from einops import rearrange, repeat
 from copy import deepcopy
 from collections import defaultdict
@@ -30,18 +31,26 @@ from model.stcformer import STCFormer
 from common.skeleton import *
 
 from common.loss import *
-from common.generators import ChunkedGenerator_Seq, UnchunkedGenerator_Seq
+from common.generators import ChunkedGenerator_Seq, UnchunkedGenerator_Seq, PackedGenerator_Seq
 from common.chunk_dataset import *
 from time import time
 from common.utils import *
 from common.logging import Logger
+from common.prepared_dataset import prepare_data
+from common.bones import BoneGeometry
+from common.augmentation import PoseFlip, FlipTTA
+from common.windows import sliding_windows, merge_windows, window_index
+from common.metrics import RunningMetrics
+from common.evaluation import evaluate_actions, epoch_summary, AsyncEvaluator
+from common.distributed import setup_distributed
+from common.checkpoint import CheckpointManager, load_checkpoint, to_cpu
 from model.load_model import load_model
 # from model.PoseMamba import PoseMamba
 from torch.utils.tensorboard import SummaryWriter
 from datetime import datetime
 from progress.bar import Bar
 from torch.nn.parallel import DistributedDataParallel as DDP
-from torch.utils.data import DataLoader, DistributedSampler
+from torch.utils.data import DataLoader, DistributedSampler, BatchSampler
 import torch.distributed as dist
 import torch.multiprocessing as mp
 import wandb
@@ -70,8 +79,9 @@ elif args.evaluate == '':
     description = "Train!"
 def main():
 
-    dist.init_process_group("nccl")
-    rank = dist.get_rank()
+    # the asynchronous evaluation worker gets cores of its own on the CPU
+    reserve = args.async_eval_cores if args.async_eval and not args.no_eval and not args.evaluate else 0
+    rank, world_size, device, eval_cores = setup_distributed(args.threads, reserve)
     
     # initial setting
     TIMESTAMP = "{0:%Y%m%dT%H-%M-%S/}".format(datetime.now())
@@ -86,9 +96,9 @@ def main():
             sys.stdout = Logger(logfile)
         print(description)
         print('python ' + ' '.join(sys.argv))
-        print("CUDA Device Count: ", torch.cuda.device_count())
+        print('INFO: {} rank(s) on {}, backend {}, {} intra-op threads'.format(
+            world_size, device, dist.get_backend(), torch.get_num_threads()))
         print(args)
-    world_num = torch.cuda.device_count()
 
     # if not assign checkpoint path, Save checkpoint file into log folder
     if args.checkpoint=='':
@@ -104,6 +114,9 @@ def main():
     if rank == 0:
         print('Loading dataset...')
     dataset_path = 'data/data_3d_' + args.dataset + '.npz'
+    keypoints_path = 'data/data_2d_' + args.dataset + '_' + args.keypoints + '.npz'
+    if args.prepared_data:
+        dataset_path = keypoints_path = args.prepared_data
     if args.dataset == 'h36m':
         from common.h36m_dataset import Human36mDataset
         dataset = Human36mDataset(dataset_path)
@@ -112,58 +125,21 @@ def main():
         dataset = HumanEvaDataset(dataset_path)
     elif args.dataset.startswith('custom'):
         from common.custom_dataset import CustomDataset
-        dataset = CustomDataset('data/data_2d_' + args.dataset + '_' + args.keypoints + '.npz')
+        dataset = CustomDataset(keypoints_path)
     else:
         raise KeyError('Invalid dataset')
-    if rank == 0:
-        print('Preparing data...')
-    for subject in dataset.subjects():
-        for action in dataset[subject].keys():
-            anim = dataset[subject][action]
-
-            if 'positions' in anim:
-                positions_3d = []
-                for cam in anim['cameras']:
-                    pos_3d = world_to_camera(anim['positions'], R=cam['orientation'], t=cam['translation'])
-                    pos_3d[:, 1:] -= pos_3d[:, :1] # Remove global offset, but keep trajectory in first position
-                    positions_3d.append(pos_3d)
-                anim['positions_3d'] = positions_3d
-    if rank == 0:
-        print('Loading 2D detections...')
-    keypoints = np.load('data/data_2d_' + args.dataset + '_' + args.keypoints + '.npz', allow_pickle=True)
-    keypoints_metadata = keypoints['metadata'].item()
+    if dataset.prepared():
+        keypoints, keypoints_metadata = dataset.keypoints(), dataset.keypoints_metadata()
+    else:
+        if rank == 0:
+            print('Preparing data...')
+        keypoints, keypoints_metadata = prepare_data(dataset, keypoints_path)
     keypoints_symmetry = keypoints_metadata['keypoints_symmetry']
     kps_left, kps_right = list(keypoints_symmetry[0]), list(keypoints_symmetry[1])
     joints_left, joints_right = list(dataset.skeleton().joints_left()), list(dataset.skeleton().joints_right())
-    keypoints = keypoints['positions_2d'].item()
-
-    ###################
-    for subject in dataset.subjects():
-        assert subject in keypoints, 'Subject {} is missing from the 2D detections dataset'.format(subject)
-        for action in dataset[subject].keys():
-            assert action in keypoints[subject], 'Action {} of subject {} is missing from the 2D detections dataset'.format(action, subject)
-            if 'positions_3d' not in dataset[subject][action]:
-                continue
-
-            for cam_idx in range(len(keypoints[subject][action])):
-
-                # We check for >= instead of == because some videos in H3.6M contain extra frames
-                mocap_length = dataset[subject][action]['positions_3d'][cam_idx].shape[0]
-                assert keypoints[subject][action][cam_idx].shape[0] >= mocap_length
-
-                if keypoints[subject][action][cam_idx].shape[0] > mocap_length:
-                    # Shorten sequence
-                    keypoints[subject][action][cam_idx] = keypoints[subject][action][cam_idx][:mocap_length]
-
-            assert len(keypoints[subject][action]) == len(dataset[subject][action]['positions_3d'])
-
-    for subject in keypoints.keys():
-        for action in keypoints[subject]:
-            for cam_idx, kps in enumerate(keypoints[subject][action]):
-                # Normalize camera frame
-                cam = dataset.cameras()[subject][cam_idx]
-                kps[..., :2] = normalize_screen_coordinates(kps[..., :2], w=cam['res_w'], h=cam['res_h'])
-                keypoints[subject][action][cam_idx] = kps
+    pose_flip = PoseFlip.from_metadata(keypoints_metadata, dataset.skeleton())
+    bones = BoneGeometry.from_skeleton(dataset.skeleton())
+    root_solver = get_root_solver(args.root_solver, args.root_refine)
 
     subjects_train = args.subjects_train.split(',')
     subjects_semi = [] if not args.subjects_unlabeled else args.subjects_unlabeled.split(',')
@@ -263,8 +239,7 @@ def main():
         writer.add_text(args.log+'_'+TIMESTAMP + '/Receptive field', str(receptive_field))
     pad = (receptive_field -1) // 2 # Padding on each side
     min_loss = args.min_loss
-    width = cam['res_w']
-    height = cam['res_h']
+    min_root = 100
     num_joints = keypoints_metadata['num_joints']
 
     #########################################PoseTransformer
@@ -276,11 +251,14 @@ def main():
         model_pos = STCFormer()
     else:
         try:
-            model_pos_train =  eval(args.model)(num_frame=receptive_field, num_joints=num_joints, in_chans=2, embed_dim_ratio=args.cs, depth=args.dep,
-                num_heads=8, mlp_ratio=2., qkv_bias=True, qk_scale=None,drop_path_rate=0.1)
-
-            model_pos =  eval(args.model)(num_frame=receptive_field, num_joints=num_joints, in_chans=2, embed_dim_ratio=args.cs, depth=args.dep,
-                    num_heads=8, mlp_ratio=2., qkv_bias=True, qk_scale=None,drop_path_rate=0)
+            model_class = eval(args.model)
+            # models with a bone-length head take the geometry of the dataset skeleton
+            model_kwargs = {'bones': bones} if 'bones' in inspect.signature(model_class).parameters else {}
+            model_pos_train =  model_class(num_frame=receptive_field, num_joints=num_joints, in_chans=2, embed_dim_ratio=args.cs, depth=args.dep,
+                num_heads=8, mlp_ratio=2., qkv_bias=True, qk_scale=None,drop_path_rate=0.1, **model_kwargs)
+
+            model_pos =  model_class(num_frame=receptive_field, num_joints=num_joints, in_chans=2, embed_dim_ratio=args.cs, depth=args.dep,
+                    num_heads=8, mlp_ratio=2., qkv_bias=True, qk_scale=None,drop_path_rate=0, **model_kwargs)
         except:
             raise Exception("Undefined model name")
 
@@ -302,24 +280,22 @@ def main():
 
     wandb_id = args.wandb_id if args.wandb_id != '' else wandb.util.generate_id()
     # make model parallel
-    if torch.cuda.is_available():
-        torch.cuda.set_device(rank)
-        model_pos = nn.DataParallel(model_pos)
-        model_pos = model_pos.cuda()
-        
-        model_pos_train = model_pos_train.to(rank)
-        model_pos_train = DDP(model_pos_train, device_ids=[rank])
+    # without GPUs DataParallel only adds the 'module.' prefix shared with the DDP checkpoints
+    model_pos = nn.DataParallel(model_pos)
+    model_pos = model_pos.to(device)
+
+    model_pos_train = model_pos_train.to(device)
+    model_pos_train = DDP(model_pos_train, device_ids=[device.index] if device.type == 'cuda' else None)
 
     if args.resume or args.evaluate:
         chk_filename = os.path.join(args.checkpoint, args.resume if args.resume else args.evaluate)
         chk_filename = "checkpoint/" + chk_filename
-        checkpoint = torch.load(chk_filename, map_location=lambda storage, loc: storage)
+        checkpoint = load_checkpoint(chk_filename, optimizer=bool(args.resume))
         # chk_filename = args.resume or args.evaluate
         model_pos_train.load_state_dict(checkpoint['model_pos'], strict=False)
         model_pos.load_state_dict(checkpoint['model_pos'], strict=False)
         wandb_id = checkpoint['wandb_id'] if 'wandb_id' in checkpoint else wandb_id
         min_loss = checkpoint['min_loss'] if 'min_loss' in checkpoint else min_loss
-        min_root = 100
         if rank == 0:
             print('Loading checkpoint', chk_filename)
             print('This model was trained for {} epochs'.format(checkpoint['epoch']))
@@ -339,61 +315,19 @@ def main():
         config=args
         )
 
-    test_generator = UnchunkedGenerator_Seq(cameras_valid, poses_valid, poses_valid_2d, actions_valid, 
-                                        pad=pad, causal_shift=causal_shift, augment=False,
-                                        kps_left=kps_left, kps_right=kps_right, joints_left=joints_left, joints_right=joints_right)
+    # the windows of the end-of-epoch evaluation are sharded over the ranks (see common.evaluation)
+    test_generator = PackedGenerator_Seq(args.eval_batch_size, cameras_valid, poses_valid, poses_valid_2d, receptive_field,
+                                         actions=actions_valid, rank=rank, num_replicas=world_size)
     if rank == 0:
         print('INFO: Testing on {} frames'.format(test_generator.num_frames()))
     if not args.nolog and rank == 0:
         writer.add_text(args.log+'_'+TIMESTAMP + '/Testing Frames', str(test_generator.num_frames()))
 
-    def eval_data_prepare(receptive_field, inputs_2d, inputs_3d):
-        # inputs_2d_p = torch.squeeze(inputs_2d)
-        # inputs_3d_p = inputs_3d.permute(1,0,2,3)
-        # out_num = inputs_2d_p.shape[0] - receptive_field + 1
-        # eval_input_2d = torch.empty(out_num, receptive_field, inputs_2d_p.shape[1], inputs_2d_p.shape[2])
-        # for i in range(out_num):
-        #     eval_input_2d[i,:,:,:] = inputs_2d_p[i:i+receptive_field, :, :]
-        # return eval_input_2d, inputs_3d_p
-        ### split into (f/f1, f1, n, 2)
-        assert inputs_2d.shape[:-1] == inputs_3d.shape[:-1], "2d and 3d inputs shape must be same! "+str(inputs_2d.shape)+str(inputs_3d.shape)
-        inputs_2d_p = torch.squeeze(inputs_2d)
-        inputs_3d_p = torch.squeeze(inputs_3d)
-
-        if inputs_2d_p.shape[0] / receptive_field > inputs_2d_p.shape[0] // receptive_field: 
-            out_num = inputs_2d_p.shape[0] // receptive_field+1
-        elif inputs_2d_p.shape[0] / receptive_field == inputs_2d_p.shape[0] // receptive_field:
-            out_num = inputs_2d_p.shape[0] // receptive_field
-
-        eval_input_2d = torch.empty(out_num, receptive_field, inputs_2d_p.shape[1], inputs_2d_p.shape[2])
-        eval_input_3d = torch.empty(out_num, receptive_field, inputs_3d_p.shape[1], inputs_3d_p.shape[2])
-
-        for i in range(out_num-1):
-            eval_input_2d[i,:,:,:] = inputs_2d_p[i*receptive_field:i*receptive_field+receptive_field,:,:]
-            eval_input_3d[i,:,:,:] = inputs_3d_p[i*receptive_field:i*receptive_field+receptive_field,:,:]
-        if inputs_2d_p.shape[0] < receptive_field:
-            from torch.nn import functional as F
-            pad_right = receptive_field-inputs_2d_p.shape[0]
-            inputs_2d_p = rearrange(inputs_2d_p, 'b f c -> f c b')
-            inputs_2d_p = F.pad(inputs_2d_p, (0,pad_right), mode='replicate')
-            # inputs_2d_p = np.pad(inputs_2d_p, ((0, receptive_field-inputs_2d_p.shape[0]), (0, 0), (0, 0)), 'edge')
-            inputs_2d_p = rearrange(inputs_2d_p, 'f c b -> b f c')
-        if inputs_3d_p.shape[0] < receptive_field:
-            pad_right = receptive_field-inputs_3d_p.shape[0]
-            inputs_3d_p = rearrange(inputs_3d_p, 'b f c -> f c b')
-            inputs_3d_p = F.pad(inputs_3d_p, (0,pad_right), mode='replicate')
-            inputs_3d_p = rearrange(inputs_3d_p, 'f c b -> b f c')
-        eval_input_2d[-1,:,:,:] = inputs_2d_p[-receptive_field:,:,:]
-        eval_input_3d[-1,:,:,:] = inputs_3d_p[-receptive_field:,:,:]
-
-        return eval_input_2d, eval_input_3d
-
-
     ###################
 
     # Training start
     if not args.evaluate:
-        cameras_train, poses_train, poses_train_2d, _ = fetch(subjects_train, action_filter, subset=args.subset)
+        cameras_train, poses_train, poses_train_2d, actions_train = fetch(subjects_train, action_filter, subset=args.subset)
 
         lr = args.learning_rate
         optimizer = optim.AdamW(model_pos_train.parameters(), lr=lr, weight_decay=0.1)
@@ -411,15 +345,74 @@ def main():
         train_dataset = ChunkedDataset_Seq(cameras_train, poses_train, poses_train_2d, args.number_of_frames, args.stride,
                                         pad=pad, causal_shift=causal_shift, shuffle=False, augment=args.data_augmentation,
                                         kps_left=kps_left, kps_right=kps_right, joints_left=joints_left, joints_right=joints_right)
-        sampler = DistributedSampler(train_dataset, num_replicas=torch.cuda.device_count(),rank=rank, shuffle=True)
-        dataloader = DataLoader(train_dataset,sampler=sampler, batch_size=args.batch_size, num_workers=8)
-        train_generator_eval = UnchunkedGenerator_Seq(cameras_train, poses_train, poses_train_2d,
-                                                pad=pad, causal_shift=causal_shift, augment=False)
+        # one copy of the buffers for all DataLoader workers (a no-op for the memory-mapped prepared store)
+        train_dataset.share_memory()
+        sampler = DistributedSampler(train_dataset, num_replicas=world_size, rank=rank, shuffle=True)
+        # the dataset gathers whole batches at once (ChunkedDataset_Seq.get_batch), so batching happens in the sampler
+        dataloader = DataLoader(train_dataset, sampler=BatchSampler(sampler, args.batch_size, drop_last=False),
+                                batch_size=None, num_workers=8)
+        # MPJPE(Train) is estimated on a fixed stratified sample of --train-eval-windows windows per action (0: all)
+        train_generator_eval = PackedGenerator_Seq(args.eval_batch_size, cameras_train, poses_train, poses_train_2d, receptive_field,
+                                                   actions=actions_train, per_action=args.train_eval_windows,
+                                                   rank=rank, num_replicas=world_size)
         if rank == 0:
             print('INFO: Training on {} frames'.format(train_generator_eval.num_frames()))
+            print('INFO: Evaluating the training set on {} of {} windows, every {} epoch(s)'.format(
+                len(train_generator_eval.sample_seq), train_generator_eval.strata_sizes.sum(), args.train_eval_interval))
         if not args.nolog and rank == 0:
             writer.add_text(args.log+'_'+TIMESTAMP + '/Training Frames', str(train_generator_eval.num_frames()))
 
+        if rank == 0:
+            checkpoints = CheckpointManager("checkpoint/" + args.checkpoint, keep=args.keep_checkpoints)
+
+        # end-of-epoch evaluation in a process of its own, on whole (not sharded) sets
+        async_eval = args.async_eval and not args.no_eval
+        if async_eval and rank == 0:
+            evaluator = AsyncEvaluator(
+                deepcopy(model_pos.module).cpu(),
+                PackedGenerator_Seq(args.eval_batch_size, cameras_valid, poses_valid, poses_valid_2d, receptive_field,
+                                    actions=actions_valid),
+                PackedGenerator_Seq(args.eval_batch_size, cameras_train, poses_train, poses_train_2d, receptive_field,
+                                    actions=actions_train, per_action=args.train_eval_windows),
+                pose_flip, args.root_solver, args.root_refine, device,
+                min_loss=min_loss, min_root=min_root, cores=eval_cores)
+            # snapshot and optimizer state of every submitted epoch, until its evaluation is back
+            pending_snapshots = {}
+
+        def train_eval_text(summary):
+            if 'train_eval' not in summary:
+                return "MPJPE(Train) -"
+            if summary['train_eval_ci'] > 0:
+                return f"MPJPE(Train) {summary['train_eval'] * 1000:.1f}±{summary['train_eval_ci'] * 1000:.1f}mm"
+            return f"MPJPE(Train) {summary['train_eval'] * 1000:.1f}mm"
+
+        def report_evaluation(eval_epoch, summary, best_loss, best):
+            """
+            Log the numbers of an asynchronous evaluation and save the snapshot as the best checkpoints it
+            earned (with its optimizer state, like the synchronous evaluation), returns the best MPJPE so far
+            """
+            print(f"[{eval_epoch}] (async eval) "
+                  f"{train_eval_text(summary)} "
+                  f"MPJPE(Test) {summary['valid'] * 1000:.1f}mm "
+                  f"MRPE(Test) {summary['valid_root'] * 1000:.1f}mm "
+                  f"MPJVE(Test){summary['valid_velocity'] * 1000:.2f}mm")
+            snapshot, optimizer_state = pending_snapshots.pop(eval_epoch)
+            if best:
+                print("save best checkpoint", ', '.join(best))
+                checkpoints.save(eval_epoch, best, snapshot['model_pos'], optimizer_state,
+                                 lr=snapshot['lr'], min_loss=best_loss, wandb_id=wandb_id)
+            log = {"3d_valid": summary['valid'] * 1000, "3d_val_velocity": summary['valid_velocity'] * 1000, "eval_epoch": eval_epoch}
+            if 'train_eval' in summary:
+                losses_3d_train_eval.append(summary['train_eval'])
+                log["3d_train_eval"] = summary['train_eval'] * 1000
+            if not args.nolog:
+                if 'train_eval' in summary:
+                    writer.add_scalar("Loss/3d training eval loss", summary['train_eval'] * 1000, eval_epoch)
+                writer.add_scalar("Loss/3d validation loss", summary['valid'] * 1000, eval_epoch)
+                # wandb steps only increase, so the evaluated epoch goes with the next training step
+                wandb.log(log, commit=False)
+            return best_loss
+
         if args.resume:
             epoch = checkpoint['epoch']
             if 'optimizer' in checkpoint and checkpoint['optimizer'] is not None:
@@ -437,21 +430,27 @@ def main():
             print('** Note: reported losses are averaged over all frames.')
             print('** The final evaluation will be carried out after the last training epoch.')
 
+        ### weight mpjpe
+        if args.dataset=='h36m':
+            # # hrdet
+            # w_mpjpe = torch.tensor([1, 1, 2.5, 2.5, 1, 2.5, 2.5, 1, 1, 1.5, 1.5, 4, 4, 1.5, 4, 4])
+
+            w_mpjpe = torch.tensor([1, 1, 2.5, 2.5, 1, 2.5, 2.5, 1, 1, 1, 1.5, 1.5, 4, 4, 1.5, 4, 4])
+        elif args.dataset=='humaneva15':
+            w_mpjpe = torch.tensor([1, 1, 2.5, 2.5, 1, 2.5, 2.5, 1, 1.5, 1.5, 4, 4, 1.5, 4, 4])
+        w_mpjpe = w_mpjpe.to(device)
+
         # Pos model only
         while epoch < args.epochs:
             start_time = time()
-            epoch_loss_3d_train = 0
             epoch_loss_traj_train = 0
             epoch_loss_2d_train_unlabeled = 0
-            N = 0
             N_semi = 0
             model_pos_train.train()
 
             batch_time = AverageMeter()
             data_time = AverageMeter()
-            mpj = AverageMeter()
-            mpj_2d = AverageMeter()
-            root = AverageMeter()
+            train_metrics = RunningMetrics()
             end = time()
 
 
@@ -468,11 +467,10 @@ def main():
                 # inputs_3d = torch.from_numpy(batch_3d.astype('float32'))
                 # inputs_2d = torch.from_numpy(batch_2d.astype('float32'))
 
-                if torch.cuda.is_available():
-                    inputs_3d = inputs_3d.cuda()
-                    inputs_2d = inputs_2d.cuda()
-                    if cameras_train is not None:
-                        cameras_train = cameras_train.cuda()
+                inputs_3d = inputs_3d.to(device)
+                inputs_2d = inputs_2d.to(device)
+                if cameras_train is not None:
+                    cameras_train = cameras_train.to(device)
                 inputs_traj = inputs_3d[:, :, :1].clone()
                 inputs_3d[:, :, 0] = 0
                 optimizer.zero_grad()
@@ -481,10 +479,9 @@ def main():
                 predicted_3d_pos = model_pos_train(inputs_2d)
 
                 gt2d = project_to_2d_linear(inputs_3d + inputs_traj, cameras_train)
-                pred_traj, mask = get_root(predicted_3d_pos, inputs_2d, cameras_train)
+                pred_traj, mask = root_solver(predicted_3d_pos, inputs_2d, cameras_train)
                 
                 predicted_2d_pos = project_to_2d_linear(predicted_3d_pos + pred_traj, cameras_train)
-                # predicted_3d_pos ,pred_traj, predicted_2d_pos = refine_pose(predicted_3d_pos, inputs_2d, cameras_train, iterations=3)
 
 
                 # inputs_3d[:, :, :1] = inputs_traj
@@ -493,204 +490,89 @@ def main():
 
                 # del inputs_2d
                 # torch.cuda.empty_cache()
-                ### weight mpjpe
-                if args.dataset=='h36m':
-                    # # hrdet
-                    # w_mpjpe = torch.tensor([1, 1, 2.5, 2.5, 1, 2.5, 2.5, 1, 1, 1.5, 1.5, 4, 4, 1.5, 4, 4]).cuda()
-
-                    w_mpjpe = torch.tensor([1, 1, 2.5, 2.5, 1, 2.5, 2.5, 1, 1, 1, 1.5, 1.5, 4, 4, 1.5, 4, 4]).cuda()
-                
-                elif args.dataset=='humaneva15':
-                    w_mpjpe = torch.tensor([1, 1, 2.5, 2.5, 1, 2.5, 2.5, 1, 1.5, 1.5, 4, 4, 1.5, 4, 4]).cuda()
-
-                b, f , _, _ = inputs_3d.shape
-                loss_3d_pos = weighted_mpjpe(inputs_3d, predicted_3d_pos, w_mpjpe)
-                # loss_3d_pos = mpjpe(inputs_3d.reshape(b,f, -1), predicted_3d_pos.reshape(b,f, -1))
-
-                inputs_3d_masked = inputs_3d.clone()
-                inputs_3d_masked[mask] = 0
-                inputs_3d_masked[:, :, :1] = inputs_traj
-                predicted_3d_pos_masked = predicted_3d_pos.clone()
-                predicted_3d_pos_masked[mask] = 0
-                predicted_3d_pos_masked[:, :, :1] = pred_traj
-                gt2d_masked = gt2d.clone()
-                gt2d_masked[mask] = 0
-                predicted_2d_pos_masked = predicted_2d_pos.clone()
-                predicted_2d_pos_masked[mask] = 0
-
-                loss_3d_pos = weighted_mpjpe(inputs_3d_masked, predicted_3d_pos_masked, w_mpjpe)
-                inputs_2d_error = mpjpe(gt2d, inputs_2d)
-                loss_2d_pos = mpjpe(gt2d_masked, predicted_2d_pos_masked)
-                pose_2d_error = mpjpe(gt2d, predicted_2d_pos)
-                loss_root = mpjpe(inputs_traj, pred_traj)
-                loss_resid = mpjpe(inputs_traj, pred_traj)
-                loss_mpj = mpjpe(predicted_3d_pos - predicted_3d_pos[..., :1], inputs_3d - inputs_3d[..., :1])
-
-                # Temporal Consistency Loss
-                predicted_3d_pos[:, :, :1] = pred_traj
-                inputs_3d[:, :, :1] = inputs_traj
-                dif_seq = predicted_3d_pos[:,1:,:,:] - predicted_3d_pos[:,:-1,:,:]
-                weights_joints = torch.ones_like(dif_seq).cuda()
-                weights_mul = w_mpjpe
-                assert weights_mul.shape[0] == weights_joints.shape[-2]
-                weights_joints = torch.mul(weights_joints.permute(0,1,3,2),weights_mul).permute(0,1,3,2)
-                dif_seq = torch.mean(torch.multiply(weights_joints, torch.square(dif_seq)))
-
-                loss_diff = 0.5 * dif_seq + 2.0 * mean_velocity_error_train(predicted_3d_pos, inputs_3d, axis=1)
-                
-
-                loss_total = loss_3d_pos + loss_diff
+                losses = pose_root_losses(predicted_3d_pos, inputs_3d, pred_traj, inputs_traj,
+                                          predicted_2d_pos, gt2d, inputs_2d, mask, w_mpjpe)
+                loss_total = losses['loss']
+                loss_mpj = losses['mpjpe']
+                pose_2d_error = losses['error_2d']
+                inputs_2d_error = losses['input_error_2d']
+                loss_resid = losses['mrpe']
                 
                 loss_total.backward(loss_total.clone().detach())
 
                 loss_total = torch.mean(loss_total)
 
-                epoch_loss_3d_train += inputs_3d.shape[0] * inputs_3d.shape[1] * loss_total.item()
-                N += inputs_3d.shape[0] * inputs_3d.shape[1]
-
                 optimizer.step()
 
+                # running sums stay on the device, they are only copied when the bar is refreshed
+                train_metrics.update('loss', loss_total, inputs_3d.shape[0] * inputs_3d.shape[1])
+                train_metrics.update('mpjpe', loss_mpj * 1000, inputs_3d.shape[0])
+                train_metrics.update('error_2d', pose_2d_error * 1000, inputs_3d.shape[0])
+                train_metrics.update('input_2d', (pose_2d_error - inputs_2d_error) * 1000, inputs_3d.shape[0])
+                train_metrics.update('mrpe', loss_resid * 1000, inputs_3d.shape[0])
+
                 batch_time.update(time() - end)
                 end = time()
-                mpj.update(loss_mpj.item() * 1000, inputs_3d.shape[0])
-                mpj_2d.update(pose_2d_error.item() * 1000 - inputs_2d_error.item() * 1000, inputs_3d.shape[0])
-                root.update(loss_resid.item() * 1000, inputs_3d.shape[0])
                 if rank == 0:
-                    bar.suffix = '({batch}/{size}) Batch: {bt:.3f}s | Elapsed Time: {ttl:} | ETA: {eta:} ' \
-                            '| MPJPE: {mpj: .1f}({loss: .1f}) | 2D Error:  {p2d: .1f}({input2d: .1f})| MRPE: {res: .1f}({root: .1f})' \
-                    .format(batch=i + 1, size=len(dataloader), bt=batch_time.avg,
-                            ttl=bar.elapsed_td, eta=bar.eta_td, loss=mpj.avg, mpj=loss_mpj.item() * 1000, p2d= pose_2d_error.item() * 1000,res=loss_resid.item() * 1000 ,input2d = mpj_2d.avg, root = root.avg)
+                    if (i + 1) % args.bar_interval == 0 or i + 1 == len(dataloader):
+                        avg, last = train_metrics.snapshot()
+                        bar.suffix = '({batch}/{size}) Batch: {bt:.3f}s | Elapsed Time: {ttl:} | ETA: {eta:} ' \
+                                '| MPJPE: {mpj: .1f}({loss: .1f}) | 2D Error:  {p2d: .1f}({input2d: .1f})| MRPE: {res: .1f}({root: .1f})' \
+                        .format(batch=i + 1, size=len(dataloader), bt=batch_time.avg,
+                                ttl=bar.elapsed_td, eta=bar.eta_td, loss=avg['mpjpe'], mpj=last['mpjpe'], p2d=last['error_2d'],
+                                res=last['mrpe'], input2d=avg['input_2d'], root=avg['mrpe'])
                     bar.next()
                 i += 1
             if rank == 0:
                 bar.finish()
-            losses_3d_train.append(epoch_loss_3d_train / N)
+            train_metrics.all_reduce()
+            losses_3d_train.append(train_metrics.result()['loss'])
             torch.cuda.empty_cache()
 
-            # End-of-epoch evaluation
-            if rank == 0:
-                valid_mpjpe = defaultdict(float)
-                valid_vel = defaultdict(float)
-                valid_root = defaultdict(float)
-                num_frames = defaultdict(int)
+            # End-of-epoch evaluation, every rank evaluates its shard of the windows
+            evaluate_train = (epoch + 1) % args.train_eval_interval == 0
+            if async_eval:
+                # rank 0 hands a weights snapshot to the evaluation worker, training goes on without waiting
+                if rank == 0:
+                    snapshot = {
+                        'epoch': epoch + 1,
+                        'lr': lr * lr_decay,
+                        'model_pos': {k: v.detach().cpu() for k, v in model_pos_train.state_dict().items()},
+                        'min_loss': min_loss,
+                        'wandb_id': wandb_id
+                    }
+                    pending_snapshots[epoch + 1] = (snapshot, to_cpu(optimizer.state_dict()))
+                    evaluator.submit(os.path.join("checkpoint/", args.checkpoint, 'snapshot_epoch_{}.bin'.format(epoch + 1)),
+                                     snapshot, evaluate_train)
+            else:
                 with torch.no_grad():
                     model_pos.load_state_dict(model_pos_train.state_dict(), strict=False)
                     model_pos.eval()
 
-                    epoch_loss_3d_valid = 0
-                    epoch_loss_traj_valid = 0
-                    epoch_loss_2d_valid = 0
-                    epoch_loss_3d_vel = 0
-                    N = 0
                     if not args.no_eval:
                         # Evaluate on test set
-                        for cam, batch, batch_2d, act_name in test_generator.next_epoch():
-                            inputs_3d = torch.from_numpy(batch.astype('float32'))
-                            inputs_2d = torch.from_numpy(batch_2d.astype('float32'))
-                            cam = torch.from_numpy(cam.astype('float32'))
-
-                            ##### apply test-time-augmentation (following Videopose3d)
-                            inputs_2d_flip = inputs_2d.clone()
-                            inputs_2d_flip[:, :, :, 0] *= -1
-                            inputs_2d_flip[:, :, kps_left + kps_right, :] = inputs_2d_flip[:, :, kps_right + kps_left, :]
-
-                            ##### convert size
-                            inputs_3d_p = inputs_3d
-                            inputs_2d, inputs_3d = eval_data_prepare(receptive_field, inputs_2d, inputs_3d_p)
-                            inputs_2d_flip, _ = eval_data_prepare(receptive_field, inputs_2d_flip, inputs_3d_p)
-
-                            if torch.cuda.is_available():
-                                inputs_3d = inputs_3d.cuda()
-                                inputs_2d = inputs_2d.cuda()
-                                inputs_2d_flip = inputs_2d_flip.cuda()
-                                b = inputs_3d.shape[0]
-                                cam = cam.cuda()
-                                cam = cam.repeat(b,1)
-                            inputs_traj = inputs_3d[:, :, :1].clone()
-                            inputs_3d[:, :, 0] = 0
-                            predicted_3d_pos = model_pos(inputs_2d)
-                            predicted_3d_pos_flip = model_pos(inputs_2d_flip)
-
-                            predicted_3d_pos_flip[:, :, :, 0] *= -1
-                            predicted_3d_pos_flip[:, :, joints_left + joints_right] = predicted_3d_pos_flip[:, :,
-                                                                                    joints_right + joints_left]
-                            for i in range(predicted_3d_pos.shape[0]):
-                                # print(predicted_3d_pos[i,0,0,0], predicted_3d_pos_flip[i,0,0,0])
-                                predicted_3d_pos[i,:,:,:] = (predicted_3d_pos[i,:,:,:] + predicted_3d_pos_flip[i,:,:,:])/2
-                                # print(predicted_3d_pos[i,0,0,0], predicted_3d_pos_flip[i,0,0,0])
-                            # predicted_3d_pos = torch.mean(torch.cat((predicted_3d_pos, predicted_3d_pos_flip), dim=1), dim=1, keepdim=True)
-                            # predicted_3d_pos, pred_traj, predicted_2d_pos = refine_pose(predicted_3d_pos, inputs_2d, cam, iterations=3)
-                            # del inputs_2d, inputs_2d_flip
-                            # torch.cuda.empty_cache()
-                            pred_root, _ = get_root(predicted_3d_pos, inputs_2d, cam)
-                            # set root as zero
-                            # predicted_3d_pos[:, :, 0] =
-                            loss_3d_pos = mpjpe(predicted_3d_pos, inputs_3d)
-
-                            valid_mpjpe[act_name] += inputs_3d.shape[0] * inputs_3d.shape[1] * loss_3d_pos.item()
-                            valid_root[act_name] += inputs_3d.shape[0] * inputs_3d.shape[1] * mpjpe(pred_root, inputs_traj).item()
-                            num_frames[act_name] += inputs_3d.shape[0] * inputs_3d.shape[1]
-
-                            loss_3d_vel = mean_velocity_error_train(predicted_3d_pos, inputs_3d, axis=1)
-                            valid_vel[act_name] += inputs_3d.shape[0] * inputs_3d.shape[1] * loss_3d_vel.item()
-
-
-                            # del inputs_3d, loss_3d_pos, predicted_3d_pos
-                            # torch.cuda.empty_cache()
-                        for k in valid_mpjpe.keys():
-                            valid_mpjpe[k] /= num_frames[k]
-                            valid_vel[k] /= num_frames[k]
-                            valid_root[k] /= num_frames[k]
-                        losses_3d_valid = sum(valid_mpjpe.values()) / len(num_frames.keys())
-                        epoch_loss_3d_vel = sum(valid_vel.values()) / len(num_frames.keys())
-                        valid_root = sum(valid_root.values()) / len(num_frames.keys())
-
-                        # Evaluate on training set, this time in evaluation mode
-                        epoch_loss_3d_train_eval = 0
-                        epoch_loss_traj_train_eval = 0
-                        epoch_loss_2d_train_labeled_eval = 0
-                        N = 0
-                        for cam, batch, batch_2d, _ in train_generator_eval.next_epoch():
-                            if batch_2d.shape[1] == 0:
-                                # This can only happen when downsampling the dataset
-                                continue
-
-                            inputs_3d = torch.from_numpy(batch.astype('float32'))
-                            inputs_2d = torch.from_numpy(batch_2d.astype('float32'))
-                            cam = torch.from_numpy(cam.astype('float32'))
-                            inputs_2d, inputs_3d = eval_data_prepare(receptive_field, inputs_2d, inputs_3d)
-
-                            if torch.cuda.is_available():
-                                inputs_3d = inputs_3d.cuda()
-                                inputs_2d = inputs_2d.cuda()
-                                b = inputs_3d.shape[0]
-                                cam = cam.cuda()
-                                cam = cam.repeat(b,1)
-                            inputs_3d[:, :, 0] = 0
-
-                            # Compute 3D poses
-                            predicted_3d_pos = model_pos(inputs_2d)
-
-                            # del inputs_2d
-                            # torch.cuda.empty_cache()
-                            
-                            # set root as zero
-                            # predicted_3d_pos[:, :, 0] = 0
-                            loss_3d_pos = mpjpe(predicted_3d_pos, inputs_3d)
-                            epoch_loss_3d_train_eval += inputs_3d.shape[0] * inputs_3d.shape[1] * loss_3d_pos.item()
-                            N += inputs_3d.shape[0] * inputs_3d.shape[1]
-
-                            # del inputs_3d, loss_3d_pos, predicted_3d_pos
-                            # torch.cuda.empty_cache()
-
-                        losses_3d_train_eval.append(epoch_loss_3d_train_eval / N)
+                        valid_errors = evaluate_actions(test_generator, model_pos, root_solver, device, pose_flip)
+                        valid_errors.all_reduce()
+
+                        # Evaluate on (a sample of) the training set, this time in evaluation mode
+                        train_errors = None
+                        if evaluate_train:
+                            train_errors = evaluate_actions(train_generator_eval, model_pos, root_solver, device)
+                            train_errors.all_reduce()
+
+                        summary = epoch_summary(valid_errors, train_errors, train_generator_eval)
+                        losses_3d_valid = summary['valid']
+                        epoch_loss_3d_vel = summary['valid_velocity']
+                        valid_root = summary['valid_root']
+                        if evaluate_train:
+                            losses_3d_train_eval.append(summary['train_eval'])
 
                         # Evaluate 2D loss on unlabeled training set (in evaluation mode)
                         epoch_loss_2d_train_unlabeled_eval = 0
                         N_semi = 0
             elapsed = (time() - start_time) / 60
             if rank == 0:
-                if args.no_eval:
+                if args.no_eval or async_eval:
                     print('[%d] time %.2f lr %f 3d_train %f' % (
                         epoch + 1,
                         elapsed,
@@ -699,19 +581,25 @@ def main():
                 else:
                     print(f"[{epoch + 1}] time {elapsed:.2f} lr {lr:.6f} "
                           f"Loss(Train) {losses_3d_train[-1] * 1000:.1f} "
-                          f"MPJPE(Train) {losses_3d_train_eval[-1] * 1000:.1f}mm "
+                          f"{train_eval_text(summary)} "
                           f"MPJPE(Test) {losses_3d_valid * 1000:.1f}mm "
                           f"MRPE(Test) {valid_root * 1000:.1f}mm "
                           f"MPJVE(Test){epoch_loss_3d_vel * 1000:.2f}mm")
                     if not args.nolog:
-                        writer.add_scalar("Loss/3d training eval loss", losses_3d_train_eval[-1] * 1000, epoch+1)
+                        log = {"3d_train": losses_3d_train[-1] * 1000, "3d_valid": losses_3d_valid * 1000, "3d_val_velocity": epoch_loss_3d_vel * 1000}
+                        if evaluate_train:
+                            writer.add_scalar("Loss/3d training eval loss", losses_3d_train_eval[-1] * 1000, epoch+1)
+                            log["3d_train_eval"] = losses_3d_train_eval[-1] * 1000
                         writer.add_scalar("Loss/3d validation loss", losses_3d_valid * 1000, epoch+1)
-                        wandb.log({"3d_train": losses_3d_train[-1] * 1000, "3d_train_eval": losses_3d_train_eval[-1] * 1000, "3d_valid": losses_3d_valid * 1000, "3d_val_velocity": epoch_loss_3d_vel * 1000}, epoch+1)
+                        wandb.log(log, epoch+1)
                 if not args.nolog:
                     writer.add_scalar("Loss/3d training loss", losses_3d_train[-1] * 1000, epoch+1)
                     writer.add_scalar("Parameters/learing rate", lr, epoch+1)
                     writer.add_scalar('Parameters/training time per epoch', elapsed, epoch+1)
                     wandb.log({"3d_train": losses_3d_train[-1] * 1000}, epoch+1, commit=True)
+                if async_eval:
+                    for result in evaluator.poll():
+                        min_loss = report_evaluation(*result)
             # Decay learning rate exponentially
             lr *= lr_decay
             for param_group in optimizer.param_groups:
@@ -722,56 +610,27 @@ def main():
             # momentum = initial_momentum * np.exp(-epoch/args.epochs * np.log(initial_momentum/final_momentum))
             # model_pos_train.set_bn_momentum(momentum)
 
-            # Save checkpoint if necessary
-            if epoch % args.checkpoint_frequency == 0 and rank == 0:
-                chk_path = os.path.join(args.checkpoint, 'epoch_{}.bin'.format(epoch))
-                chk_path = "checkpoint/" + chk_path
-                print('Saving checkpoint to', chk_path)
-
-                torch.save({
-                    'epoch': epoch,
-                    'lr': lr,
-                    'optimizer': optimizer.state_dict(),
-                    'model_pos': model_pos_train.state_dict(),
-                    'min_loss': min_loss,
-                    'wandb_id': wandb_id
-                    # 'model_traj': model_traj_train.state_dict() if semi_supervised else None,
-                    # 'random_state_semi': semi_generator.random_state() if semi_supervised else None,
-                }, chk_path)
-
-            #### save best checkpoint
-            best_chk_path = os.path.join(args.checkpoint, 'best_epoch.bin'.format(epoch))
-            best_chk_path = "checkpoint/" + best_chk_path
-            # min_loss = 41.65
+            # Save checkpoints if necessary: periodic, best MPJPE and best MRPE, written in the background
             if rank == 0:
-                if losses_3d_valid * 1000 < min_loss:
-                    min_loss = losses_3d_valid * 1000
-                    print("save best checkpoint")
-                    torch.save({
-                        'epoch': epoch,
-                        'lr': lr,
-                        'optimizer': optimizer.state_dict(),
-                        'model_pos': model_pos_train.state_dict(),
-                        "min_loss": min_loss,
-                        'wandb_id': wandb_id
-                        # 'model_traj': model_traj_train.state_dict() if semi_supervised else None,
-                        # 'random_state_semi': semi_generator.random_state() if semi_supervised else None,
-                    }, best_chk_path)
-                best_chk_path = os.path.join(args.checkpoint, 'best_epochR.bin'.format(epoch))
-                best_chk_path = "checkpoint/" + best_chk_path
-                if valid_root * 1000 < min_root:
-                    min_root = valid_root * 1000
-                    print("save best checkpoint")
-                    torch.save({
-                        'epoch': epoch,
-                        'lr': lr,
-                        'optimizer': optimizer.state_dict(),
-                        'model_pos': model_pos_train.state_dict(),
-                        "min_loss": min_loss,
-                        'wandb_id': wandb_id
-                        # 'model_traj': model_traj_train.state_dict() if semi_supervised else None,
-                        # 'random_state_semi': semi_generator.random_state() if semi_supervised else None,
-                    }, best_chk_path)
+                chk_names = []
+                periodic = None
+                if epoch % args.checkpoint_frequency == 0:
+                    periodic = 'epoch_{}.bin'.format(epoch)
+                    chk_names.append(periodic)
+                    print('Saving checkpoint to', "checkpoint/" + os.path.join(args.checkpoint, periodic))
+                if not async_eval:
+                    # min_loss = 41.65
+                    if losses_3d_valid * 1000 < min_loss:
+                        min_loss = losses_3d_valid * 1000
+                        print("save best checkpoint")
+                        chk_names.append('best_epoch.bin')
+                    if valid_root * 1000 < min_root:
+                        min_root = valid_root * 1000
+                        print("save best checkpoint")
+                        chk_names.append('best_epochR.bin')
+                # the optimizer state goes to a file of its own, shared by all checkpoints of the epoch
+                checkpoints.save(epoch, chk_names, model_pos_train.state_dict(), optimizer.state_dict(), periodic=periodic,
+                                 lr=lr, min_loss=min_loss, wandb_id=wandb_id)
 
             # Save training curves after every epoch, as .png images (if requested)
             if args.export_training_curves and epoch > 3:
@@ -792,9 +651,28 @@ def main():
                 plt.savefig(os.path.join(args.checkpoint, 'loss_3d.png'))
 
                 plt.close('all')
+        if async_eval and rank == 0:
+            for result in evaluator.close():
+                min_loss = report_evaluation(*result)
+        if rank == 0:
+            checkpoints.close()
     # Training end
 
     # Evaluate
+    def load_eval_checkpoint(model_eval):
+        # load best checkpoint
+        if args.evaluate == '':
+            chk_file_path = os.path.join("checkpoint/", args.checkpoint, 'best_epoch.bin')
+            print('Loading best checkpoint', chk_file_path)
+        elif args.evaluate != '':
+            chk_file_path = os.path.join("checkpoint/", args.checkpoint, args.evaluate)
+            print('Loading evaluate checkpoint', chk_file_path)
+        checkpoint = torch.load(chk_file_path, map_location=lambda storage, loc: storage)
+        print('This model was trained for {} epochs'.format(checkpoint['epoch']))
+        # model_pos_train.load_state_dict(checkpoint['model_pos'], strict=False)
+        model_eval.load_state_dict(checkpoint['model_pos'], strict=False)
+        model_eval.eval()
+
     def evaluate(test_generator, action=None, return_predictions=False, use_trajectory_model=False, newmodel=None):
         epoch_loss_3d_pos = 0
         epoch_loss_3d_pos_procrustes = 0
@@ -812,78 +690,41 @@ def main():
             else:
                 model_eval = model_pos
                 if not use_trajectory_model:
-                    # load best checkpoint
-                    if args.evaluate == '':
-                        chk_file_path = os.path.join("checkpoint/", args.checkpoint, 'best_epoch.bin')
-                        print('Loading best checkpoint', chk_file_path)
-                    elif args.evaluate != '':
-                        chk_file_path = os.path.join("checkpoint/", args.checkpoint, args.evaluate)
-                        print('Loading evaluate checkpoint', chk_file_path)
-                    checkpoint = torch.load(chk_file_path, map_location=lambda storage, loc: storage)
-                    print('This model was trained for {} epochs'.format(checkpoint['epoch']))
-                    # model_pos_train.load_state_dict(checkpoint['model_pos'], strict=False)
-                    model_eval.load_state_dict(checkpoint['model_pos'], strict=False)
-                    model_eval.eval()
+                    load_eval_checkpoint(model_eval)
             # else:
                 # model_traj.eval()
             N = 0
-            for cam, batch, batch_2d in test_generator.next_epoch():
+            for cam, batch, batch_2d, _ in test_generator.next_epoch():
                 inputs_2d = torch.from_numpy(batch_2d.astype('float32'))
                 inputs_3d = torch.from_numpy(batch.astype('float32'))
                 cam = torch.from_numpy(cam.astype('float32'))
 
 
-                ##### apply test-time-augmentation (following Videopose3d)
-                inputs_2d_flip = inputs_2d.clone()
-                inputs_2d_flip [:, :, :, 0] *= -1
-                inputs_2d_flip[:, :, kps_left + kps_right,:] = inputs_2d_flip[:, :, kps_right + kps_left,:]
-
                 ##### convert size
-                inputs_3d_p = inputs_3d
                 if newmodel is not None:
-                    def eval_data_prepare_pf(receptive_field, inputs_2d, inputs_3d):
-                        inputs_2d_p = torch.squeeze(inputs_2d)
-                        inputs_3d_p = inputs_3d.permute(1,0,2,3)
-                        padding = int(receptive_field//2)
-                        inputs_2d_p = rearrange(inputs_2d_p, 'b f c -> f c b')
-                        inputs_2d_p = F.pad(inputs_2d_p, (padding,padding), mode='replicate')
-                        inputs_2d_p = rearrange(inputs_2d_p, 'f c b -> b f c')
-                        out_num = inputs_2d_p.shape[0] - receptive_field + 1
-                        eval_input_2d = torch.empty(out_num, receptive_field, inputs_2d_p.shape[1], inputs_2d_p.shape[2])
-                        for i in range(out_num):
-                            eval_input_2d[i,:,:,:] = inputs_2d_p[i:i+receptive_field, :, :]
-                        return eval_input_2d, inputs_3d_p
-                    
-                    inputs_2d, inputs_3d = eval_data_prepare_pf(81, inputs_2d, inputs_3d_p)
-                    inputs_2d_flip, _ = eval_data_prepare_pf(81, inputs_2d_flip, inputs_3d_p)
+                    # PoseFormer predicts the center frame of a window around every frame
+                    inputs_2d, _ = sliding_windows(inputs_2d[0], 81, stride=1, pad=81 // 2)
+                    inputs_3d = inputs_3d.permute(1,0,2,3)
                 else:
-                    inputs_2d, inputs_3d = eval_data_prepare(receptive_field, inputs_2d, inputs_3d_p)
-                    inputs_2d_flip, _ = eval_data_prepare(receptive_field, inputs_2d_flip, inputs_3d_p)
-
-                if torch.cuda.is_available():
-                    inputs_2d = inputs_2d.cuda()
-                    inputs_2d_flip = inputs_2d_flip.cuda()
-                    inputs_3d = inputs_3d.cuda()
-                    b = inputs_3d.shape[0]
-                    cam = cam.cuda()
-                    cam = cam.repeat(b,1)
+                    inputs_2d, _ = sliding_windows(inputs_2d[0], receptive_field)
+                    inputs_3d, _ = sliding_windows(inputs_3d[0], receptive_field)
+
+                inputs_2d = inputs_2d.to(device)
+                inputs_3d = inputs_3d.to(device)
+                cam = cam.to(device).repeat(inputs_3d.shape[0], 1)
                 
                 inputs_traj = inputs_3d[:, :, :1].clone()
                 inputs_3d[:, :, 0] = 0
                 
-                predicted_3d_pos = model_eval(inputs_2d)
-                predicted_3d_pos_flip = model_eval(inputs_2d_flip)
-                predicted_3d_pos_flip[:, :, :, 0] *= -1
-                predicted_3d_pos_flip[:, :, joints_left + joints_right] = predicted_3d_pos_flip[:, :,
-                                                                        joints_right + joints_left]
-                for i in range(predicted_3d_pos.shape[0]):
-                    predicted_3d_pos[i,:,:,:] = (predicted_3d_pos[i,:,:,:] + predicted_3d_pos_flip[i,:,:,:])/2
+                ##### apply test-time-augmentation (following Videopose3d)
+                predicted_3d_pos = FlipTTA(model_eval, pose_flip)(inputs_2d)
                 predicted_3d_pos[:, :, 0] = 0
-                # predicted_3d_pos, pred_root, predicted_2d_pos = refine_pose(predicted_3d_pos, inputs_2d, cam)
-                pred_root, _ = get_root(predicted_3d_pos, inputs_2d, cam)
+                pred_root, _ = root_solver(predicted_3d_pos, inputs_2d, cam)
 
                 if return_predictions:
-                    return predicted_3d_pos.squeeze().cpu().numpy()
+                    if newmodel is not None:
+                        return predicted_3d_pos.squeeze().cpu().numpy()
+                    return predicted_3d_pos.cpu().numpy()
                 
     
                 error = mpjpe(predicted_3d_pos, inputs_3d)
@@ -893,13 +734,13 @@ def main():
                 epoch_loss_3d_pos += inputs_3d.shape[0]*inputs_3d.shape[1] * error.item()
                 N += inputs_3d.shape[0] * inputs_3d.shape[1]
 
-                inputs = inputs_3d.cpu().numpy().reshape(-1, inputs_3d.shape[-2], inputs_3d.shape[-1])
-                predicted_3d_pos = predicted_3d_pos.cpu().numpy().reshape(-1, inputs_3d.shape[-2], inputs_3d.shape[-1])
+                inputs = inputs_3d.reshape(-1, inputs_3d.shape[-2], inputs_3d.shape[-1])
+                predicted_3d_pos = predicted_3d_pos.reshape(-1, inputs_3d.shape[-2], inputs_3d.shape[-1])
 
-                epoch_loss_3d_pos_procrustes += inputs_3d.shape[0]*inputs_3d.shape[1] * p_mpjpe(predicted_3d_pos, inputs)
+                epoch_loss_3d_pos_procrustes += inputs_3d.shape[0]*inputs_3d.shape[1] * p_mpjpe(predicted_3d_pos, inputs).item()
 
                 # Compute velocity error
-                epoch_loss_3d_vel += inputs_3d.shape[0]*inputs_3d.shape[1] * mean_velocity_error(predicted_3d_pos, inputs)
+                epoch_loss_3d_vel += inputs_3d.shape[0]*inputs_3d.shape[1] * mean_velocity_error(predicted_3d_pos, inputs).item()
         if action is None:
             print('----------')
         else:
@@ -936,9 +777,8 @@ def main():
         if args.compare:
             from common.model_poseformer import PoseTransformer
             model_pf = PoseTransformer(num_frame=81, num_joints=17, in_chans=2, num_heads=8, mlp_ratio=2., qkv_bias=False, qk_scale=None,drop_path_rate=0.1)
-            if torch.cuda.is_available():
-                model_pf = nn.DataParallel(model_pf)
-                model_pf = model_pf.cuda()
+            model_pf = nn.DataParallel(model_pf)
+            model_pf = model_pf.to(device)
             prediction_pf = evaluate(gen, newmodel=model_pf, return_predictions=True)
             
             # ### reshape prediction_pf as ground truth
@@ -956,17 +796,8 @@ def main():
         # if model_traj is not None and ground_truth is None:
         #     prediction_traj = evaluate(gen, return_predictions=True, use_trajectory_model=True)
         #     prediction += prediction_traj
-        ### reshape prediction as ground truth
-        if ground_truth.shape[0] / receptive_field > ground_truth.shape[0] // receptive_field: 
-            batch_num = (ground_truth.shape[0] // receptive_field) +1
-            prediction2 = np.empty_like(ground_truth)
-            for i in range(batch_num-1):
-                prediction2[i*receptive_field:(i+1)*receptive_field,:,:] = prediction[i,:,:,:]
-            left_frames = ground_truth.shape[0] - (batch_num-1)*receptive_field
-            prediction2[-left_frames:,:,:] = prediction[-1,-left_frames:,:,:]
-            prediction = prediction2
-        elif ground_truth.shape[0] / receptive_field == ground_truth.shape[0] // receptive_field:
-            prediction.reshape(ground_truth.shape[0], 17, 3)
+        ### stitch the windows back into one sequence
+        prediction = merge_windows(prediction, window_index(input_keypoints.shape[0], receptive_field))
 
         if args.viz_export is not None:
             print('Exporting joint positions to', args.viz_export)
@@ -1045,11 +876,13 @@ def main():
                 out_poses_3d = []
                 out_poses_2d = []
                 out_camera_params = []
+                out_actions = []
 
                 for subject, action in actions:
                     poses_2d = keypoints[subject][action]
                     for i in range(len(poses_2d)): # Iterate across cameras
                         out_poses_2d.append(poses_2d[i])
+                        out_actions.append(action.split(' ')[0])
 
                     poses_3d = dataset[subject][action]['positions_3d']
                     assert len(poses_3d) == len(poses_2d), 'Camera count mismatch'
@@ -1072,7 +905,7 @@ def main():
                         if out_poses_3d is not None:
                             out_poses_3d[i] = out_poses_3d[i][::stride]
 
-                return out_camera_params ,out_poses_3d, out_poses_2d
+                return out_camera_params ,out_poses_3d, out_poses_2d, out_actions
 
             def run_evaluation(actions, action_filter=None):
                 errors_p1 = []
@@ -1081,6 +914,8 @@ def main():
                 errors_vel = []
                 # joints_errs_list=[]
 
+                # All selected actions are evaluated in one pass, with windows of different sequences packed together
+                selected = []
                 for action_key in actions.keys():
                     if action_filter is not None:
                         found = False
@@ -1090,13 +925,26 @@ def main():
                                 break
                         if not found:
                             continue
-
-                    cams_act ,poses_act, poses_2d_act = fetch_actions(actions[action_key])
-                    gen = UnchunkedGenerator_Seq(cams_act, poses_act, poses_2d_act,
-                                            pad=pad, causal_shift=causal_shift, augment=args.test_time_augmentation,
-                                            kps_left=kps_left, kps_right=kps_right, joints_left=joints_left,
-                                            joints_right=joints_right)
-                    e1, e2, e3, ev = evaluate(gen, action_key)
+                    selected += actions[action_key]
+
+                cams_act, poses_act, poses_2d_act, actions_act = fetch_actions(selected)
+                gen = PackedGenerator_Seq(args.eval_batch_size, cams_act, poses_act, poses_2d_act, receptive_field,
+                                          actions=actions_act)
+                load_eval_checkpoint(model_pos)
+                errors = evaluate_actions(gen, model_pos, root_solver, device, pose_flip, zero_root=True, procrustes=True)
+
+                for action_key in errors.action_names():
+                    e1 = errors.result('mpjpe', action_key)*1000
+                    e2 = errors.result('p_mpjpe', action_key)*1000
+                    e3 = errors.result('mrpe', action_key)*1000
+                    ev = errors.result('mpjve', action_key)*1000
+                    print('----'+action_key+'----')
+                    print('Test time augmentation:', args.test_time_augmentation)
+                    print('Protocol #1 Error (MPJPE):', e1, 'mm')
+                    print('Protocol #2 Error (MRPE):', e3, 'mm')
+                    print('Protocol #3 Error (P-MPJPE):', e2, 'mm')
+                    print('Velocity Error (MPJVE):', ev, 'mm')
+                    print('----------')
                     
                     # joints_errs_list.append(joints_errs)
 